@@ -4,7 +4,7 @@ Main command-line interface for the application
 
 import argparse
 
-from SBDY_app import run
+from SBDY_app import options, run
 
 
 parser = argparse.ArgumentParser(
@@ -12,9 +12,13 @@ parser = argparse.ArgumentParser(
 parser.add_argument("--host", default="localhost",
                     help="change where app will be hosted,"
                     " default is 'localhost'")
+parser.add_argument("--storage", choices=["sqlite", "memory"],
+                    default=options.STORAGE_BACKEND,
+                    help="where the units are kept, default is 'sqlite'")
 
 args = parser.parse_args()
 
 
 if __name__ == "__main__":
+    options.STORAGE_BACKEND = args.storage
     run(host=args.host)
@@ -1,33 +1,54 @@
 import logging
 from datetime import datetime, timedelta
+from hashlib import sha256
+from itertools import islice
 from math import ceil
-from typing import Any, Dict, Optional
+from typing import Dict, List, Optional, Set
 from uuid import UUID
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Header, Request, Response
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from sqlalchemy.engine import Row
 
 from . import __name__ as mod_name
-from . import crud, models, options
-from .database import db_injection, db_shutdown, db_startup, engine
+from . import (events, models, options, parsing, storage, streaming,
+               tree_cache)
+from .coalescer import Coalescer
+from .compaction import Compactor
 from .docs import info, paths
-from .exceptions import ItemNotFound, ValidationFailed, add_exception_handlers
-from .schemas import (Error, Import, ImpRequest, ShopUnit, ShopUnitType,
-                      StatResponse)
-from .typedefs import DB, AnyCallable, ShopUnits, T
+from .exceptions import (ItemNotFound, StreamValidationFailed,
+                         ValidationFailed, add_exception_handlers)
+from .jobs import JobQueue
+from .purger import Purger
+from .retention import Retention
+from .schemas import (DeleteRequest, Error, Import, ImpRequest, Job,
+                      JobStatus, ShopUnit, ShopUnitType, StatResponse)
+from .storage import (Transaction, read_db_injection, read_session,
+                      write_db_injection, write_session)
+from .typedefs import AnyCallable, Deltas, Links
 
 
 logger = logging.getLogger(mod_name)
 
+# number of the events of the log replayed in one transaction
+REPLAY_BATCH = 1000
 
-def path_with_docs(decorator: AnyCallable, path: str, **kw) -> AnyCallable:
+
+def path_with_docs(decorator: AnyCallable, path: str, *,
+                   raw_body: bool = False, **kw) -> AnyCallable:
     # TODO: for aesthetics add examples for errors and inputs
     # https://fastapi.tiangolo.com/tutorial/schema-extra-example/
 
     docs = paths[path][decorator.__name__]
 
-    docs.pop("requestBody", None)
+    body = docs.pop("requestBody", None)
     docs.pop("parameters", None)
 
+    # the handler reads the body itself, so fastapi knows nothing about it
+    if raw_body:
+        kw["openapi_extra"] = {"requestBody": body}
+
     for code, info in docs["responses"].items():
         if code == "400":
             info["model"] = Error
@@ -47,12 +68,27 @@ add_exception_handlers(app)
 
 @app.on_event("startup")
 async def startup():
-    await db_startup()
+    await storage.startup()
+    tree_cache.cache.clear()
+    events.open_log()
+    replayed = await replay_events()
+    if replayed:
+        logger.info(f"Replayed {replayed} events of the log on startup")
+    job_queue.start()
+    purger.start()
+    retention.start()
+    compactor.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    await db_shutdown()
+    await job_queue.stop()
+    await purger.stop()
+    await retention.stop()
+    await compactor.stop()
+    parsing.shutdown()
+    await storage.shutdown()
+    events.close_log()
 
 
 # XXX: return status code 404?
@@ -62,151 +98,443 @@ async def cleanup_database() -> None:
     if not options.DEV_MODE:
         return
 
-    async with engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.drop_all)  # type: ignore
-        await conn.run_sync(models.Base.metadata.create_all)  # type: ignore
+    await storage.current().clear()
+    tree_cache.cache.clear()
+    events.log.clear()
 
 
-def update_parents(parents: ShopUnits,
-                   parent_id: Optional[UUID],
-                   diff: int, count: int = 0) -> None:
+def add_delta(deltas: Deltas, parent_id: Optional[UUID],
+              diff: int, count: int = 0) -> None:
     if parent_id is None:
         return
 
-    parent = parents[parent_id]
-    parent.price += diff
-    parent.sub_offers_count += count
+    price, sub_offers_count = deltas.get(parent_id, (0, 0))
+    deltas[parent_id] = (price + diff, sub_offers_count + count)
 
-    update_parents(parents, parent.parentId, diff, count)
 
+def bottom_up(parents: Links) -> List[UUID]:
+    """
+    Orders the parents so that every unit goes before its parent
+    (parents outside of 'parents' are considered roots),
+    raises ValidationFailed if the parents form a cycle
+    """
 
-def setattrs(o: T, attrs: Dict[str, Any]) -> T:
-    for name, value in attrs.items():
-        setattr(o, name, value)
-    return o
+    depths: Dict[UUID, int] = {}
 
+    for id in parents.keys():
+        chain: List[UUID] = []
+        seen: Set[UUID] = set()
+        current: Optional[UUID] = id
+        while current in parents and current not in depths:
+            if current in seen:
+                logger.error(f"Cycle in the parents of {id}")
+                raise ValidationFailed
+            seen.add(current)
+            chain.append(current)
+            current = parents[current]  # type: ignore
 
-def update_unit(
-    db: DB, date: datetime, imp: Import,
-    unit: Optional[models.ShopUnit], *, record: bool,
-    _kw: dict = {"date": None, "sub_offers_count": 0}
-) -> models.ShopUnit:
+        depth = depths.get(current, -1)  # type: ignore
+        for current in reversed(chain):
+            depth += 1
+            depths[current] = depth
 
-    _kw["date"] = date
+    return sorted(depths.keys(), key=depths.__getitem__, reverse=True)
 
-    if unit is None:
-        # new
-        result = crud.create_shop_unit(db, **_kw, **imp.dict())
-    elif unit.type == ShopUnitType.CATEGORY:
-        # change in db
-        result = setattrs(unit, imp.dict(exclude={"price"}))
-    elif unit.type == ShopUnitType.OFFER:
-        # change in db
-        result = setattrs(unit, {**_kw, **imp.dict()})
-    else:
-        raise ValueError(f"Unknown unit type: {unit.type}")
 
-    if record:
-        crud.create_stat_unit(db, result)
-    return result
+def update_parents(parents: Links, deltas: Deltas) -> Deltas:
+    """
+    Spreads the 'deltas' to the parents and all of their ancestors,
+    they are accumulated in one pass, so each parent is visited once,
+    returns the total change of every affected parent
+    """
+
+    deltas = dict(deltas)
+    totals: Deltas = {}
+    for id in bottom_up(parents):
+        diff, count = deltas.pop(id, (0, 0))
+        if diff == 0 and count == 0:
+            continue
+
+        totals[id] = (diff, count)
+        add_delta(deltas, parents[id], diff, count)
+
+    return totals
+
 
+def unchanged(unit: Row, imp: Import) -> bool:
+    if unit.name != imp.name or unit.parentId != imp.parentId:
+        return False
+    # the price of a category is the sum of its offers, not imported
+    return imp.type == ShopUnitType.CATEGORY or unit.price == imp.price
+
+
+async def import_units(db: Transaction, req: ImpRequest) -> int:
+    """
+    Applies the import, but doesn't commit,
+    raises ValidationFailed if the import is invalid,
+    returns the number of the unchanged items that were skipped
+    """
 
-@path_with_docs(app.post, "/imports")
-async def imports(req: ImpRequest, db: DB = db_injection) -> str:
     items = {imp.id: imp for imp in req.items}
-    units = await crud.shop_units(db, items.keys())
+
+    # the deleted units that are imported again can't wait for the purge
+    dead = await db.dead_units(items.keys())
+    for root in set(dead.values()):
+        await db.purge_subtree(root)
 
     # validate type (no changes allowed)
-    for id, unit in units.items():
-        if items[unit.id].type != unit.type:
-            logger.error(f"Type change of {unit.id}:"
-                         f" {items[unit.id].type} != {unit.type}")
-            raise ValidationFailed
+    if await db.type_changed(items.values()):
+        logger.error("Type change of some of the units")
+        raise ValidationFailed
+
+    units = await db.shop_unit_states(items.keys())
+
+    skipped = 0
+    if options.SKIP_UNCHANGED:
+        items = {id: imp for id, imp in items.items()
+                 if id not in units or not unchanged(units[id], imp)}
+        units = {id: unit for id, unit in units.items() if id in items}
+        skipped = len(req.items) - len(items)
+        logger.info(f"Import skips {skipped} unchanged items"
+                    f" and applies {len(items)}")
+
+    # units that are new or change the parent, the tree has to follow them
+    new: Links = {id: imp.parentId for id, imp in items.items()
+                  if id not in units}
+    moved: Links = {id: imp.parentId for id, imp in items.items()
+                    if id in units and units[id].parentId != imp.parentId}
 
     possible_parent_ids = {u.parentId for u in units.values() if u.parentId}
     possible_parent_ids |= {i.parentId for i in items.values() if i.parentId}
 
-    parents = await crud.shop_units_parents(db, possible_parent_ids)
+    if await db.dead_units(possible_parent_ids):
+        logger.error("Some of the parents are deleted")
+        raise ValidationFailed
 
-    # add parents from the import request
-    for id in possible_parent_ids:
-        parent = parents.get(id, None)  # type: ignore
-        imp_parent = items.get(id, None)  # type: ignore
+    stored = await db.shop_units_parents(possible_parent_ids)
 
-        if imp_parent is None:
-            if parent is None:
-                # non-existent
-                logger.error(f"Non-existent {id}")
-                raise ValidationFailed
-            else:
-                # present in db, no change
-                pass
+    # links between the parents as they will be after the import
+    parents: Links = {}
+    for id in possible_parent_ids | stored.keys():
+        imp_parent = items.get(id, None)  # type: ignore
+        parent = stored.get(id, None)  # type: ignore
+
+        if imp_parent is not None:
+            # from the import request
+            parents[id], tp = imp_parent.parentId, imp_parent.type
+        elif parent is not None:
+            # present in db, no change
+            parents[id], tp = parent.parentId, parent.type
         else:
-            parents[id] = update_unit(
-                db, req.updateDate, imp_parent, parent, record=False)
-
-    # validate parent's type (can only be a category)
-    for parent in parents.values():
-        if parent.type != ShopUnitType.CATEGORY:
-            logger.error(f"Parent {parent.id} is not a category:"
-                         f" {parent.type} != {ShopUnitType.CATEGORY}")
+            # non-existent
+            logger.error(f"Non-existent {id}")
+            raise ValidationFailed
+
+        # validate parent's type (can only be a category)
+        if tp != ShopUnitType.CATEGORY:
+            logger.error(f"Parent {id} is not a category:"
+                         f" {tp} != {ShopUnitType.CATEGORY}")
             raise ValidationFailed
 
     offers: Dict[UUID, Import] = {id: imp for id, imp in items.items()
                                   if imp.type == ShopUnitType.OFFER}
 
     # update parents of offers
+    deltas: Deltas = {}
     for id, imp in offers.items():
         assert imp.price is not None
 
         offer = units.get(id, None)  # type: ignore
         if offer is None:
-            update_parents(parents, imp.parentId, imp.price, count=1)
+            add_delta(deltas, imp.parentId, imp.price, count=1)
             continue
 
         if offer.parentId == imp.parentId:
-            update_parents(parents, imp.parentId, imp.price - offer.price)
+            add_delta(deltas, imp.parentId, imp.price - offer.price)
         else:
-            update_parents(parents, imp.parentId, imp.price, count=1)
-            update_parents(parents, offer.parentId, -offer.price, count=-1)
+            add_delta(deltas, imp.parentId, imp.price, count=1)
+            add_delta(deltas, offer.parentId, -offer.price, count=-1)
 
-    # update parents's date
-    for parent in parents.values():
-        parent.date = req.updateDate
-        crud.create_stat_unit(db, parent)
+    # moved categories take their totals from the old ancestors to the new
+    for id, parent_id in moved.items():
+        category = units[id]
+        if category.type != ShopUnitType.CATEGORY:
+            continue
+        add_delta(deltas, parent_id,
+                  category.price, category.sub_offers_count)
+        add_delta(deltas, category.parentId,
+                  -category.price, -category.sub_offers_count)
+    totals = update_parents(parents, deltas)
 
-    # update offers
-    for id, imp in offers.items():
-        update_unit(db, req.updateDate, imp, units.get(id, None), record=True)
+    await db.upsert_shop_units(req.updateDate, items.values())
+    await db.update_aggregates(totals, date=req.updateDate,
+                               parents=parents.keys())
+    await db.create_stat_units(items.keys() | parents.keys())
+    db.units_changed(items.keys() | parents.keys(), new=new.keys())
 
-    # update the rest of the categories
-    for id in items.keys() - parents.keys() - offers.keys():
-        imp = items[id]
-        assert imp.type == ShopUnitType.CATEGORY
+    # update the tree index, new parents go before their children
+    await db.add_tree_nodes([
+        (id, new[id]) for id in reversed(bottom_up(new))])
+    for id, parent_id in moved.items():
+        await db.move_tree_node(id, parent_id)
 
-        update_unit(db, req.updateDate, imp, units.get(id, None), record=True)
+    return skipped
 
-    await db.commit()
+
+async def apply_import(db: Transaction, req: ImpRequest,
+                       key: Optional[str] = None) -> int:
+    """
+    Applies the import as 'import_units', but if it has the 'key',
+    it's remembered, and if it was applied already, it's not repeated
+    """
+
+    if key is not None:
+        applied = await db.applied_import(key)
+        if applied is not None:
+            return applied.skipped
+
+    skipped = await import_units(db, req)
+    if key is not None:
+        await db.remember_import(key, len(req.items) - skipped,
+                                 skipped, options.REMEMBERED_IMPORTS)
+    db.log_event(import_event(req, key))
+    return skipped
+
+
+coalescer = Coalescer(apply_import)
+
+
+async def commit_import(req: ImpRequest, key: Optional[str] = None) -> int:
+    if options.COALESCE_IMPORTS:
+        return await coalescer.submit(req, key)
+
+    async with write_session() as db:
+        skipped = await apply_import(db, req, key)
+        await db.commit()
+    return skipped
+
+
+async def import_key(request: Request,
+                     idempotency_key: Optional[str] = Header(None)
+                     ) -> Optional[str]:
+    if idempotency_key is not None:
+        return f"key:{idempotency_key}"
+    if options.DEDUPLICATE_IMPORTS:
+        return f"sha256:{sha256(await request.body()).hexdigest()}"
+    return None
+
+
+async def applied_import(key: str) -> Optional[models.AppliedImport]:
+    async with read_session() as db:
+        return await db.applied_import(key)
+
+
+@path_with_docs(app.post, "/imports", raw_body=True)
+async def imports(request: Request, response: Response,
+                  key: Optional[str] = Depends(import_key)) -> str:
+    # the repeated import isn't even parsed
+    applied = None
+    if key is not None:
+        applied = await applied_import(key)
+
+    if applied is None:
+        req = await parsing.parse_import(await request.body())
+        skipped = await commit_import(req, key)
+        applied_items, skipped_items = len(req.items) - skipped, skipped
+    else:
+        response.headers["X-Replayed"] = "true"
+        applied_items, skipped_items = applied.applied, applied.skipped
+
+    response.headers["X-Skipped-Items"] = str(skipped_items)
+    response.headers["X-Applied-Items"] = str(applied_items)
     return "Successful import"
 
 
-@path_with_docs(app.delete, "/delete/{id}")
-async def delete(id: UUID, db: DB = db_injection) -> str:
-    result = await crud.shop_unit(db, id)
-    if result is None:
+@app.post("/imports/stream", tags=["Extensions"],
+          summary="Import newline-delimited items in chunks")
+async def imports_stream(request: Request,
+                         updateDate: datetime) -> Dict[str, int]:
+    """
+    Takes the items of the import (ShopUnitImport) one per line,
+    all of them get the same 'updateDate'.
+    They are imported in chunks of the fixed size, every chunk is
+    validated and committed as a separate /imports,
+    so parents have to go before their children or in the same chunk.
+
+    Responds with the number of committed chunks and items,
+    if a chunk is invalid, the error also has the numbers
+    of the chunks and items committed before it.
+    """
+
+    progress = {"chunks": 0, "items": 0}
+
+    try:
+        async for chunk in streaming.import_chunks(
+                request.stream(), options.STREAM_CHUNK_SIZE):
+            await commit_import(ImpRequest(items=chunk, updateDate=updateDate))
+            progress["chunks"] += 1
+            progress["items"] += len(chunk)
+            logger.info(f"Streamed import progress: {progress}")
+    except (RequestValidationError, ValidationError) as e:
+        logger.error(f"Streamed import failed after {progress}: {e!r}")
+        raise StreamValidationFailed(progress) from e
+
+    return progress
+
+
+job_queue = JobQueue(apply_import)
+purger = Purger()
+retention = Retention()
+compactor = Compactor()
+
+
+@app.post("/imports/jobs", tags=["Extensions"], status_code=202,
+          response_model=Job, summary="Queue an import")
+async def imports_job(req: ImpRequest, request: Request) -> Job:
+    """
+    Takes the same import as /imports, but only saves it and responds,
+    the queued imports are applied in the background in their order.
+
+    Use /imports/jobs/{id} to find out whether it's done.
+    """
+
+    body = (await request.body()).decode("utf-8")
+    return Job(id=await job_queue.submit(body), status=JobStatus.QUEUED)
+
+
+@app.get("/imports/jobs/{id}", tags=["Extensions"],
+         response_model=Job, summary="Status of a queued import")
+async def import_job(id: UUID, db: Transaction = read_db_injection) -> Job:
+    """
+    The status of the import queued by /imports/jobs,
+    if it failed, the error is the one /imports would respond with
+    """
+
+    job = await db.job(id)
+    if job is None:
         raise ItemNotFound
-    await crud.delete_units(db, result.values())
-    await crud.delete_units(db, await crud.stat_units(db, id))
 
-    unit = result[id]
-    if unit.parentId:
-        parents = await crud.shop_unit_parents(db, unit.parentId)
-        update_parents(parents, unit.parentId, -unit.price, count=-1)
+    error = None
+    if job.error is not None:
+        error = Error.parse_raw(job.error)
+    return Job(id=job.id, status=job.status, error=error)
+
+
+async def delete_units(db: Transaction, ids: Set[UUID]) -> None:
+    """
+    Deletes the units with their subtrees, but doesn't commit,
+    the changes of their ancestors are merged and applied at once,
+    raises ItemNotFound if any of the units doesn't exist
+    """
+
+    units = await db.shop_unit_states(ids)
+    if units.keys() != ids or await db.dead_units(ids):
+        raise ItemNotFound
+
+    # the ancestors of every unit, including themselves
+    stored = await db.shop_units_parents(ids)
+    parents: Links = {id: unit.parentId for id, unit in stored.items()}
+
+    deltas: Deltas = {}
+    buried: List[UUID] = []
+    for id, unit in units.items():
+        # the unit under the other deleted unit goes with it
+        parent_id = unit.parentId
+        while parent_id is not None and parent_id not in ids:
+            parent_id = parents[parent_id]
+        if parent_id is not None:
+            continue
+
+        # the price of a category is the sum of its offers
+        count = unit.sub_offers_count
+        if unit.type == ShopUnitType.OFFER:
+            count = 1
 
+        buried.append(id)
+        add_delta(deltas, unit.parentId, -unit.price, -count)
+
+    await db.bury_subtrees(buried)
+    await db.update_aggregates(update_parents(parents, deltas))
+    db.units_changed(parents.keys() - ids, removed=buried)
+    db.log_event({"kind": "delete", "ids": sorted(map(str, ids))})
+
+
+@path_with_docs(app.delete, "/delete/{id}")
+async def delete(id: UUID, db: Transaction = write_db_injection) -> str:
+    await delete_units(db, {id})
     await db.commit()
+    purger.wake()
     return "Successful deletion"
 
 
+@app.post("/delete/batch", tags=["Extensions"],
+          summary="Delete several items at once")
+async def delete_batch(req: DeleteRequest,
+                       db: Transaction = write_db_injection) -> str:
+    """
+    Deletes the items the same way as /delete/{id},
+    but all of them in one transaction, so if any of them
+    is not found, none is deleted and the response is 404
+    """
+
+    await delete_units(db, set(req.ids))
+    await db.commit()
+    purger.wake()
+    return "Successful deletion"
+
+
+def import_event(req: ImpRequest, key: Optional[str]) -> events.Event:
+    # as it was received, the categories come without the price
+    items = [{**imp.dict(), "price": None} if imp.type
+             == ShopUnitType.CATEGORY else imp.dict() for imp in req.items]
+    return {"kind": "import", "key": key,
+            "updateDate": req.updateDate.isoformat(), "items": items}
+
+
+async def apply_event(db: Transaction, event: events.Event) -> None:
+    if event["kind"] == "import":
+        req = ImpRequest(
+            items=event["items"],
+            updateDate=datetime.fromisoformat(event["updateDate"]))
+        await apply_import(db, req, event["key"])
+    elif event["kind"] == "delete":
+        await delete_units(db, set(map(UUID, event["ids"])))
+    else:
+        raise ValueError(f"Unknown event {event['kind']!r}")
+
+
+async def replay_events() -> int:
+    """
+    Applies the events of the log after the last one the storage has,
+    e.g. the ones after its snapshot or lost by a crash before its commit,
+    returns the number of the replayed events
+    """
+
+    async with read_session() as db:
+        last = await db.last_event()
+    # the log could be lost, but its numbers are never reused
+    events.log.skip_to(last)
+
+    replayed = 0
+    tail = events.log.read_after(last)
+    while batch := list(islice(tail, REPLAY_BATCH)):
+        async with write_session() as db:
+            for sequence, event in batch:
+                try:
+                    async with db.begin_nested():
+                        await apply_event(db, event)
+                except (ValidationFailed, ItemNotFound):
+                    logger.error(f"Event {sequence} of the log failed"
+                                 f" on replay: {event}")
+            # they are in the log already
+            db.events.clear()
+            await db.set_last_event(batch[-1][0])
+            await db.commit()
+        replayed += len(batch)
+
+    return replayed
+
+
 def shop_unit_to_schema(unit: models.ShopUnit) -> ShopUnit:
     """
     Takes price and devices it by the number of sub offers,
@@ -225,16 +553,29 @@ def shop_unit_to_schema(unit: models.ShopUnit) -> ShopUnit:
 
 
 @path_with_docs(app.get, "/nodes/{id}", response_model=ShopUnit)
-async def nodes(id: UUID, db: DB = db_injection) -> ShopUnit:
-    result = await crud.shop_unit(db, id)
+async def nodes(id: UUID, db: Transaction = read_db_injection) -> ShopUnit:
+    result = await tree_cache.cache.shop_unit(id, db)
     if result is None:
         raise ItemNotFound
     return shop_unit_to_schema(result[id])
 
 
+@app.get("/nodes_cache", tags=["Extensions"],
+         summary="Counters of the tree cache of /nodes")
+async def nodes_cache() -> Dict[str, int]:
+    """
+    Hits and misses of /nodes/{id} in the tree cache since the start,
+    the subtrees evicted to keep it in the budget, the cached units
+    and their estimated bytes, and the budget (options.TREE_CACHE_BYTES)
+    """
+
+    return tree_cache.cache.counters()
+
+
 @path_with_docs(app.get, "/sales", response_model=StatResponse)
-async def sales(date: datetime, db: DB = db_injection) -> StatResponse:
-    units = await crud.offers_by_date(db, date - timedelta(days=1), date)
+async def sales(date: datetime,
+                db: Transaction = read_db_injection) -> StatResponse:
+    units = await db.offers_by_date(date - timedelta(days=1), date)
     return StatResponse(items=list(units.values()))
 
 
@@ -242,8 +583,8 @@ async def sales(date: datetime, db: DB = db_injection) -> StatResponse:
 async def statistic(id: UUID,
                     dateStart: datetime = datetime.min,
                     dateEnd: datetime = datetime.max,
-                    db: DB = db_injection) -> StatResponse:
-    if not await crud.shop_unit_exists(db, id):
+                    db: Transaction = read_db_injection) -> StatResponse:
+    if not await db.shop_unit_exists(id):
         raise ItemNotFound
-    units = await crud.stat_units_by_date(db, id, dateStart, dateEnd)
+    units = await db.stat_units_by_date(id, dateStart, dateEnd)
     return StatResponse(items=units)
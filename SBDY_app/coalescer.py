@@ -0,0 +1,100 @@
+"""
+Group commit for the imports
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from . import __name__ as mod_name
+from .schemas import ImpRequest
+from .storage import write_session
+
+
+logger = logging.getLogger(mod_name)
+
+Apply = Callable[..., Awaitable[Any]]  # (db, req, *args)
+Pending = Tuple[ImpRequest, Tuple[Any, ...], "asyncio.Future[Any]"]
+
+# the most imports that can share one transaction
+MAX_GROUP = 256
+
+
+class Coalescer:
+    """
+    Imports that arrive while the previous group is being committed
+    are applied together in one transaction with one commit,
+    in the order of their 'updateDate' and then arrival,
+    each import is in its own savepoint, so it still fails alone.
+
+    The chunks of one /imports/stream never share a group,
+    as each of them is submitted only after the previous one is committed,
+    so they can't be reordered
+    """
+
+    def __init__(self, apply: Apply):
+        self.apply = apply
+        self.pending: List[Pending] = []
+        self.worker: Optional[asyncio.Task] = None
+
+    async def submit(self, req: ImpRequest, *args: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((req, args, future))
+
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+
+        return await future
+
+    async def run(self) -> None:
+        group: List[Pending] = []
+        try:
+            while self.pending:
+                group = self.pending[:MAX_GROUP]
+                del self.pending[:MAX_GROUP]
+                await self.commit(group)
+        except asyncio.CancelledError:
+            # e.g. the app is shut down, nobody is going to commit these
+            error = RuntimeError("Group commit of the imports was cancelled")
+            for _, _, future in group + self.pending:
+                settle(future, error)
+            self.pending.clear()
+            raise
+
+    async def commit(self, group: List[Pending]) -> None:
+        # sort is stable, so the arrival order is kept for the same date
+        group = sorted(group, key=lambda pending: pending[0].updateDate)
+        applied = []
+
+        try:
+            async with write_session() as db:
+                for req, args, future in group:
+                    try:
+                        async with db.begin_nested():
+                            result = await self.apply(db, req, *args)
+                    except Exception as e:
+                        settle(future, e)
+                    else:
+                        applied.append((future, result))
+                await db.commit()
+        except Exception as e:
+            # the session itself could fail before any import is applied,
+            # e.g. BEGIN IMMEDIATE gives up waiting for the lock
+            logger.error(f"Group of {len(group)} imports failed: {e!r}")
+            for _, _, future in group:
+                settle(future, e)
+        else:
+            for future, result in applied:
+                settle(future, result=result)
+
+
+def settle(future: "asyncio.Future[Any]",
+           exception: Optional[BaseException] = None,
+           result: Any = None) -> None:
+    # the request could have been cancelled, e.g. client disconnected
+    if future.done():
+        return
+    if exception is None:
+        future.set_result(result)
+    else:
+        future.set_exception(exception)
@@ -0,0 +1,77 @@
+"""
+Compaction of the history that was written before options.COMPACT_HISTORY,
+its months are compacted in the background on startup
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+from . import __name__ as mod_name
+from . import options
+from .storage import write_session
+
+
+logger = logging.getLogger(mod_name)
+
+# seconds before the compaction that failed is retried
+RETRY_INTERVAL = 60
+
+
+async def compact_month() -> Optional[str]:
+    """
+    Compacts the next month of the history that isn't compacted yet,
+    returns it, None if there is none left
+    """
+
+    async with write_session() as db:
+        month = await db.compact_history()
+        await db.commit()
+
+    if month is not None:
+        logger.info(f"Compacted the history of {month}")
+    return month
+
+
+class Compactor:
+    """
+    Compacts the months one by one, a transaction each, so the imports
+    wait for one month at most, stops when none are left, as with
+    options.COMPACT_HISTORY the new history is written compacted
+    """
+
+    def __init__(self) -> None:
+        self.stopping: Optional[asyncio.Event] = None
+        self.worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if not options.COMPACT_HISTORY:
+            return
+        self.stopping = asyncio.Event()
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        # not cancelled, so it doesn't leave the transaction unfinished
+        if self.worker is None:
+            return
+        self.stopping.set()  # type: ignore
+        await self.worker
+        self.worker = None
+
+    async def run(self) -> None:
+        assert self.stopping is not None
+
+        while not self.stopping.is_set():
+            try:
+                month = await compact_month()
+            except Exception as e:
+                logger.error(f"Compaction will be retried: {e!r}")
+                try:
+                    await asyncio.wait_for(self.stopping.wait(),
+                                           RETRY_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if month is None:
+                return
@@ -1,50 +1,349 @@
 import logging
-from asyncio import gather
 from datetime import datetime
-from math import ceil
-from typing import Any, Iterable, List, Optional, Union
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import (Any, Collection, Dict, Iterable, Iterator, List,
+                    Optional, Tuple)
 from uuid import UUID
 
+from sqlalchemy import (Integer, String, Table, and_, bindparam, case, cast,
+                        delete, func, insert, literal, type_coerce, union_all,
+                        update)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.engine import Result
-from sqlalchemy.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.exc import (MultipleResultsFound, NoResultFound,
+                            OperationalError)
 from sqlalchemy.future import select
-from sqlalchemy.sql import Select
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.sql import Delete, Insert, Select, Update
 
 from . import __name__ as mod_name
 from .exceptions import NotEnoughResultsFound
-from .models import ShopUnit, StatUnit
-from .schemas import ShopUnitType
-from .typedefs import DB, ShopUnits
+from .models import (AppliedImport, HistoryPartition, HistorySequence,
+                     ImportJob, LastEvent, ShopTree, ShopUnit, Tombstone,
+                     UnitType, history_marks, history_partition)
+from .schemas import Import, JobStatus, ShopUnitType
+from .storage import month_of
+from .typedefs import DB, Deltas, ShopUnits, ShopUnitStates
 
 
 logger = logging.getLogger(mod_name)
 
+# SQLite limits the number of parameters in one statement,
+# so the long lists of ids are split into the chunks of this size
+MAX_PARAMETERS = 900
+
 
 class Query:
+    @classmethod
+    def key(cls, id: Any) -> Any:
+        # the integer key of the unit, as the tree refers to it
+        return (select(ShopUnit._unique_id)
+                .filter(ShopUnit.id == id)
+                .scalar_subquery())
+
+    @classmethod
+    def alive(cls) -> Any:
+        # the unit is deleted if it or any of its ancestors is a tombstone
+        dead = (select(ShopTree.ancestor)
+                .join(Tombstone, Tombstone.key == ShopTree.ancestor)
+                .filter(ShopTree.descendant == ShopUnit._unique_id))
+        return ~dead.exists()
+
     @classmethod
     def get_children(cls, selection: Select) -> Select:
+        keys = selection.with_only_columns(ShopUnit._unique_id)
+        return (select(ShopUnit)
+                .join(ShopTree, ShopUnit._unique_id == ShopTree.descendant)
+                .filter(ShopTree.ancestor.in_(keys))  # type: ignore
+                .filter(cls.alive()))
+
+    @classmethod
+    def get_parents(cls, selection: Select) -> Select:
+        keys = selection.with_only_columns(ShopUnit._unique_id)
+        return (select(ShopUnit)
+                .join(ShopTree, ShopUnit._unique_id == ShopTree.ancestor)
+                .filter(ShopTree.descendant.in_(keys)))  # type: ignore
+
+    # the recursive versions don't need the tree,
+    # so they are used to (re)build it and for comparison
+
+    @classmethod
+    def get_children_recursive(cls, selection: Select) -> Select:
         cte = selection.cte(recursive=True)
         cte = cte.union_all(
             select(ShopUnit).filter(ShopUnit.parentId == cte.c.id))
         return select(ShopUnit).join(cte, ShopUnit.id == cte.c.id)
 
     @classmethod
-    def get_parents(cls, selection: Select) -> Select:
+    def get_parents_recursive(cls, selection: Select) -> Select:
         cte = selection.cte(recursive=True)
         cte = cte.union_all(
             select(ShopUnit).filter(ShopUnit.id == cte.c.parentId))
         return select(ShopUnit).join(cte, ShopUnit.id == cte.c.id)
 
+    @classmethod
+    def tree_closure(cls) -> Select:
+        # 'parentId' is a uuid, so the uuid of the descendant is carried too
+        cte = select(ShopUnit._unique_id.label("ancestor"),
+                     ShopUnit._unique_id.label("descendant"),
+                     ShopUnit.id.label("descendant_id"),
+                     literal(0).label("depth")).cte(recursive=True)
+        cte = cte.union_all(
+            select(cte.c.ancestor, ShopUnit._unique_id, ShopUnit.id,
+                   cte.c.depth + 1)
+            .filter(ShopUnit.parentId == cte.c.descendant_id))
+        return select(cte.c.ancestor, cte.c.descendant, cte.c.depth)
+
+    @classmethod
+    def subtree_keys(cls, key: Any) -> Select:
+        return select(ShopTree.descendant).filter(ShopTree.ancestor == key)
+
+    @classmethod
+    def detach_subtree(cls, id: UUID) -> Delete:
+        subtree = cls.subtree_keys(cls.key(id))
+        return (delete(ShopTree)
+                .filter(ShopTree.descendant.in_(subtree))  # type: ignore
+                .filter(ShopTree.ancestor.not_in(subtree))  # type: ignore
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def attach_subtree(cls, id: UUID, parent_id: UUID) -> Insert:
+        upper, lower = aliased(ShopTree), aliased(ShopTree)
+        # every ancestor of the parent with every unit of the subtree
+        pairs = (select(upper.ancestor, lower.descendant,
+                        upper.depth + lower.depth + 1)
+                 .join(lower, lower.ancestor == cls.key(id))
+                 .filter(upper.descendant == cls.key(parent_id)))
+        return insert(ShopTree).from_select(
+            ["ancestor", "descendant", "depth"], pairs)
+
+    @classmethod
+    def add_tree_root(cls) -> Insert:
+        # the unit itself with depth 0
+        key = cls.key(bindparam("unit_id"))
+        return insert(ShopTree).from_select(
+            ["ancestor", "descendant", "depth"],
+            select(key, key, literal(0)))
+
+    @classmethod
+    def attach_leaf(cls) -> Insert:
+        # every ancestor of the parent with the unit itself
+        pairs = (select(ShopTree.ancestor, cls.key(bindparam("unit_id")),
+                        ShopTree.depth + 1)
+                 .filter(ShopTree.descendant
+                         == cls.key(bindparam("parent_id"))))
+        return insert(ShopTree).from_select(
+            ["ancestor", "descendant", "depth"], pairs)
+
+    @classmethod
+    def delete_subtree(cls, key: int) -> Delete:
+        return (delete(ShopTree)
+                .filter(ShopTree.descendant.in_(  # type: ignore
+                    cls.subtree_keys(key)))
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def dead_units(cls, ids: List[UUID]) -> Select:
+        return (select(ShopUnit.id, Tombstone.key)
+                .join(ShopTree, ShopTree.descendant == ShopUnit._unique_id)
+                .join(Tombstone, Tombstone.key == ShopTree.ancestor)
+                .filter(ShopUnit.id.in_(ids)))  # type: ignore
+
+    @classmethod
+    def bury_subtrees(cls, ids: List[UUID]) -> Insert:
+        return insert(Tombstone).from_select(
+            ["key"], select(ShopUnit._unique_id)
+            .filter(ShopUnit.id.in_(ids)))  # type: ignore
+
+    @classmethod
+    def purge_batch(cls, key: int, size: int) -> Select:
+        # the root goes last, the rest is found through it
+        return (select(ShopTree.descendant)
+                .filter(ShopTree.ancestor == key, ShopTree.descendant != key)
+                .limit(size))
+
+    @classmethod
+    def delete_units(cls, keys: Any) -> Delete:
+        return (delete(ShopUnit)
+                .filter(ShopUnit._unique_id.in_(keys))  # type: ignore
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def history_runs(cls, month: str, keys: Any) -> Select:
+        # the history is kept by uuid, as it outlives the keys
+        table = history_partition(month)
+        ids = select(ShopUnit.id).filter(
+            ShopUnit._unique_id.in_(keys))  # type: ignore
+        return select(table.c._unique_id).filter(table.c.id.in_(ids))
+
+    @classmethod
+    def delete_history(cls, month: str, keys: Any) -> Delete:
+        table = history_partition(month)
+        return (delete(table)
+                .filter(table.c._unique_id.in_(cls.history_runs(month, keys)))
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def delete_marks(cls, month: str, keys: Any) -> Delete:
+        marks = history_marks(month)
+        return (delete(marks)
+                .filter(marks.c.run.in_(cls.history_runs(month, keys)))
+                .execution_options(synchronize_session=False))
+
     @classmethod
     def shop_units(cls, ids: Optional[List[UUID]]) -> Select:
-        selection = select(ShopUnit)
+        selection = select(ShopUnit).filter(cls.alive())
         if ids is None:
             return selection
         return selection.filter(ShopUnit.id.in_(ids))  # type: ignore
 
+    @classmethod
+    def shop_unit_states(cls, ids: List[UUID]) -> Select:
+        return (select(ShopUnit.id, ShopUnit.parentId, ShopUnit.type,
+                       ShopUnit.price, ShopUnit.sub_offers_count,
+                       ShopUnit.name)
+                .filter(ShopUnit.id.in_(ids)))  # type: ignore
+
+    @classmethod
+    def parent_states(cls, ids: List[UUID]) -> Select:
+        return (select(ShopUnit.id, ShopUnit.parentId, ShopUnit.type,
+                       ShopUnit.price, ShopUnit.sub_offers_count)
+                .join(ShopTree, ShopUnit._unique_id == ShopTree.ancestor)
+                .filter(ShopTree.descendant.in_(  # type: ignore
+                    select(ShopUnit._unique_id)
+                    .filter(ShopUnit.id.in_(ids)))))  # type: ignore
+
+    @classmethod
+    def type_changes(cls, imports: List[Import]) -> Select:
+        offers = [i.id for i in imports if i.type == ShopUnitType.OFFER]
+        categories = [i.id for i in imports if i.type != ShopUnitType.OFFER]
+        return (select(ShopUnit.id)
+                .filter(ShopUnit.id.in_(offers)  # type: ignore
+                        & (ShopUnit.type != ShopUnitType.OFFER)
+                        | ShopUnit.id.in_(categories)  # type: ignore
+                        & (ShopUnit.type != ShopUnitType.CATEGORY))
+                .limit(1))
+
+    @classmethod
+    def upsert_shop_units(cls) -> Insert:
+        # categories keep their date and aggregates, offers take everything
+        stmt = sqlite_insert(ShopUnit)
+        new = stmt.excluded
+        is_offer = ShopUnit.type == ShopUnitType.OFFER
+        return stmt.on_conflict_do_update(index_elements=[ShopUnit.id], set_={
+            "name": new.name,
+            "parentId": new.parentId,
+            "price": case((is_offer, new.price), else_=ShopUnit.price),
+            "date": case((is_offer, new.date), else_=ShopUnit.date),
+        })
+
+    @classmethod
+    def update_aggregates(cls, with_date: bool) -> Update:
+        # relative, so concurrent changes of the same parent add up
+        table = ShopUnit.__table__
+        values = {
+            "price": table.c.price + bindparam("diff_price"),
+            "sub_offers_count": (table.c.sub_offers_count
+                                 + bindparam("diff_sub_offers_count")),
+        }
+        if with_date:
+            values["date"] = bindparam("new_date", type_=ShopUnit.date.type)
+        return (update(table)
+                .where(table.c.id == bindparam("parent_id"))
+                .values(values))
+
+    @classmethod
+    def unit_dates(cls, ids: List[UUID]) -> Select:
+        return (select(ShopUnit.id, ShopUnit.date)
+                .filter(ShopUnit.id.in_(ids)))  # type: ignore
+
+    @classmethod
+    def history_states(cls, ids: List[UUID]) -> Select:
+        # the same as price of ShopUnit schema - ceil(price / count)
+        count = ShopUnit.sub_offers_count
+        price = case((count != 0, (ShopUnit.price + count - 1) / count),
+                     else_=ShopUnit.price)
+        return (select(ShopUnit.id, ShopUnit.parentId, ShopUnit.name,
+                       ShopUnit.date, ShopUnit.type, price.label("price"))
+                .filter(ShopUnit.id.in_(ids))  # type: ignore
+                .order_by(ShopUnit._unique_id))
+
+    @classmethod
+    def history(cls, month: str, ids: List[UUID], last: int) -> Insert:
+        # the keys go on from the 'last' one of all the partitions
+        key = literal(last) + func.row_number().over(
+            order_by=ShopUnit._unique_id)
+        return insert(history_partition(month)).from_select(
+            ["id", "parentId", "name", "date", "type", "price", "_unique_id"],
+            cls.history_states(ids).add_columns(key))
+
+    @classmethod
+    def latest_runs(cls, month: str, ids: List[UUID]) -> Select:
+        table = history_partition(month)
+        latest = (select(func.max(table.c._unique_id))
+                  .filter(table.c.id.in_(ids))
+                  .group_by(table.c.id))
+        return select(table).filter(table.c._unique_id.in_(latest))
+
+    # the compaction of the month, the runs that repeat the previous ones
+    # become their marks, with the marks they had
+
+    @classmethod
+    def merge_runs(cls, month: str) -> Insert:
+        table, marks = history_partition(month), history_marks(month)
+        window = {"partition_by": table.c.id, "order_by": table.c._unique_id}
+        repeats = and_(
+            func.lag(table.c._unique_id).over(**window).isnot(None),
+            *(func.lag(column).over(**window).is_(column) for column in (
+                table.c.parentId, table.c.name, table.c.type, table.c.price)))
+        states = select(table.c._unique_id, table.c.id, table.c.date,
+                        repeats.label("repeats")).subquery()
+
+        # the last state before that doesn't repeat the previous one
+        run = func.max(case((~states.c.repeats, states.c._unique_id))).over(
+            partition_by=states.c.id, order_by=states.c._unique_id)
+        runs = select(states.c._unique_id, run.label("run"), states.c.date,
+                      states.c.repeats).subquery()
+        return insert(marks).from_select(
+            ["_unique_id", "run", "date"],
+            select(runs.c._unique_id, runs.c.run, runs.c.date)
+            .filter(runs.c.repeats))
+
+    @classmethod
+    def move_marks(cls, month: str) -> Update:
+        # the marks of the runs that became marks themselves
+        marks = history_marks(month)
+        merged = marks.alias("merged")
+        run = (select(merged.c.run)
+               .filter(merged.c._unique_id == marks.c.run)
+               .scalar_subquery())
+        return (update(marks)
+                .filter(marks.c.run.in_(select(merged.c._unique_id)))
+                .values(run=run))
+
+    @classmethod
+    def delete_merged_runs(cls, month: str) -> Delete:
+        table, marks = history_partition(month), history_marks(month)
+        return (delete(table)
+                .filter(table.c._unique_id.in_(select(marks.c._unique_id)))
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def history_months(cls, first: Any, last: Any) -> Select:
+        return (select(HistoryPartition.month)
+                .filter(HistoryPartition.month.between(first, last))
+                .order_by(HistoryPartition.month))
+
+    @classmethod
+    def set_history_sequence(cls, last: int) -> Insert:
+        stmt = sqlite_insert(HistorySequence).values(_unique_id=1, last=last)
+        return stmt.on_conflict_do_update(
+            index_elements=[HistorySequence._unique_id], set_={"last": last})
+
     @classmethod
     def shop_unit_id(cls, id: UUID) -> Select:
-        return select(ShopUnit.id).filter(ShopUnit.id == id)
+        return select(ShopUnit.id).filter(ShopUnit.id == id, cls.alive())
 
     @classmethod
     def shop_units_by_date(cls, start: datetime, end: datetime,
@@ -61,19 +360,156 @@ class Query:
                 .filter(ShopUnit.type == ShopUnitType.OFFER))
 
     @classmethod
-    def stat_units(cls, ids: Optional[List[UUID]]) -> Select:
-        selection = select(StatUnit)
-        if ids is None:
-            return selection
-        return selection.filter(StatUnit.id.in_(ids))  # type: ignore
+    def stat_units_by_date(cls, months: Collection[str], ids: List[UUID],
+                           start: datetime, end: datetime,
+                           with_end: bool) -> Select:
+        def in_range(date: Any) -> Any:
+            if with_end:
+                return (start <= date) & (date <= end)
+            return (start <= date) & (date < end)
+
+        # only the partitions of the 'months', one after another,
+        # the runs and their marks with the state of the run
+        selections = []
+        for month in months:
+            table, marks = history_partition(month), history_marks(month)
+            selections.append(select(table).filter(
+                table.c.id.in_(ids), in_range(table.c.date)))
+            selections.append(
+                select(marks.c._unique_id, table.c.id, table.c.parentId,
+                       table.c.name, marks.c.date, table.c.type,
+                       table.c.price)
+                .join(marks, marks.c.run == table.c._unique_id)
+                .filter(table.c.id.in_(ids), in_range(marks.c.date)))
+
+        # in the order of the changes, not of the index
+        history = union_all(*selections).subquery()
+        return select(history).order_by(history.c._unique_id)
+
+    # the statements of the reads are built once, with the values bound
+    # on execution, so the requests don't build them and their cache keys
 
     @classmethod
-    def stat_units_by_date(cls, ids: Optional[List[UUID]], start: datetime,
-                           end: datetime, with_end: bool) -> Select:
-        selection = cls.stat_units(ids).filter(start <= StatUnit.date)
-        if with_end:
-            return selection.filter(StatUnit.date <= end)
-        return selection.filter(StatUnit.date < end)
+    def plain(cls, selection: Select) -> Select:
+        # the columns of the model instead of the model, see 'fetch_plain'
+        model = selection.column_descriptions[0]["entity"]
+        return selection.with_only_columns(*model.__table__.columns)
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def bound_shop_unit(cls, recursive: bool) -> Select:
+        selection = cls.shop_units([bindparam("id", type_=ShopUnit.id.type)])
+        if recursive:
+            selection = cls.get_children(selection)
+        return cls.plain(selection)
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def bound_shop_unit_id(cls) -> Select:
+        return cls.shop_unit_id(bindparam("id", type_=ShopUnit.id.type))
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def bound_offers_by_date(cls, with_end: bool) -> Select:
+        start = bindparam("start", type_=ShopUnit.date.type)
+        end = bindparam("end", type_=ShopUnit.date.type)
+        return cls.plain(cls.offers_by_date(start, end, with_end))
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def bound_history_months(cls) -> Select:
+        return cls.history_months(bindparam("first"), bindparam("last"))
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def bound_stat_units_by_date(cls, months: Tuple[str, ...],
+                                 with_end: bool) -> Select:
+        id = bindparam("id", type_=ShopUnit.id.type)
+        start = bindparam("start", type_=ShopUnit.date.type)
+        end = bindparam("end", type_=ShopUnit.date.type)
+        return cls.stat_units_by_date(months, [id], start, end, with_end)
+
+    @classmethod
+    def job(cls, id: UUID) -> Select:
+        return select(ImportJob).filter(ImportJob.id == id)
+
+    @classmethod
+    def next_job(cls) -> Select:
+        # the running one was interrupted, e.g. by a restart
+        return (select(ImportJob)
+                .filter(ImportJob.status.in_(  # type: ignore
+                    [JobStatus.QUEUED, JobStatus.RUNNING]))
+                .order_by(ImportJob._unique_id)
+                .limit(1))
+
+    @classmethod
+    def set_job_status(cls, id: UUID, status: JobStatus,
+                       error: Optional[str]) -> Update:
+        return (update(ImportJob)
+                .where(ImportJob.id == id)
+                .values(status=status, error=error)
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def applied_import(cls, key: str) -> Select:
+        return select(AppliedImport).filter(AppliedImport.key == key)
+
+    @classmethod
+    def forget_imports(cls, keep: int) -> Delete:
+        last = select(func.max(AppliedImport._unique_id)).scalar_subquery()
+        return (delete(AppliedImport)
+                .filter(AppliedImport._unique_id <= last - keep)
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def set_last_event(cls, sequence: int) -> Insert:
+        stmt = sqlite_insert(LastEvent).values(_unique_id=1, sequence=sequence)
+        return stmt.on_conflict_do_update(
+            index_elements=[LastEvent._unique_id],
+            set_={"sequence": sequence})
+
+    # the stored values are converted as they are, past the column types
+
+    @classmethod
+    def compact_dates(cls, table: Table) -> Update:
+        date = type_coerce(table.c.date, String)
+        millis = (cast(func.strftime("%s", date), Integer) * 1000
+                  + cast(func.substr(date, 21, 3), Integer))
+        return (update(table)
+                .filter(func.typeof(date) == "text")
+                .values(date=millis)
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def expand_dates(cls, table: Table) -> Update:
+        date = type_coerce(table.c.date, Integer)
+        # the dates before the epoch are negative, % and / round to zero
+        millis = (date % 1000 + 1000) % 1000
+        seconds = func.strftime("%Y-%m-%d %H:%M:%S",
+                                (date - millis) / 1000, "unixepoch")
+        text = seconds.concat(func.printf(".%06d", millis * 1000))
+        return (update(table)
+                .filter(func.typeof(date) == "integer")
+                .values(date=text)
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def compact_types(cls, table: Table) -> Update:
+        tp = type_coerce(table.c.type, String)
+        codes = [(tp == t.name, code) for t, code in UnitType.CODES.items()]
+        return (update(table)
+                .filter(tp.in_([t.name for t in UnitType.CODES]))
+                .values(type=case(*codes))
+                .execution_options(synchronize_session=False))
+
+    @classmethod
+    def expand_types(cls, table: Table) -> Update:
+        tp = type_coerce(table.c.type, Integer)
+        names = [(tp == code, t.name) for t, code in UnitType.CODES.items()]
+        return (update(table)
+                .filter(tp.in_(UnitType.TYPES))
+                .values(type=case(*names))
+                .execution_options(synchronize_session=False))
 
 
 ### helpers ###
@@ -88,7 +524,7 @@ def assemble_shop_units(fetched: List[ShopUnit], *,
             # new
             unit.children = []
             units[unit.id] = unit
-        elif ex is unit:
+        elif ex is unit or ex._unique_id == unit._unique_id:
             # duplicate of existing, not a big deal
             pass
         else:
@@ -132,13 +568,47 @@ def several(units: ShopUnits, ids: Iterable[UUID]) -> ShopUnits:
     return units
 
 
+def chunks(ids: Iterable[Any], size: int = MAX_PARAMETERS
+           ) -> Iterator[List[Any]]:
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
 ### CRUD itself ###
 
-async def fetch_all(db: DB, selection: Select) -> List[Any]:
-    result: Result = await db.execute(selection)
+async def fetch_all(db: DB, selection: Select,
+                    params: Optional[Dict[str, Any]] = None) -> List[Any]:
+    result: Result = await db.execute(selection, params)
     return result.scalars().all()
 
 
+async def fetch_plain(db: DB, selection: Select,
+                      params: Optional[Dict[str, Any]] = None) -> List[Any]:
+    """
+    Fetches the rows of 'Query.plain(...)' as plain objects
+    with the same attributes as the model,
+    the session doesn't track them, so they are cheaper to load
+    """
+
+    result: Result = await db.execute(selection, params)
+    return [SimpleNamespace(**row._mapping) for row in result]
+
+
+async def fetch_states(db: DB, build: Any,
+                       ids: Iterable[UUID]) -> ShopUnitStates:
+    """
+    Fetches the plain rows (not ORM objects) selected by 'build(chunk)'
+    for every chunk of the 'ids', and maps them by their id
+    """
+
+    states: ShopUnitStates = {}
+    for chunk in chunks(ids):
+        result: Result = await db.execute(build(chunk))
+        states.update((row.id, row) for row in result.all())
+    return states
+
+
 async def fetch_shop_units(db: DB, selection: Select, *,
                            get_children: bool = False,
                            get_parents: bool = False) -> ShopUnits:
@@ -150,76 +620,449 @@ async def fetch_shop_units(db: DB, selection: Select, *,
     if get_parents:
         selection = Query.get_parents(selection)
     return assemble_shop_units(
-        await fetch_all(db, selection), add_children=get_children)
+        await fetch_plain(db, Query.plain(selection)),
+        add_children=get_children)
 
 
 async def shop_unit_exists(db: DB, id: UUID) -> bool:
-    selection = Query.shop_unit_id(id)
-    return len(await fetch_all(db, selection)) > 0
+    selection = Query.bound_shop_unit_id()
+    return len(await fetch_all(db, selection, {"id": id})) > 0
 
 
 async def shop_unit(db: DB, id: UUID, *,
                     recursive: bool = True) -> Optional[ShopUnits]:
-    selection = Query.shop_units([id])
-    units = await fetch_shop_units(db, selection, get_children=recursive)
+    selection = Query.bound_shop_unit(recursive)
+    units = assemble_shop_units(
+        await fetch_plain(db, selection, {"id": id}), add_children=recursive)
     return one_or_none(units, id)
 
 
 async def shop_units(db: DB, ids: Iterable[UUID], *,
                      recursive: bool = False) -> ShopUnits:
-    selection = Query.shop_units(list(ids))
-    return await fetch_shop_units(db, selection, get_children=recursive)
+    if recursive:
+        selection = Query.shop_units(list(ids))
+        return await fetch_shop_units(db, selection, get_children=True)
+
+    units: ShopUnits = {}
+    for chunk in chunks(ids):
+        units.update(await fetch_shop_units(db, Query.shop_units(chunk)))
+    return units
 
 
 async def offers_by_date(db: DB, start: datetime, end: datetime, *,
                          with_end: bool = True,
                          recursive: bool = False) -> ShopUnits:
-    selection = Query.offers_by_date(start, end, with_end)
-    return await fetch_shop_units(db, selection, get_children=recursive)
+    if recursive:
+        selection = Query.offers_by_date(start, end, with_end)
+        return await fetch_shop_units(db, selection, get_children=True)
 
+    selection = Query.bound_offers_by_date(with_end)
+    fetched = await fetch_plain(db, selection, {"start": start, "end": end})
+    return assemble_shop_units(fetched, add_children=False)
 
-async def shop_unit_parents(db: DB, parent_id: UUID) -> ShopUnits:
-    selection = Query.shop_units([parent_id])
-    units = await fetch_shop_units(db, selection, get_parents=True)
-    return one(units, parent_id)
 
+async def shop_unit_states(db: DB, ids: Iterable[UUID]) -> ShopUnitStates:
+    return await fetch_states(db, Query.shop_unit_states, ids)
 
-async def shop_units_parents(db: DB, parent_ids: Iterable[UUID]) -> ShopUnits:
-    selection = Query.shop_units(list(parent_ids))
-    units = await fetch_shop_units(db, selection, get_parents=True)
-    return units
+
+async def shop_units_parents(db: DB,
+                             parent_ids: Iterable[UUID]) -> ShopUnitStates:
+    return await fetch_states(db, Query.parent_states, parent_ids)
 
 
-async def stat_units(db: DB, id: UUID) -> List[StatUnit]:
-    selection = Query.stat_units([id])
-    return await fetch_all(db, selection)
+async def type_changed(db: DB, imports: Iterable[Import]) -> bool:
+    for chunk in chunks(imports):
+        if len(await fetch_all(db, Query.type_changes(chunk))) > 0:
+            return True
+    return False
+
+
+async def history_months(db: DB, start: datetime = datetime.min,
+                         end: datetime = datetime.max) -> List[str]:
+    # the months of the partitions that overlap the range of dates
+    return await fetch_all(db, Query.bound_history_months(),
+                           {"first": month_of(start), "last": month_of(end)})
 
 
 async def stat_units_by_date(db: DB, id: UUID, start: datetime, end: datetime,
-                             *, with_end: bool = False) -> List[StatUnit]:
-    selection = Query.stat_units_by_date([id], start, end, with_end)
-    return await fetch_all(db, selection)
+                             *, with_end: bool = False) -> List[Any]:
+    params = {"id": id, "start": start, "end": end}
+    months = await history_months(db, start, end)
+    while months:
+        selection = Query.bound_stat_units_by_date(tuple(months), with_end)
+        try:
+            return await fetch_plain(db, selection, params)
+        except OperationalError:
+            # the partition could be dropped after its month was read
+            listed, months = months, await history_months(db, start, end)
+            if months == listed:
+                raise
+    return []
+
+
+async def upsert_shop_units(db: DB, date: datetime,
+                            imports: Iterable[Import]) -> None:
+    """
+    Inserts the new units and updates the existing ones in a single
+    executemany, without loading them
+    """
+
+    rows = [{**imp.dict(), "date": date, "sub_offers_count": 0}
+            for imp in imports]
+    if rows:
+        await db.execute(Query.upsert_shop_units(), rows)
+
+
+async def update_aggregates(db: DB, totals: Deltas, *,
+                            date: Optional[datetime] = None,
+                            parents: Iterable[UUID] = ()) -> None:
+    """
+    Adds the 'totals' to the aggregates of the units in the database,
+    with one UPDATE per parent, if 'date' is given,
+    it's also set to all the 'parents', even if they have no change
+    """
+
+    ids = set(totals.keys())
+    if date is not None:
+        ids |= set(parents)
+
+    rows = []
+    for id in ids:
+        diff, count = totals.get(id, (0, 0))
+        row = {"parent_id": id,
+               "diff_price": diff, "diff_sub_offers_count": count}
+        if date is not None:
+            row["new_date"] = date
+        rows.append(row)
+
+    if rows:
+        await db.execute(Query.update_aggregates(date is not None), rows)
+
+
+def create_table(session: Session, table: Table) -> None:
+    table.create(session.connection())
+
+
+def drop_table(session: Session, table: Table) -> None:
+    table.drop(session.connection())
+
+
+async def create_partitions(db: DB, months: Iterable[str]) -> None:
+    """
+    Creates the partitions of the history of the 'months'
+    that don't have them yet
+    """
+
+    months = set(months)
+    stored = await fetch_all(db, select(HistoryPartition.month).filter(
+        HistoryPartition.month.in_(months)))  # type: ignore
+    for month in sorted(months - set(stored)):
+        await db.run_sync(create_table, history_partition(month))
+        await db.run_sync(create_table, history_marks(month))
+        await db.execute(insert(HistoryPartition).values(month=month))
+
+
+async def copy_history(db: DB, ids: List[UUID], last: int) -> int:
+    """
+    Writes every state as a run of its own, copying the rows
+    inside of the database, returns the last key
+    """
+
+    result: Result = await db.execute(Query.unit_dates(ids))
+    months: Dict[str, List[UUID]] = {}
+    for id, date in result.all():
+        months.setdefault(month_of(date), []).append(id)
+
+    await create_partitions(db, months.keys())
+    for month, month_ids in months.items():
+        await db.execute(Query.history(month, month_ids, last))
+        last += len(month_ids)
+
+    # the runs may repeat the previous ones now
+    written = HistoryPartition.month.in_(list(months))  # type: ignore
+    await db.execute(update(HistoryPartition)
+                     .where(written)
+                     .values(compacted=False)
+                     .execution_options(synchronize_session=False))
+    return last
+
+
+def repeats(run: Any, state: Any) -> bool:
+    return ((run.parentId, run.name, run.type, run.price)
+            == (state.parentId, state.name, state.type, state.price))
+
+
+async def append_history(db: DB, ids: List[UUID], last: int) -> int:
+    """
+    Writes the states that repeat the latest runs of their units
+    as the marks of the runs, the rest as the new runs, returns the last key
+    """
+
+    months: Dict[str, List[Any]] = {}
+    for state in await fetch_plain(db, Query.history_states(ids)):
+        months.setdefault(month_of(state.date), []).append(state)
+
+    await create_partitions(db, months.keys())
+    for month, states in months.items():
+        runs = {run.id: run for run in await fetch_plain(
+            db, Query.latest_runs(month, [state.id for state in states]))}
+
+        new_runs, marks = [], []
+        for state in states:
+            last += 1
+            run = runs.get(state.id, None)
+            if run is not None and repeats(run, state):
+                marks.append({"_unique_id": last, "run": run._unique_id,
+                              "date": state.date})
+            else:
+                new_runs.append({**vars(state), "_unique_id": last})
+
+        if new_runs:
+            await db.execute(insert(history_partition(month)), new_runs)
+        if marks:
+            await db.execute(insert(history_marks(month)), marks)
+    return last
+
+
+async def create_stat_units(db: DB, ids: Iterable[UUID], *,
+                            compact: bool = False) -> None:
+    """
+    Writes the current state of the units as their history,
+    to the partitions of the months of their dates,
+    if 'compact', the states that repeat the previous ones are only marked
+    """
+
+    sequence = await fetch_all(db, select(HistorySequence.last))
+    last = sequence[0] if sequence else 0
+
+    for chunk in chunks(ids):
+        if compact:
+            last = await append_history(db, chunk, last)
+        else:
+            last = await copy_history(db, chunk, last)
+
+    await db.execute(Query.set_history_sequence(last))
+
+
+async def compact_history(db: DB) -> Optional[str]:
+    """
+    Compacts the next month of the history that isn't compacted yet,
+    the runs that repeat the previous ones of their units become their marks,
+    returns the month, None if all of them are compacted
+    """
+
+    months = await fetch_all(db, select(HistoryPartition.month)
+                             .filter(HistoryPartition.compacted.is_(False))
+                             .order_by(HistoryPartition.month)
+                             .limit(1))
+    if not months:
+        return None
+    month = months[0]
+
+    await db.execute(Query.merge_runs(month))
+    await db.execute(Query.move_marks(month))
+    await db.execute(Query.delete_merged_runs(month))
+    await db.execute(update(HistoryPartition)
+                     .where(HistoryPartition.month == month)
+                     .values(compacted=True)
+                     .execution_options(synchronize_session=False))
+    return month
+
+
+async def drop_history(db: DB, before: str) -> List[str]:
+    """
+    Drops the partitions of the history of the months before the 'before',
+    the tables as a whole, without deleting their rows one by one
+    """
+
+    months = await fetch_all(db, select(HistoryPartition.month).filter(
+        HistoryPartition.month < before))
+    for month in months:
+        await db.run_sync(drop_table, history_partition(month))
+        await db.run_sync(drop_table, history_marks(month))
+    await db.execute(delete(HistoryPartition)
+                     .filter(HistoryPartition.month < before)
+                     .execution_options(synchronize_session=False))
+    return months
+
+
+async def convert_layout(db: DB, compact: bool) -> None:
+    """
+    Converts the dates and the types of the stored units and their history
+    to the compact layout (integers) or back to text,
+    the rows that are already converted are left as they are
+    """
+
+    months = await history_months(db)
+    tables = [ShopUnit.__table__] + [  # type: ignore
+        history_partition(month) for month in months]
+    for table in tables:
+        if compact:
+            await db.execute(Query.compact_dates(table))
+            await db.execute(Query.compact_types(table))
+        else:
+            await db.execute(Query.expand_dates(table))
+            await db.execute(Query.expand_types(table))
+
+    # the marks have only the dates
+    for marks in map(history_marks, months):
+        if compact:
+            await db.execute(Query.compact_dates(marks))
+        else:
+            await db.execute(Query.expand_dates(marks))
+
+
+async def tree_is_stale(db: DB) -> bool:
+    """
+    The tree is stale if there are units, but it's empty,
+    e.g. the database was created before the tree was introduced
+    """
+
+    has_units = await fetch_all(db, select(ShopUnit.id).limit(1))
+    has_tree = await fetch_all(db, select(ShopTree.ancestor).limit(1))
+    return len(has_units) > 0 and len(has_tree) == 0
+
+
+async def rebuild_tree(db: DB) -> None:
+    await db.execute(delete(ShopTree).execution_options(
+        synchronize_session=False))
+    await db.execute(insert(ShopTree).from_select(
+        ["ancestor", "descendant", "depth"], Query.tree_closure()))
+
+
+async def add_tree_nodes(db: DB,
+                         links: List[Tuple[UUID, Optional[UUID]]]) -> None:
+    """
+    Adds the new units as leaves of their parents, parents have to
+    either be in the tree already or go before their children in 'links'
+    """
+
+    rows = [{"unit_id": id} for id, _ in links]
+    if rows:
+        await db.execute(Query.add_tree_root(), rows)
+
+    params = [{"unit_id": id, "parent_id": parent_id}
+              for id, parent_id in links if parent_id is not None]
+    if params:
+        await db.execute(Query.attach_leaf(), params)
+
+
+async def move_tree_node(db: DB, id: UUID,
+                         parent_id: Optional[UUID]) -> None:
+    """
+    Moves the unit with all its descendants under the 'parent_id',
+    the unit has to be in the tree, so use 'add_tree_nodes' for new ones
+    """
+
+    await db.execute(Query.detach_subtree(id))
+    if parent_id is not None:
+        await db.execute(Query.attach_subtree(id, parent_id))
+
+
+async def delete_subtree(db: DB, key: int) -> None:
+    """
+    Deletes the unit with all its descendants and all of their history,
+    the subtree is found by the tree, so it goes last
+    """
+
+    subtree = Query.subtree_keys(key)
+    for month in await history_months(db):
+        await db.execute(Query.delete_marks(month, subtree))
+        await db.execute(Query.delete_history(month, subtree))
+    await db.execute(Query.delete_units(subtree))
+    await db.execute(Query.delete_subtree(key))
+
+
+async def dead_units(db: DB, ids: Iterable[UUID]) -> Dict[UUID, int]:
+    """
+    Finds which of the units are deleted, but not purged yet,
+    maps them to the keys of the roots of their deleted subtrees
+    """
+
+    dead: Dict[UUID, int] = {}
+    for chunk in chunks(ids):
+        result: Result = await db.execute(Query.dead_units(chunk))
+        dead.update(result.all())  # type: ignore
+    return dead
+
+
+async def bury_subtrees(db: DB, ids: Iterable[UUID]) -> None:
+    for chunk in chunks(ids):
+        await db.execute(Query.bury_subtrees(chunk))
+
+
+async def purge_subtree(db: DB, key: int) -> None:
+    # all at once, for the rare occasion when it can't wait
+    await delete_subtree(db, key)
+    await db.execute(delete(Tombstone).filter(Tombstone.key == key))
+
+
+async def purge_batch(db: DB, size: int) -> bool:
+    """
+    Purges up to 'size' units of some deleted subtree with their history,
+    returns False if there was nothing to purge
+    """
+
+    tombstones = await fetch_all(db, select(Tombstone.key).limit(1))
+    if not tombstones:
+        return False
+    key = tombstones[0]
+
+    keys = await fetch_all(db, Query.purge_batch(key, size))
+    if not keys:
+        await purge_subtree(db, key)
+        return True
+
+    for month in await history_months(db):
+        await db.execute(Query.delete_marks(month, keys))
+        await db.execute(Query.delete_history(month, keys))
+    await db.execute(Query.delete_units(keys))
+    await db.execute(delete(ShopTree)
+                     .filter(ShopTree.descendant.in_(keys))  # type: ignore
+                     .execution_options(synchronize_session=False))
+    return True
+
+
+async def create_job(db: DB, id: UUID, request: str) -> None:
+    await db.execute(insert(ImportJob).values(
+        id=id, status=JobStatus.QUEUED, request=request))
+
+
+async def job(db: DB, id: UUID) -> Optional[ImportJob]:
+    jobs = await fetch_all(db, Query.job(id))
+    return jobs[0] if jobs else None
+
+
+async def next_job(db: DB) -> Optional[ImportJob]:
+    jobs = await fetch_all(db, Query.next_job())
+    return jobs[0] if jobs else None
+
+
+async def set_job_status(db: DB, id: UUID, status: JobStatus, *,
+                         error: Optional[str] = None) -> None:
+    await db.execute(Query.set_job_status(id, status, error))
+
+
+async def applied_import(db: DB, key: str) -> Optional[AppliedImport]:
+    imports = await fetch_all(db, Query.applied_import(key))
+    return imports[0] if imports else None
+
 
+async def remember_import(db: DB, key: str, applied: int, skipped: int,
+                          keep: int) -> None:
+    """
+    Remembers the import by its key, forgetting all but the 'keep' latest
+    """
 
-def create_shop_unit(db: DB, /, *args: Any, **kwargs: Any) -> ShopUnit:
-    unit = ShopUnit(*args, **kwargs)
-    unit.children = []
-    db.add(unit)
-    return unit
+    await db.execute(insert(AppliedImport).values(
+        key=key, applied=applied, skipped=skipped))
+    await db.execute(Query.forget_imports(keep))
 
 
-def create_stat_unit(db: DB, shop_unit: ShopUnit) -> StatUnit:
-    attrs = {name: getattr(shop_unit, name)
-             for name in StatUnit._fields(exclude={"_unique_id"})}
-    if shop_unit.sub_offers_count != 0:
-        attrs["price"] = ceil(shop_unit.price / shop_unit.sub_offers_count)
-    unit = StatUnit(**attrs)
-    db.add(unit)
-    return unit
+async def last_event(db: DB) -> int:
+    sequences = await fetch_all(db, select(LastEvent.sequence))
+    return sequences[0] if sequences else 0
 
 
-async def delete_units(db: DB,
-                       units: Iterable[Union[ShopUnit, ShopUnit]]) -> None:
-    tasks = [db.delete(unit) for unit in units]
-    await gather(*tasks)
-    await db.flush()
+async def set_last_event(db: DB, sequence: int) -> None:
+    await db.execute(Query.set_last_event(sequence))
@@ -1,26 +1,107 @@
+from contextlib import asynccontextmanager
+from datetime import datetime
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import (Any, AsyncContextManager, AsyncGenerator, Dict, Iterable,
+                    List, Optional, Tuple)
+from uuid import UUID
 
-from fastapi import Depends
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from . import options
-from .models import Base
-from .typedefs import DB
+from . import crud, migrations, options
+from .models import PARTITION_PREFIX, AppliedImport, Base, ImportJob
+from .schemas import Import, JobStatus
+from .storage import Storage, Transaction
+from .typedefs import DB, Deltas, ShopUnits, ShopUnitStates
 
 
 DATABASE_URL = f"sqlite+aiosqlite:///{Path(__file__).parent}/sqlite.db"
 
-engine = create_async_engine(DATABASE_URL, future=True,
-                             connect_args={"check_same_thread": False})
+# seconds that a writer waits for the other writers to finish
+BUSY_TIMEOUT = 30
 
-SessionLocal = sessionmaker(bind=engine, class_=DB, expire_on_commit=False)
+# number of the connections that serve the reads
+READ_CONNECTIONS = 4
 
+# pragmas of every connection with options.WAL_MODE,
+# with WAL the commit is durable after a checkpoint, not a sync per commit
+WAL_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "cache_size": -64 * 1024,  # KiB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
 
-async def get_db() -> AsyncGenerator[DB, None]:
-    async with SessionLocal() as session:
+
+def create_engine(connections: int, *, read_only: bool) -> AsyncEngine:
+    """
+    Engine with a fixed number of the connections, the callers wait
+    for a free one instead of SQLite locks, if there are none
+    """
+
+    engine = create_async_engine(
+        DATABASE_URL, future=True,
+        poolclass=AsyncAdaptedQueuePool, pool_size=connections,
+        max_overflow=0, pool_timeout=BUSY_TIMEOUT,
+        # nothing to roll back on the connections that can't write
+        pool_reset_on_return=None if read_only else "rollback",
+        connect_args={"check_same_thread": False, "timeout": BUSY_TIMEOUT})
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+        pragmas = {"busy_timeout": BUSY_TIMEOUT * 1000}
+        if options.WAL_MODE:
+            pragmas.update(WAL_PRAGMAS)
+        if not read_only:
+            # WAL is kept by the database file, so it's set by the writer
+            pragmas["journal_mode"] = "WAL" if options.WAL_MODE else "DELETE"
+        else:
+            pragmas["query_only"] = "ON"
+
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    return engine
+
+
+# the only connection that writes, so the writers wait for it in turn,
+# while the readers have their own connections
+engine = create_engine(1, read_only=False)
+read_engine = create_engine(READ_CONNECTIONS, read_only=True)
+
+ReadSessionLocal = sessionmaker(bind=read_engine, class_=DB,
+                                autoflush=False, expire_on_commit=False)
+WriteSessionLocal = sessionmaker(bind=engine, class_=DB,
+                                 expire_on_commit=False)
+
+
+@asynccontextmanager
+async def read_session() -> AsyncGenerator[DB, None]:
+    """
+    Session of the routes that never write, so it has nothing to flush
+    and no transaction to commit, every query sees the last commit
+    """
+
+    async with ReadSessionLocal() as session:
+        yield session
+
+
+@asynccontextmanager
+async def write_session() -> AsyncGenerator[DB, None]:
+    """
+    Session which transaction takes the write lock right away,
+    so the concurrent writers are serialized as a whole by SQLite,
+    and what they read can't be changed before they write
+    """
+
+    async with WriteSessionLocal() as session:
         async with session.begin():
+            await session.execute(text("BEGIN IMMEDIATE"))
             try:
                 yield session
             except Exception:
@@ -28,19 +109,181 @@ async def get_db() -> AsyncGenerator[DB, None]:
                 raise
 
 
-db_injection = Depends(get_db)
+def drop_all(conn: Connection) -> None:
+    # the partitions of the history aren't in the metadata
+    for name in inspect(conn).get_table_names():
+        if name.startswith(PARTITION_PREFIX):
+            conn.exec_driver_sql(f'DROP TABLE "{name}"')
+    Base.metadata.drop_all(conn)
 
 
 async def db_startup() -> None:
     async with engine.begin() as conn:
         if options.DEV_MODE:
-            await conn.run_sync(Base.metadata.drop_all)  # type: ignore
-        await conn.run_sync(Base.metadata.create_all)  # type: ignore
+            await conn.run_sync(drop_all)
+        await conn.run_sync(migrations.upgrade)
+
+    async with write_session() as db:
+        await crud.convert_layout(db, options.COMPACT_STORAGE)
+        if await crud.tree_is_stale(db):
+            await crud.rebuild_tree(db)
+        await db.commit()
+
+    # the first connection of a pool holds a thread lock while it awaits,
+    # so it's opened before anything can ask the pool concurrently
+    async with read_engine.connect():
+        pass
 
 
 async def db_shutdown() -> None:
     if options.DEV_MODE:
         async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.drop_all)  # type: ignore
+            await conn.run_sync(drop_all)
 
+    await read_engine.dispose()
     await engine.dispose()
+
+
+class SqliteTransaction(Transaction):
+    """
+    Session of the database, the operations are the ones of 'crud'
+    """
+
+    def __init__(self, db: DB):
+        super().__init__()
+        self.db = db
+
+    async def commit_changes(self) -> None:
+        await self.db.commit()
+
+    def savepoint(self) -> AsyncContextManager[Any]:
+        return self.db.begin_nested()
+
+    async def last_event(self) -> int:
+        return await crud.last_event(self.db)
+
+    async def set_last_event(self, sequence: int) -> None:
+        await crud.set_last_event(self.db, sequence)
+
+    async def shop_unit_exists(self, id: UUID) -> bool:
+        return await crud.shop_unit_exists(self.db, id)
+
+    async def shop_unit(self, id: UUID, *,
+                        recursive: bool = True) -> Optional[ShopUnits]:
+        return await crud.shop_unit(self.db, id, recursive=recursive)
+
+    async def shop_units(self, ids: Iterable[UUID]) -> ShopUnits:
+        return await crud.shop_units(self.db, ids)
+
+    async def offers_by_date(self, start: datetime, end: datetime, *,
+                             with_end: bool = True) -> ShopUnits:
+        return await crud.offers_by_date(self.db, start, end,
+                                         with_end=with_end)
+
+    async def shop_unit_states(self, ids: Iterable[UUID]) -> ShopUnitStates:
+        return await crud.shop_unit_states(self.db, ids)
+
+    async def shop_units_parents(self,
+                                 ids: Iterable[UUID]) -> ShopUnitStates:
+        return await crud.shop_units_parents(self.db, ids)
+
+    async def type_changed(self, imports: Iterable[Import]) -> bool:
+        return await crud.type_changed(self.db, imports)
+
+    async def stat_units_by_date(self, id: UUID, start: datetime,
+                                 end: datetime, *,
+                                 with_end: bool = False) -> List[Any]:
+        return await crud.stat_units_by_date(self.db, id, start, end,
+                                             with_end=with_end)
+
+    async def upsert_shop_units(self, date: datetime,
+                                imports: Iterable[Import]) -> None:
+        await crud.upsert_shop_units(self.db, date, imports)
+
+    async def update_aggregates(self, totals: Deltas, *,
+                                date: Optional[datetime] = None,
+                                parents: Iterable[UUID] = ()) -> None:
+        await crud.update_aggregates(self.db, totals,
+                                     date=date, parents=parents)
+
+    async def create_stat_units(self, ids: Iterable[UUID]) -> None:
+        await crud.create_stat_units(self.db, ids,
+                                     compact=options.COMPACT_HISTORY)
+
+    async def compact_history(self) -> Optional[str]:
+        return await crud.compact_history(self.db)
+
+    async def drop_history(self, before: str) -> List[str]:
+        return await crud.drop_history(self.db, before)
+
+    async def add_tree_nodes(self,
+                             links: List[Tuple[UUID, Optional[UUID]]]
+                             ) -> None:
+        await crud.add_tree_nodes(self.db, links)
+
+    async def move_tree_node(self, id: UUID,
+                             parent_id: Optional[UUID]) -> None:
+        await crud.move_tree_node(self.db, id, parent_id)
+
+    async def dead_units(self, ids: Iterable[UUID]) -> Dict[UUID, int]:
+        return await crud.dead_units(self.db, ids)
+
+    async def bury_subtrees(self, ids: Iterable[UUID]) -> None:
+        await crud.bury_subtrees(self.db, ids)
+
+    async def purge_subtree(self, key: int) -> None:
+        await crud.purge_subtree(self.db, key)
+
+    async def purge_batch(self, size: int) -> bool:
+        return await crud.purge_batch(self.db, size)
+
+    async def create_job(self, id: UUID, request: str) -> None:
+        await crud.create_job(self.db, id, request)
+
+    async def job(self, id: UUID) -> Optional[ImportJob]:
+        return await crud.job(self.db, id)
+
+    async def next_job(self) -> Optional[ImportJob]:
+        return await crud.next_job(self.db)
+
+    async def set_job_status(self, id: UUID, status: JobStatus, *,
+                             error: Optional[str] = None) -> None:
+        await crud.set_job_status(self.db, id, status, error=error)
+
+    async def applied_import(self, key: str) -> Optional[AppliedImport]:
+        return await crud.applied_import(self.db, key)
+
+    async def remember_import(self, key: str, applied: int, skipped: int,
+                              keep: int) -> None:
+        await crud.remember_import(self.db, key, applied, skipped, keep)
+
+
+class SqliteStorage(Storage):
+    """
+    The database file next to the app, see the engines above
+    """
+
+    async def startup(self) -> None:
+        await db_startup()
+
+    async def shutdown(self) -> None:
+        await db_shutdown()
+
+    async def clear(self) -> None:
+        async with engine.begin() as conn:
+            await conn.run_sync(drop_all)
+            await conn.run_sync(Base.metadata.create_all)  # type: ignore
+
+    @asynccontextmanager
+    async def read_session(self) -> AsyncGenerator[Transaction, None]:
+        async with read_session() as db:
+            yield SqliteTransaction(db)
+
+    @asynccontextmanager
+    async def write_session(self) -> AsyncGenerator[Transaction, None]:
+        async with write_session() as db:
+            transaction = SqliteTransaction(db)
+            yield transaction
+            # the session would commit on exit, but without the events
+            if transaction.events:
+                await transaction.commit()
@@ -0,0 +1,194 @@
+"""
+Append-only log of the accepted imports and deletions
+"""
+
+import json
+import logging
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from . import __name__ as mod_name
+from . import options
+
+
+logger = logging.getLogger(mod_name)
+
+LOG_PATH = Path(__file__).parent / "events"
+
+# bytes after which the next segment is started
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# length of the payload, its checksum and the sequence number of the event
+HEADER = struct.Struct("<IIQ")
+
+Event = Dict[str, Any]
+# segment, its size and the next sequence number, before an append
+Mark = Tuple[Path, int, int]
+
+
+class CorruptedLog(Exception):
+    pass
+
+
+def segment_path(first: int) -> Path:
+    # named by the first sequence number, so they sort in order
+    return LOG_PATH / f"{first:020d}.log"
+
+
+def checksum(sequence: int, payload: bytes) -> int:
+    return zlib.crc32(payload, zlib.crc32(sequence.to_bytes(8, "little")))
+
+
+def encode(sequence: int, event: Event) -> bytes:
+    payload = zlib.compress(json.dumps(
+        event, separators=(",", ":"), default=str).encode("utf-8"), 1)
+    return HEADER.pack(len(payload), checksum(sequence, payload),
+                       sequence) + payload
+
+
+def read_records(file: BinaryIO) -> Iterator[Tuple[int, int, Event]]:
+    """
+    Yields the offset, the sequence number and the event of every record,
+    stops at the end or at the torn record, which is the end of the log
+    """
+
+    while True:
+        offset = file.tell()
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            file.seek(offset)
+            return
+        length, crc, sequence = HEADER.unpack(header)
+        payload = file.read(length)
+        if len(payload) < length or checksum(sequence, payload) != crc:
+            file.seek(offset)
+            return
+        yield offset, sequence, json.loads(zlib.decompress(payload))
+
+
+class EventLog:
+    """
+    Events in the segment files, one after another, every record is
+    its length, its checksum, its sequence number and the compressed json.
+    The record that was torn by a crash, the last one, is cut off on open
+    """
+
+    def __init__(self) -> None:
+        self.path: Optional[Path] = None
+        self.size = 0
+        self.next_sequence = 1
+
+    def segments(self) -> List[Path]:
+        return sorted(LOG_PATH.glob("*.log"))
+
+    def open(self) -> None:
+        LOG_PATH.mkdir(exist_ok=True)
+        segments = self.segments()
+        if not segments:
+            self.path, self.size = segment_path(1), 0
+            self.next_sequence = 1
+            return
+
+        # only the last segment is read, it has the end of the log
+        self.path = segments[-1]
+        self.next_sequence = int(self.path.stem)
+        with open(self.path, "rb") as file:
+            for _, sequence, _ in read_records(file):
+                self.next_sequence = sequence + 1
+            self.size = file.tell()
+
+        if self.size != self.path.stat().st_size:
+            logger.warning(f"Cutting off the torn end of the event log"
+                           f" {self.path} at {self.size}")
+            os.truncate(self.path, self.size)
+
+    def clear(self) -> None:
+        for segment in self.segments():
+            segment.unlink()
+        self.open()
+
+    @property
+    def last_sequence(self) -> int:
+        return self.next_sequence - 1
+
+    def skip_to(self, sequence: int) -> None:
+        self.next_sequence = max(self.next_sequence, sequence + 1)
+
+    def mark(self) -> Mark:
+        assert self.path is not None
+        return self.path, self.size, self.next_sequence
+
+    def append(self, events: List[Event]) -> int:
+        """
+        Writes the events and syncs them to the disk,
+        returns the sequence number of the last one
+        """
+
+        assert self.path is not None
+        if self.size >= SEGMENT_SIZE:
+            self.path, self.size = segment_path(self.next_sequence), 0
+
+        records = []
+        for event in events:
+            records.append(encode(self.next_sequence, event))
+            self.next_sequence += 1
+        data = b"".join(records)
+
+        with open(self.path, "ab") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        self.size += len(data)
+        return self.last_sequence
+
+    def truncate(self, mark: Mark) -> None:
+        """
+        Takes back the appends made after the 'mark'
+        """
+
+        path, size, next_sequence = mark
+        if self.path != path and self.path is not None:
+            self.path.unlink(missing_ok=True)
+        if path.exists():
+            os.truncate(path, size)
+        self.path, self.size, self.next_sequence = mark
+
+    def read_after(self, sequence: int) -> Iterator[Tuple[int, Event]]:
+        """
+        Yields the events after the 'sequence' with their sequence numbers,
+        the segments before the one that has it aren't read at all
+        """
+
+        segments = self.segments()
+        firsts = [int(segment.stem) for segment in segments]
+        start = max((i for i, first in enumerate(firsts)
+                     if first <= sequence + 1), default=0)
+
+        for segment in segments[start:]:
+            with open(segment, "rb") as file:
+                for _, number, event in read_records(file):
+                    if number > sequence:
+                        yield number, event
+                end = file.tell()
+            if segment != segments[-1] and end != segment.stat().st_size:
+                raise CorruptedLog(f"Event log is corrupted in {segment}"
+                                   f" at {end}")
+
+
+log = EventLog()
+
+
+def open_log() -> None:
+    # the dev mode starts afresh, as the storage does
+    if options.DEV_MODE:
+        log.clear()
+    else:
+        log.open()
+
+
+def close_log() -> None:
+    if options.DEV_MODE:
+        log.clear()
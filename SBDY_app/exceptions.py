@@ -1,4 +1,5 @@
 import logging
+from typing import Dict
 
 from fastapi import FastAPI, Request, Response
 from fastapi.encoders import jsonable_encoder
@@ -20,6 +21,17 @@ class ItemNotFound(Exception):
 ValidationFailed = RequestValidationError([])
 
 
+class StreamValidationFailed(Exception):
+    """
+    Validation of a part of the streamed import failed,
+    but the parts before it were already committed
+    """
+
+    def __init__(self, progress: Dict[str, int]):
+        super().__init__(progress)
+        self.progress = progress
+
+
 response_400 = JSONResponse(status_code=400, content=jsonable_encoder(
     Error(code=400, message="Validation Failed")))
 
@@ -38,6 +50,14 @@ async def handler_400(request: Request, exc: Exception) -> Response:
     return response_400
 
 
+async def handler_stream_400(request: Request, exc: Exception) -> Response:
+    log_handler(request, exc)
+    assert isinstance(exc, StreamValidationFailed)
+    return JSONResponse(status_code=400, content={
+        **jsonable_encoder(Error(code=400, message="Validation Failed")),
+        **exc.progress})
+
+
 async def handler_404(request: Request, exc: Exception) -> Response:
     log_handler(request, exc)
     return response_404
@@ -46,6 +66,7 @@ async def handler_404(request: Request, exc: Exception) -> Response:
 def add_exception_handlers(app: FastAPI) -> None:
     app.exception_handler(RequestValidationError)(handler_400)
     app.exception_handler(ItemNotFound)(handler_404)
+    app.exception_handler(StreamValidationFailed)(handler_stream_400)
 
 
 class NotEnoughResultsFound(InvalidRequestError):
@@ -0,0 +1,107 @@
+"""
+Queue of the imports applied in the background
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+from uuid import UUID, uuid4
+
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+from . import __name__ as mod_name
+from .models import ImportJob
+from .schemas import Error, ImpRequest, JobStatus
+from .storage import Transaction, read_session, write_session
+
+
+logger = logging.getLogger(mod_name)
+
+Apply = Callable[[Transaction, ImpRequest], Awaitable[Any]]
+
+# seconds before the job that failed not by its own fault is retried
+RETRY_DELAY = 1
+
+
+class JobQueue:
+    """
+    Imports are saved into the database and applied one by one
+    in the order of their arrival by the worker,
+    so the queue survives a restart of the app
+    """
+
+    def __init__(self, apply: Apply):
+        self.apply = apply
+        self.stopping = False
+        self.wakeup: Optional[asyncio.Event] = None
+        self.worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        # not cancelled, so it doesn't leave the transaction unfinished
+        if self.worker is None:
+            return
+        self.stopping = True
+        self.wakeup.set()  # type: ignore
+        await self.worker
+        self.worker = None
+
+    async def submit(self, request: str) -> UUID:
+        """
+        Saves the json of the ImpRequest as it was received,
+        it's parsed again only when it's applied
+        """
+
+        id = uuid4()
+        async with write_session() as db:
+            await db.create_job(id, request)
+            await db.commit()
+
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return id
+
+    async def run(self) -> None:
+        assert self.wakeup is not None
+
+        while not self.stopping:
+            # cleared before the read, so no submit can be missed
+            self.wakeup.clear()
+            async with read_session() as db:
+                job = await db.next_job()
+
+            if job is None:
+                await self.wakeup.wait()
+                continue
+
+            try:
+                await self.process(job)
+            except Exception as e:
+                logger.error(f"Job {job.id} will be retried: {e!r}")
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def process(self, job: ImportJob) -> None:
+        if job.status != JobStatus.RUNNING:
+            async with write_session() as db:
+                await db.set_job_status(job.id, JobStatus.RUNNING)
+                await db.commit()
+
+        # the job is finished in the same transaction as its import
+        async with write_session() as db:
+            try:
+                req = ImpRequest.parse_raw(job.request)
+                async with db.begin_nested():
+                    await self.apply(db, req)
+            except (RequestValidationError, ValidationError) as e:
+                logger.error(f"Job {job.id} failed: {e!r}")
+                error = Error(code=400, message="Validation Failed")
+                await db.set_job_status(job.id, JobStatus.FAILED,
+                                        error=error.json())
+            else:
+                await db.set_job_status(job.id, JobStatus.DONE)
+            await db.commit()
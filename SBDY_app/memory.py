@@ -0,0 +1,587 @@
+"""
+Storage backend that keeps everything in the memory of the process,
+with the snapshots on disk (options.STORAGE_BACKEND = "memory")
+"""
+
+import asyncio
+import logging
+import os
+import pickle
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from math import inf
+from pathlib import Path
+from types import SimpleNamespace
+from typing import (Any, AsyncGenerator, Callable, Dict, Iterable, Iterator,
+                    List, Optional, Tuple)
+from uuid import UUID
+
+from . import __name__ as mod_name
+from . import options
+from .schemas import Import, JobStatus, ShopUnitType
+from .storage import Storage, Transaction, month_of
+from .typedefs import Deltas, ShopUnits, ShopUnitStates
+
+
+logger = logging.getLogger(mod_name)
+
+SNAPSHOT_PATH = Path(__file__).parent / "snapshot.pickle"
+
+Row = Dict[str, Any]
+# (date, sequence number, row), the number orders the equal dates
+Entry = Tuple[datetime, int, Row]
+
+# the fields of the state of the unit in its history,
+# the entries with the same ones share their row
+STATE_FIELDS = ("parentId", "name", "type", "price")
+
+MISSING = object()
+
+
+def wall_clock(date: datetime) -> datetime:
+    # the same as the database keeps it, see models.Timestamp
+    return date.replace(tzinfo=None)
+
+
+def plain(row: Row) -> SimpleNamespace:
+    return SimpleNamespace(**row)
+
+
+def state_of(row: Row) -> Tuple[Any, ...]:
+    return tuple(row[name] for name in STATE_FIELDS)
+
+
+def date_range(entries: List[Any], start: datetime, end: datetime,
+               with_end: bool) -> List[Any]:
+    """
+    Slice of the sorted 'entries' with the dates from 'start' to 'end'
+    """
+
+    first = bisect_left(entries, (wall_clock(start),))
+    if with_end:
+        last = bisect_right(entries, (wall_clock(end), inf))
+    else:
+        last = bisect_left(entries, (wall_clock(end),))
+    return entries[first:last]
+
+
+class State:
+    """
+    Everything that is stored, the snapshot is the pickle of it
+    """
+
+    def __init__(self) -> None:
+        self.units: Dict[UUID, Row] = {}
+        self.children: Dict[UUID, Dict[UUID, None]] = {}
+        # the offers by their date, for /sales
+        self.offers: List[Entry] = []
+        # the partitions of the history by their months,
+        # the history of every unit in them is sorted by the date
+        self.partitions: Dict[str, Dict[UUID, List[Entry]]] = {}
+        # the months in which the entries share the rows of the same states
+        self.compacted: Dict[str, None] = {}
+        self.jobs: Dict[UUID, Row] = {}
+        # the jobs that are queued or running, in the order of arrival
+        self.pending: Dict[UUID, None] = {}
+        self.applied: Dict[str, Row] = OrderedDict()
+        self.last_key = 0
+        # sequence number of the last applied event of the log
+        self.last_event = 0
+
+    def __setstate__(self, saved: Dict[str, Any]) -> None:
+        # the snapshots of the older versions get what they miss
+        self.__init__()  # type: ignore
+        history = saved.pop("history", {})
+        self.__dict__.update(saved)
+
+        for id, entries in history.items():
+            for entry in entries:
+                partition = self.partitions.setdefault(month_of(entry[0]), {})
+                partition.setdefault(id, []).append(entry)
+
+
+class MemoryTransaction(Transaction):
+    """
+    Reads and writes the state directly, the writer keeps the undo log
+    of its changes, so they can be rolled back
+    """
+
+    def __init__(self, storage: "MemoryStorage", *, write: bool):
+        super().__init__()
+        self.storage = storage
+        self.state = storage.state
+        self.write = write
+        self.undo: List[Callable[[], None]] = []
+
+    async def view(self) -> State:
+        # uncommitted changes are only seen by their own transaction,
+        # so the readers wait for the writer that has them
+        writer = self.storage.writer
+        if writer is not None and writer is not self and writer.undo:
+            async with self.storage.lock:
+                pass
+        return self.state
+
+    def changes(self) -> State:
+        if not self.write:
+            raise RuntimeError("Change of the storage in a read session")
+        return self.state
+
+    async def commit_changes(self) -> None:
+        self.undo.clear()
+        self.storage.version += 1
+
+    def rollback(self, mark: int = 0) -> None:
+        while len(self.undo) > mark:
+            self.undo.pop()()
+
+    @asynccontextmanager
+    async def savepoint(self) -> AsyncGenerator[None, None]:
+        mark = len(self.undo)
+        try:
+            yield
+        except BaseException:
+            self.rollback(mark)
+            raise
+
+    async def last_event(self) -> int:
+        return (await self.view()).last_event
+
+    async def set_last_event(self, sequence: int) -> None:
+        state = self.changes()
+        old = state.last_event
+        state.last_event = sequence
+        self.undo.append(lambda: setattr(state, "last_event", old))
+
+    ### changes with their undo ###
+
+    def set(self, mapping: Dict[Any, Any], key: Any, value: Any) -> None:
+        old = mapping.get(key, MISSING)
+        mapping[key] = value
+        self.undo.append(lambda: self.restore(mapping, key, old))
+
+    def pop(self, mapping: Dict[Any, Any], key: Any) -> None:
+        old = mapping.pop(key, MISSING)
+        self.undo.append(lambda: self.restore(mapping, key, old))
+
+    @staticmethod
+    def restore(mapping: Dict[Any, Any], key: Any, old: Any) -> None:
+        if old is MISSING:
+            mapping.pop(key, None)
+        else:
+            mapping[key] = old
+
+    def insort(self, entries: List[Entry], entry: Entry) -> None:
+        insort(entries, entry)
+        self.undo.append(lambda: self.remove(entries, entry, log=False))
+
+    def remove(self, entries: List[Entry], entry: Entry, *,
+               log: bool = True) -> None:
+        # the sequence numbers are unique, so the rows aren't compared
+        del entries[bisect_left(entries, entry)]
+        if log:
+            self.undo.append(lambda: insort(entries, entry))
+
+    def update(self, id: UUID, **values: Any) -> None:
+        # the rows are replaced, not changed, so the undo can restore them
+        state = self.changes()
+        old = state.units[id]
+        row = {**old, **values}
+        self.set(state.units, id, row)
+
+        if row["type"] == ShopUnitType.OFFER:
+            self.remove(state.offers, self.offer_entry(old))
+            self.insort(state.offers, self.offer_entry(row))
+
+    def link(self, id: UUID, parent_id: Optional[UUID]) -> None:
+        state = self.changes()
+        if parent_id is None:
+            return
+        if parent_id not in state.children:
+            self.set(state.children, parent_id, {})
+        self.set(state.children[parent_id], id, None)
+
+    def unlink(self, id: UUID, parent_id: Optional[UUID]) -> None:
+        state = self.changes()
+        if parent_id is not None and parent_id in state.children:
+            self.pop(state.children[parent_id], id)
+
+    @staticmethod
+    def offer_entry(row: Row) -> Entry:
+        return row["date"], row["_unique_id"], row
+
+    def next_key(self) -> int:
+        # never reused, even if the transaction is rolled back
+        self.state.last_key += 1
+        return self.state.last_key
+
+    ### units ###
+
+    def subtree(self, state: State, id: UUID) -> Iterator[UUID]:
+        stack = [id]
+        while stack:
+            current = stack.pop()
+            yield current
+            stack.extend(state.children.get(current, ()))
+
+    async def shop_unit_exists(self, id: UUID) -> bool:
+        return id in (await self.view()).units
+
+    async def shop_unit(self, id: UUID, *,
+                        recursive: bool = True) -> Optional[ShopUnits]:
+        state = await self.view()
+        if id not in state.units:
+            return None
+
+        ids = self.subtree(state, id) if recursive else [id]
+        units: ShopUnits = {}
+        for unit_id in ids:
+            unit = units[unit_id] = plain(state.units[unit_id])
+            unit.children = []
+
+        # in the order of their creation, as the database gives them
+        for unit in sorted(units.values(), key=lambda u: u._unique_id):
+            parent = units.get(unit.parentId, None)  # type: ignore
+            if parent is not None and unit.id != id:
+                parent.children.append(unit)
+        return units
+
+    async def shop_units(self, ids: Iterable[UUID]) -> ShopUnits:
+        state = await self.view()
+        units: ShopUnits = {}
+        for id in ids:
+            if id in state.units:
+                unit = units[id] = plain(state.units[id])
+                unit.children = []
+        return units
+
+    async def offers_by_date(self, start: datetime, end: datetime, *,
+                             with_end: bool = True) -> ShopUnits:
+        state = await self.view()
+        units: ShopUnits = {}
+        for _, _, row in date_range(state.offers, start, end, with_end):
+            unit = units[row["id"]] = plain(row)
+            unit.children = []
+        return units
+
+    async def shop_unit_states(self, ids: Iterable[UUID]) -> ShopUnitStates:
+        state = await self.view()
+        return {id: plain(state.units[id]) for id in ids
+                if id in state.units}
+
+    async def shop_units_parents(self,
+                                 ids: Iterable[UUID]) -> ShopUnitStates:
+        state = await self.view()
+        parents: ShopUnitStates = {}
+        for id in ids:
+            current: Optional[UUID] = id
+            while current in state.units and current not in parents:
+                parents[current] = plain(state.units[current])  # type: ignore
+                current = state.units[current]["parentId"]  # type: ignore
+        return parents
+
+    async def type_changed(self, imports: Iterable[Import]) -> bool:
+        state = await self.view()
+        return any(imp.id in state.units
+                   and state.units[imp.id]["type"] != imp.type
+                   for imp in imports)
+
+    async def stat_units_by_date(self, id: UUID, start: datetime,
+                                 end: datetime, *,
+                                 with_end: bool = False) -> List[Any]:
+        state = await self.view()
+        first, last = month_of(start), month_of(end)
+
+        entries: List[Entry] = []
+        for month, partition in state.partitions.items():
+            if first <= month <= last and id in partition:
+                entries += date_range(partition[id], start, end, with_end)
+        # in the order of the changes, as the database gives them
+        return [plain({**row, "date": date, "_unique_id": key})
+                for date, key, row in sorted(entries,
+                                             key=lambda entry: entry[1])]
+
+    async def upsert_shop_units(self, date: datetime,
+                                imports: Iterable[Import]) -> None:
+        state = self.changes()
+        date = wall_clock(date)
+
+        for imp in imports:
+            row = state.units.get(imp.id, None)
+            if row is None:
+                row = {**imp.dict(), "date": date, "sub_offers_count": 0,
+                       "_unique_id": self.next_key()}
+                self.set(state.units, imp.id, row)
+                self.link(imp.id, imp.parentId)
+                if imp.type == ShopUnitType.OFFER:
+                    self.insort(state.offers, self.offer_entry(row))
+                continue
+
+            if row["parentId"] != imp.parentId:
+                self.unlink(imp.id, row["parentId"])
+                self.link(imp.id, imp.parentId)
+
+            values = {"name": imp.name, "parentId": imp.parentId}
+            if imp.type == ShopUnitType.OFFER:
+                values.update(price=imp.price, date=date)
+            self.update(imp.id, **values)
+
+    async def update_aggregates(self, totals: Deltas, *,
+                                date: Optional[datetime] = None,
+                                parents: Iterable[UUID] = ()) -> None:
+        state = self.changes()
+
+        ids = set(totals.keys())
+        if date is not None:
+            ids |= set(parents)
+
+        for id in ids:
+            if id not in state.units:
+                continue
+            row = state.units[id]
+            diff, count = totals.get(id, (0, 0))
+            values = {"price": row["price"] + diff,
+                      "sub_offers_count": row["sub_offers_count"] + count}
+            if date is not None:
+                values["date"] = wall_clock(date)
+            self.update(id, **values)
+
+    async def create_stat_units(self, ids: Iterable[UUID]) -> None:
+        state = self.changes()
+
+        for id in ids:
+            if id not in state.units:
+                continue
+            unit = state.units[id]
+            # the same as price of ShopUnit schema - ceil(price / count)
+            price, count = unit["price"], unit["sub_offers_count"]
+            if count != 0:
+                price = -(-price // count)
+
+            row = {name: unit[name]
+                   for name in ("id", "parentId", "name", "date", "type")}
+            key = self.next_key()
+            row.update(price=price, _unique_id=key)
+
+            month = month_of(row["date"])
+            if month not in state.partitions:
+                self.set(state.partitions, month, {})
+            partition = state.partitions[month]
+            if id not in partition:
+                self.set(partition, id, [])
+            entries = partition[id]
+
+            # any row of the same state will do, the entry has its own date
+            if not options.COMPACT_HISTORY:
+                self.pop(state.compacted, month)
+            elif entries and state_of(entries[-1][2]) == state_of(row):
+                row = entries[-1][2]
+            self.insort(entries, (unit["date"], key, row))
+
+    async def compact_history(self) -> Optional[str]:
+        state = self.changes()
+        month = min((month for month in state.partitions
+                     if month not in state.compacted), default=None)
+        if month is None:
+            return None
+
+        partition = state.partitions[month]
+        for id, entries in list(partition.items()):
+            rows: Dict[Tuple[Any, ...], Row] = {}
+            self.set(partition, id, [
+                (date, key, rows.setdefault(state_of(row), row))
+                for date, key, row in entries])
+        self.set(state.compacted, month, None)
+        return month
+
+    async def drop_history(self, before: str) -> List[str]:
+        state = self.changes()
+        months = sorted(month for month in state.partitions if month < before)
+        for month in months:
+            self.pop(state.partitions, month)
+            self.pop(state.compacted, month)
+        return months
+
+    # the children are linked to the parents by 'upsert_shop_units',
+    # as it knows both the old and the new parent
+
+    async def add_tree_nodes(self,
+                             links: List[Tuple[UUID, Optional[UUID]]]
+                             ) -> None:
+        pass
+
+    async def move_tree_node(self, id: UUID,
+                             parent_id: Optional[UUID]) -> None:
+        pass
+
+    ### deletion ###
+
+    # the subtrees are removed right away, it's cheap in memory,
+    # so nothing is ever left to purge
+
+    async def dead_units(self, ids: Iterable[UUID]) -> Dict[UUID, int]:
+        return {}
+
+    async def bury_subtrees(self, ids: Iterable[UUID]) -> None:
+        state = self.changes()
+
+        for id in ids:
+            self.unlink(id, state.units[id]["parentId"])
+            for unit_id in list(self.subtree(state, id)):
+                row = state.units[unit_id]
+                if row["type"] == ShopUnitType.OFFER:
+                    self.remove(state.offers, self.offer_entry(row))
+                self.pop(state.units, unit_id)
+                self.pop(state.children, unit_id)
+                for partition in state.partitions.values():
+                    if unit_id in partition:
+                        self.pop(partition, unit_id)
+
+    async def purge_subtree(self, key: int) -> None:
+        pass
+
+    async def purge_batch(self, size: int) -> bool:
+        return False
+
+    ### jobs ###
+
+    async def create_job(self, id: UUID, request: str) -> None:
+        state = self.changes()
+        self.set(state.jobs, id, {"id": id, "status": JobStatus.QUEUED,
+                                  "request": request, "error": None})
+        self.set(state.pending, id, None)
+
+    async def job(self, id: UUID) -> Optional[Any]:
+        state = await self.view()
+        return plain(state.jobs[id]) if id in state.jobs else None
+
+    async def next_job(self) -> Optional[Any]:
+        state = await self.view()
+        for id in state.pending:
+            return plain(state.jobs[id])
+        return None
+
+    async def set_job_status(self, id: UUID, status: JobStatus, *,
+                             error: Optional[str] = None) -> None:
+        state = self.changes()
+        if id not in state.jobs:
+            return
+        self.set(state.jobs, id,
+                 {**state.jobs[id], "status": status, "error": error})
+        if status in (JobStatus.DONE, JobStatus.FAILED):
+            self.pop(state.pending, id)
+
+    ### applied imports ###
+
+    async def applied_import(self, key: str) -> Optional[Any]:
+        state = await self.view()
+        return plain(state.applied[key]) if key in state.applied else None
+
+    async def remember_import(self, key: str, applied: int, skipped: int,
+                              keep: int) -> None:
+        state = self.changes()
+        self.set(state.applied, key,
+                 {"key": key, "applied": applied, "skipped": skipped})
+        while len(state.applied) > keep:
+            self.pop(state.applied, next(iter(state.applied)))
+
+
+class MemoryStorage(Storage):
+    """
+    The units are in dicts by their id, the history of every unit
+    is an array sorted by the date in the partition of every month,
+    the writers take turns by the lock.
+    The state is pickled to SNAPSHOT_PATH every options.SNAPSHOT_INTERVAL
+    seconds if it has changed, and on shutdown, and it's loaded on startup
+    """
+
+    def __init__(self) -> None:
+        self.state = State()
+        self.lock = asyncio.Lock()
+        self.writer: Optional[MemoryTransaction] = None
+        # number of the commits, and the one of the last snapshot
+        self.version = 0
+        self.saved = 0
+        self.snapshots: Optional[asyncio.Task] = None
+
+    async def startup(self) -> None:
+        if options.DEV_MODE:
+            SNAPSHOT_PATH.unlink(missing_ok=True)
+        elif SNAPSHOT_PATH.exists():
+            self.state = pickle.loads(SNAPSHOT_PATH.read_bytes())
+            logger.info(f"Loaded {len(self.state.units)} units"
+                        f" from the snapshot {SNAPSHOT_PATH}")
+
+        self.lock = asyncio.Lock()
+        self.snapshots = asyncio.create_task(self.save_periodically())
+
+    async def shutdown(self) -> None:
+        if self.snapshots is not None:
+            self.snapshots.cancel()
+            self.snapshots = None
+
+        if options.DEV_MODE:
+            SNAPSHOT_PATH.unlink(missing_ok=True)
+        else:
+            await self.save()
+
+    async def clear(self) -> None:
+        async with self.lock:
+            self.state = State()
+            self.version += 1
+
+    async def save(self) -> None:
+        """
+        Writes the snapshot if there were commits since the last one,
+        the file is replaced at once, so it's never half written
+        """
+
+        if self.version == self.saved:
+            return
+
+        # the lock keeps the uncommitted changes out of the snapshot
+        async with self.lock:
+            data = pickle.dumps(self.state, pickle.HIGHEST_PROTOCOL)
+            version = self.version
+
+        await asyncio.to_thread(write_atomically, SNAPSHOT_PATH, data)
+        self.saved = version
+        logger.info(f"Saved the snapshot of version {version}")
+
+    async def save_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(options.SNAPSHOT_INTERVAL)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Snapshot will be retried: {e!r}")
+
+    @asynccontextmanager
+    async def read_session(self) -> AsyncGenerator[Transaction, None]:
+        yield MemoryTransaction(self, write=False)
+
+    @asynccontextmanager
+    async def write_session(self) -> AsyncGenerator[Transaction, None]:
+        async with self.lock:
+            transaction = MemoryTransaction(self, write=True)
+            self.writer = transaction
+            try:
+                yield transaction
+            except BaseException:
+                transaction.rollback()
+                raise
+            else:
+                await transaction.commit()
+            finally:
+                self.writer = None
+
+
+def write_atomically(path: Path, data: bytes) -> None:
+    temporary = path.with_suffix(".tmp")
+    with open(temporary, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
@@ -0,0 +1,155 @@
+"""
+Versioned migrations of the database schema
+"""
+
+import logging
+from typing import Callable, List
+
+from sqlalchemy import inspect, insert
+from sqlalchemy.engine import Connection
+
+from . import __name__ as mod_name
+from .models import (Base, HistoryPartition, HistorySequence, ShopTree,
+                     ShopUnit, Tombstone, history_marks, history_partition)
+
+
+logger = logging.getLogger(mod_name)
+
+Migration = Callable[[Connection], None]
+
+
+def columns(conn: Connection, table: str) -> List[str]:
+    return [column["name"] for column in inspect(conn).get_columns(table)]
+
+
+def integer_keys(conn: Connection) -> None:
+    """
+    The units get the integer keys, the tree and the tombstones use them,
+    the tree is left empty, so it's rebuilt on startup
+    """
+
+    tables = inspect(conn).get_table_names()
+    if "_unique_id" in columns(conn, "shop"):
+        return
+
+    conn.exec_driver_sql("ALTER TABLE shop RENAME TO shop_old")
+    ShopUnit.__table__.create(conn)  # type: ignore
+    names = ", ".join(f'"{name}"' for name in columns(conn, "shop_old"))
+    conn.exec_driver_sql(
+        f"INSERT INTO shop ({names}) SELECT {names} FROM shop_old")
+
+    if "tombstones" in tables:
+        conn.exec_driver_sql("ALTER TABLE tombstones RENAME TO tombstones_old")
+        Tombstone.__table__.create(conn)  # type: ignore
+        conn.exec_driver_sql(
+            "INSERT INTO tombstones (key) SELECT shop._unique_id"
+            " FROM tombstones_old JOIN shop ON shop.id = tombstones_old.id")
+        conn.exec_driver_sql("DROP TABLE tombstones_old")
+
+    if "tree" in tables:
+        conn.exec_driver_sql("DROP TABLE tree")
+        ShopTree.__table__.create(conn)  # type: ignore
+
+    conn.exec_driver_sql("DROP TABLE shop_old")
+
+
+def lookup_indexes(conn: Connection) -> None:
+    """
+    Indexes of the lookups by the parent, by the date and the type
+    of the offers, and of the history by the unit and the date
+    """
+
+    for table in Base.metadata.sorted_tables:
+        if not inspect(conn).has_table(table.name):
+            continue
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def partition_history(conn: Connection) -> None:
+    """
+    The history is moved from the one table to the partitions
+    of its months, the rows keep their keys, so their order is kept
+    """
+
+    if not inspect(conn).has_table("stat"):
+        return
+
+    HistoryPartition.__table__.create(conn)  # type: ignore
+    HistorySequence.__table__.create(conn)  # type: ignore
+
+    # the dates are stored either as text or as epoch milliseconds
+    of_date = ("CASE typeof(date) WHEN 'integer'"
+               " THEN strftime('%Y_%m', date / 1000.0, 'unixepoch')"
+               " ELSE replace(substr(date, 1, 7), '-', '_') END")
+    months = conn.exec_driver_sql(
+        f"SELECT DISTINCT {of_date} FROM stat").scalars().all()
+
+    for month in months:
+        table = history_partition(month)
+        table.create(conn)
+        names = ", ".join(f'"{column.name}"' for column in table.columns)
+        conn.exec_driver_sql(
+            f"INSERT INTO {table.name} ({names})"
+            f" SELECT {names} FROM stat WHERE {of_date} = ?", (month,))
+        conn.execute(insert(HistoryPartition).values(month=month))
+
+    last = conn.exec_driver_sql(
+        "SELECT coalesce(max(_unique_id), 0) FROM stat").scalar()
+    conn.execute(insert(HistorySequence).values(_unique_id=1, last=last))
+    conn.exec_driver_sql("DROP TABLE stat")
+
+
+def run_marks(conn: Connection) -> None:
+    """
+    The partitions get the tables of the marks of their runs,
+    the existing months are left to be compacted
+    """
+
+    if not inspect(conn).has_table("history_partitions"):
+        return
+
+    if "compacted" not in columns(conn, "history_partitions"):
+        conn.exec_driver_sql("ALTER TABLE history_partitions ADD COLUMN"
+                             " compacted BOOLEAN NOT NULL DEFAULT 0")
+    months = conn.exec_driver_sql(
+        "SELECT month FROM history_partitions").scalars().all()
+    for month in months:
+        history_marks(month).create(conn, checkfirst=True)
+
+
+# the version of the schema is the number of the applied migrations,
+# so the new ones are only ever appended
+MIGRATIONS: List[Migration] = [
+    integer_keys,
+    lookup_indexes,
+    partition_history,
+    run_marks,
+]
+
+
+def version(conn: Connection) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def upgrade(conn: Connection) -> None:
+    """
+    Brings the schema of the database up to date,
+    a new database is created as it is, an existing one
+    gets the migrations that it doesn't have yet, in order
+    """
+
+    current = version(conn)
+    if current > len(MIGRATIONS):
+        raise RuntimeError(f"Database schema version {current} is newer"
+                           f" than the latest known {len(MIGRATIONS)}")
+
+    if inspect(conn).has_table("shop"):
+        for number, migration in enumerate(MIGRATIONS[current:], current):
+            logger.info(f"Migrating the database to version {number + 1}"
+                        f" ({migration.__name__})")
+            migration(conn)
+
+    # the tables that are missing, e.g. all of them in the new database
+    Base.metadata.create_all(conn)
+    conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
@@ -6,15 +6,18 @@ Database models
 
 from __future__ import annotations
 
-from datetime import datetime
-from typing import List, Optional, Set
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
 from uuid import UUID
 
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, Integer, String
+from sqlalchemy import (Boolean, Column, Enum, ForeignKey, Index, Integer,
+                        MetaData, String, Table)
 from sqlalchemy.orm import DeclarativeMeta, declarative_base, relationship
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy_utils import UUIDType
 
-from .schemas import ShopUnitType
+from . import options
+from .schemas import JobStatus, ShopUnitType
 
 
 # for future: github.com/tiangolo/sqlmodel
@@ -22,11 +25,81 @@ from .schemas import ShopUnitType
 Base: DeclarativeMeta = declarative_base()
 
 
+### storage layout ###
+# the dates and the types of the units are stored either as text
+# or, with options.COMPACT_STORAGE, as integers, both are read back,
+# crud.convert_layout converts the stored rows from one to the other
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+class Timestamp(TypeDecorator):
+    """
+    Date that is stored as text with microseconds
+    or as integer milliseconds since the epoch,
+    the timezone is dropped, the wall clock is stored as is
+    """
+
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value: Optional[datetime],
+                           dialect: Any) -> Any:
+        if value is None:
+            return None
+        value = value.replace(tzinfo=None)
+        if options.COMPACT_STORAGE:
+            return (value - EPOCH) // MILLISECOND
+        return value.isoformat(" ", "microseconds")
+
+    def process_result_value(self, value: Any,
+                             dialect: Any) -> Optional[datetime]:
+        if value is None:
+            return None
+        if isinstance(value, int):
+            return EPOCH + value * MILLISECOND
+        return datetime.fromisoformat(value)
+
+
+class UnitType(TypeDecorator):
+    """
+    ShopUnitType that is stored as its name or as a small integer code
+    """
+
+    impl = Integer
+    cache_ok = True
+
+    CODES: Dict[ShopUnitType, int] = {
+        ShopUnitType.OFFER: 1,
+        ShopUnitType.CATEGORY: 2,
+    }
+    TYPES = {code: tp for tp, code in CODES.items()}
+
+    def process_bind_param(self, value: Optional[ShopUnitType],
+                           dialect: Any) -> Any:
+        if value is None:
+            return None
+        value = ShopUnitType(value)
+        if options.COMPACT_STORAGE:
+            return self.CODES[value]
+        return value.name
+
+    def process_result_value(self, value: Any,
+                             dialect: Any) -> Optional[ShopUnitType]:
+        if value is None:
+            return None
+        # the code is text in the tables created before the layout
+        if isinstance(value, int) or value.isdigit():
+            return self.TYPES[int(value)]
+        return ShopUnitType[value]
+
+
 class BaseUnit:
     name: str = Column(String)  # type: ignore
-    date: datetime = Column(DateTime)  # type: ignore
+    date: datetime = Column(Timestamp)  # type: ignore
 
-    type: ShopUnitType = Column(Enum(ShopUnitType))  # type: ignore
+    type: ShopUnitType = Column(UnitType)  # type: ignore
     price: int = Column(Integer)  # type: ignore
 
     @classmethod
@@ -52,18 +125,176 @@ class BaseUnit:
 class ShopUnit(Base, BaseUnit):
     __tablename__ = "shop"
 
-    id: UUID = Column(UUIDType(), primary_key=True)  # type: ignore
+    # internal key, the tree and the tombstones refer to units by it
+    _unique_id = Column(Integer, primary_key=True, autoincrement=True)
+    id: UUID = Column(UUIDType(), unique=True, nullable=False)  # type: ignore
     parentId: Optional[UUID] = Column(  # type: ignore
         UUIDType(), ForeignKey("shop.id"), nullable=True)
     children: List[ShopUnit]
 
     sub_offers_count: int = Column(Integer)  # type: ignore
 
+    __table_args__ = (
+        # the recursive lookups by the parent
+        Index("ix_shop_parent", "parentId"),
+        # /sales - the offers updated in the range of dates
+        Index("ix_shop_type_date", "type", "date"),
+        # keys of the deleted units are never reused, the tree may have them
+        {"sqlite_autoincrement": True},
+    )
+
+
+### history ###
+# the history of the units is partitioned by the month of the date,
+# every month has its own tables, created with its first row,
+# so the range of dates reads only its months,
+# and the expired months are dropped as whole tables.
+# A row of the history is a run of the same states of the unit,
+# its first one, the rest of them are the marks of the run,
+# with options.COMPACT_HISTORY the unchanged states are only marked
+
+# the partitions come and go, so they aren't in Base.metadata
+History = MetaData()
+
+PARTITION_PREFIX = "stat_"
+
+
+def history_partition(month: str) -> Table:
+    """
+    Table of the runs of the history of the month, see 'storage.month_of'
+    """
+
+    name = PARTITION_PREFIX + month
+    if name in History.tables:
+        return History.tables[name]
+
+    return Table(
+        name, History,
+        # from HistorySequence, so the rows of all the months are ordered
+        Column("_unique_id", Integer, primary_key=True),
+        Column("id", UUIDType()),
+        Column("parentId", UUIDType(), nullable=True),
+        Column("name", String),
+        Column("date", Timestamp),
+        Column("type", UnitType),
+        Column("price", Integer),
+        # /node/{id}/statistic - the history of the unit in the range of dates
+        Index(f"ix_{name}_id_date", "id", "date"),
+    )
+
+
+def history_marks(month: str) -> Table:
+    """
+    Table of the later states of the runs of the month that repeat them,
+    only the date and the key of the state are kept
+    """
+
+    name = f"{PARTITION_PREFIX}{month}_marks"
+    if name in History.tables:
+        return History.tables[name]
+
+    return Table(
+        name, History,
+        Column("_unique_id", Integer, primary_key=True),
+        # '_unique_id' of the run in 'history_partition'
+        Column("run", Integer),
+        Column("date", Timestamp),
+        Index(f"ix_{name}_run_date", "run", "date"),
+    )
+
 
-class StatUnit(Base, BaseUnit):
-    __tablename__ = "stat"
+class HistoryPartition(Base):
+    """
+    Month of the history that has its partition,
+    the range of dates finds its partitions here
+    """
+
+    __tablename__ = "history_partitions"
+
+    month: str = Column(String, primary_key=True)  # type: ignore
+    # no run of a unit repeats its previous one
+    compacted: bool = Column(  # type: ignore
+        Boolean, nullable=False, default=False)
+
+
+class HistorySequence(Base):
+    """
+    Last '_unique_id' given to a row of the history, the only row,
+    the keys are never reused, even if their partition is dropped
+    """
+
+    __tablename__ = "history_sequence"
+
+    _unique_id = Column(Integer, primary_key=True)
+    last: int = Column(Integer)  # type: ignore
+
+
+class ShopTree(Base):
+    """
+    Closure table of the shop hierarchy, has a row for every
+    (ancestor, descendant) pair, including (unit, unit) with depth 0,
+    units are referred to by their integer keys - '_unique_id' of ShopUnit
+    """
+
+    __tablename__ = "tree"
+
+    ancestor: int = Column(Integer, primary_key=True)  # type: ignore
+    descendant: int = Column(Integer, primary_key=True)  # type: ignore
+    depth: int = Column(Integer)  # type: ignore
+
+    __table_args__ = (
+        Index("ix_tree_descendant", "descendant", "ancestor", "depth"),
+    )
+
+
+class Tombstone(Base):
+    """
+    Root of the deleted subtree that is still to be purged,
+    the units under it are no longer seen, but still stored
+    """
+
+    __tablename__ = "tombstones"
+
+    # '_unique_id' of the root
+    key: int = Column(Integer, primary_key=True)  # type: ignore
+
+
+class ImportJob(Base):
+    """
+    Import queued by /imports/jobs, kept until it's applied or failed,
+    the jobs are applied in the order of '_unique_id'
+    """
+
+    __tablename__ = "jobs"
 
     _unique_id = Column(Integer, primary_key=True, autoincrement=True)
-    id: UUID = Column(UUIDType())  # type: ignore
-    parentId: Optional[UUID] = Column(  # type: ignore
-        UUIDType(), nullable=True)
+    id: UUID = Column(UUIDType(), unique=True)  # type: ignore
+    status: JobStatus = Column(Enum(JobStatus))  # type: ignore
+    request: str = Column(String)  # type: ignore
+    error: Optional[str] = Column(String, nullable=True)  # type: ignore
+
+
+class AppliedImport(Base):
+    """
+    Recently applied import remembered by its key,
+    so its repetition is answered without applying it again
+    """
+
+    __tablename__ = "applied"
+
+    _unique_id = Column(Integer, primary_key=True, autoincrement=True)
+    key: str = Column(String, unique=True)  # type: ignore
+    applied: int = Column(Integer)  # type: ignore
+    skipped: int = Column(Integer)  # type: ignore
+
+
+class LastEvent(Base):
+    """
+    Sequence number of the last event of the log that is applied,
+    the only row, the events after it are replayed on startup
+    """
+
+    __tablename__ = "last_event"
+
+    _unique_id = Column(Integer, primary_key=True)
+    sequence: int = Column(Integer)  # type: ignore
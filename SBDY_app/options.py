@@ -2,8 +2,60 @@
 Changeable application-wide settings and options
 """
 
+from typing import Optional
+
 # by default we don't reload, normal production mode
 RELOAD: bool = False
 
 # by default we run in production mode
 DEV_MODE: bool = False
+
+# merge the concurrent imports into one transaction with one commit
+COALESCE_IMPORTS: bool = False
+
+# number of items imported and committed at once by /imports/stream
+STREAM_CHUNK_SIZE: int = 1000
+
+# number of worker processes that parse the big imports, 0 turns them off
+PARSE_PROCESSES: int = 0
+
+# bodies of /imports at least this big (in bytes) are parsed by the workers
+PARSE_IN_PROCESS_SIZE: int = 1024 * 1024
+
+# items of /imports that are equal to the stored units are not written,
+# so they don't get the new date, history or ancestor updates
+SKIP_UNCHANGED: bool = False
+
+# /imports without the Idempotency-Key are keyed by the hash of the body
+DEDUPLICATE_IMPORTS: bool = False
+
+# number of the latest applied imports remembered by their keys
+REMEMBERED_IMPORTS: int = 10_000
+
+# dates are stored as integer epoch milliseconds and the unit types as
+# small integers, instead of text, the database is converted on startup
+COMPACT_STORAGE: bool = False
+
+# the database journal is the write-ahead log, so the reads don't wait
+# for the writes, and the connections get the pragmas tuned for it
+WAL_MODE: bool = False
+
+# where the units are kept: "sqlite" - the database file next to the app,
+# "memory" - the dicts of the process, saved to the disk as snapshots
+STORAGE_BACKEND: str = "sqlite"
+
+# seconds between the snapshots of the "memory" storage, if it has changed
+SNAPSHOT_INTERVAL: float = 60
+
+# the history keeps only the states of the units that change,
+# the repeated ones are marks of the run of the same states,
+# the existing history is compacted in the background on startup
+COMPACT_HISTORY: bool = False
+
+# bytes of the memory that the tree cache of /nodes may take,
+# the imports and the deletions update it on commit, 0 turns it off
+TREE_CACHE_BYTES: int = 0
+
+# the history of the units is kept for the current month and for this many
+# months before it, the older months are dropped, None keeps all of them
+HISTORY_RETENTION_MONTHS: Optional[int] = None
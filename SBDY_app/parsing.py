@@ -0,0 +1,101 @@
+"""
+Parsing of the big imports in the worker processes
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Tuple
+from uuid import UUID
+
+from pydantic import ValidationError
+
+from . import __name__ as mod_name
+from . import options
+from .crud import chunks
+from .exceptions import ValidationFailed
+from .schemas import Import, ImpRequest, ShopUnitType
+
+
+logger = logging.getLogger(mod_name)
+
+# id, name, parentId, type, price - uuids as bytes, type as its value
+Item = Tuple[bytes, str, Optional[bytes], str, int]
+Parsed = Optional[Tuple[datetime, List[Item]]]
+
+# number of items constructed between the yields to the event loop
+REBUILD_CHUNK = 1000
+
+executor: Optional[ProcessPoolExecutor] = None
+
+
+def validate(body: bytes) -> Parsed:
+    """
+    Runs in the worker process, returns None if the import is invalid,
+    otherwise only the plain values, they are cheaper to send back
+    """
+
+    try:
+        req = ImpRequest.parse_raw(body)
+    except ValidationError:
+        return None
+
+    return req.updateDate, [
+        (imp.id.bytes, imp.name, imp.parentId and imp.parentId.bytes,
+         imp.type.value, imp.price)  # type: ignore
+        for imp in req.items]
+
+
+async def rebuild(parsed: Parsed) -> ImpRequest:
+    """
+    The values are validated already, so it's just a construction,
+    but it's not free either, so the event loop is let go in between
+    """
+
+    if parsed is None:
+        raise ValidationFailed
+
+    date, items = parsed
+    imports: List[Import] = []
+    for chunk in chunks(items, REBUILD_CHUNK):
+        imports.extend(
+            Import.construct(id=UUID(bytes=id), name=name,
+                             parentId=parent_id and UUID(bytes=parent_id),
+                             type=ShopUnitType(tp), price=price)
+            for id, name, parent_id, tp, price in chunk)
+        await asyncio.sleep(0)
+
+    return ImpRequest.construct(updateDate=date, items=imports)
+
+
+async def parse_import(body: bytes) -> ImpRequest:
+    """
+    Parses and validates the body of /imports,
+    if it's big enough, it's done in the worker process,
+    so the event loop is free to serve the other requests,
+    raises ValidationFailed if the import is invalid
+    """
+
+    global executor
+
+    if (options.PARSE_PROCESSES <= 0
+            or len(body) < options.PARSE_IN_PROCESS_SIZE):
+        try:
+            return ImpRequest.parse_raw(body)
+        except ValidationError as e:
+            raise ValidationFailed from e
+
+    if executor is None:
+        executor = ProcessPoolExecutor(options.PARSE_PROCESSES)
+
+    loop = asyncio.get_running_loop()
+    return await rebuild(await loop.run_in_executor(executor, validate, body))
+
+
+def shutdown() -> None:
+    global executor
+
+    if executor is not None:
+        executor.shutdown()
+        executor = None
@@ -0,0 +1,70 @@
+"""
+Purge of the deleted subtrees in the background
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+from . import __name__ as mod_name
+from .storage import write_session
+
+
+logger = logging.getLogger(mod_name)
+
+# number of units purged in one transaction,
+# the writers waiting for the lock get it in between
+PURGE_BATCH = 500
+
+# seconds before the failed batch is retried
+RETRY_DELAY = 1
+
+
+class Purger:
+    """
+    Removes the units of the deleted subtrees with their history
+    in small batches, so the deletion doesn't hold the lock for long
+    """
+
+    def __init__(self) -> None:
+        self.stopping = False
+        self.wakeup: Optional[asyncio.Event] = None
+        self.worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        # not cancelled, so it doesn't leave the transaction unfinished
+        if self.worker is None:
+            return
+        self.stopping = True
+        self.wakeup.set()  # type: ignore
+        await self.worker
+        self.worker = None
+
+    def wake(self) -> None:
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self) -> None:
+        assert self.wakeup is not None
+
+        while not self.stopping:
+            # cleared before the read, so no deletion can be missed
+            self.wakeup.clear()
+            try:
+                async with write_session() as db:
+                    purged = await db.purge_batch(PURGE_BATCH)
+                    await db.commit()
+            except Exception as e:
+                logger.error(f"Purge will be retried: {e!r}")
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+
+            if purged:
+                await asyncio.sleep(0)
+            else:
+                await self.wakeup.wait()
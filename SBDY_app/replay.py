@@ -0,0 +1,39 @@
+"""
+Rebuilds the storage from the event log, the one of the app or a copy
+    python -m SBDY_app.replay --storage memory --rebuild
+"""
+
+import argparse
+import asyncio
+
+from SBDY_app import events, options, storage
+from SBDY_app.app import replay_events
+
+
+parser = argparse.ArgumentParser(
+    prog="SBDY_app.replay", description=__doc__.splitlines()[1].strip())
+parser.add_argument("--storage", choices=list(storage.BACKENDS),
+                    default=options.STORAGE_BACKEND,
+                    help="storage to rebuild, default is 'sqlite'")
+parser.add_argument("--rebuild", action="store_true",
+                    help="start from the empty storage and replay the whole"
+                    " log, otherwise only the events after its snapshot")
+
+
+async def replay(rebuild: bool) -> int:
+    await storage.startup()
+    events.open_log()
+    try:
+        if rebuild:
+            await storage.current().clear()
+        return await replay_events()
+    finally:
+        await storage.shutdown()
+        events.close_log()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    options.STORAGE_BACKEND = args.storage
+    replayed = asyncio.run(replay(args.rebuild))
+    print(f"Replayed {replayed} events into the {args.storage} storage")
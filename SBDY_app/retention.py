@@ -0,0 +1,85 @@
+"""
+Retention of the history, its expired months are dropped in the background
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from . import __name__ as mod_name
+from . import options
+from .storage import month_of, write_session
+
+
+logger = logging.getLogger(mod_name)
+
+# seconds between the checks for the expired months
+CHECK_INTERVAL = 60 * 60
+
+
+def first_kept_month(now: datetime, months: int) -> str:
+    """
+    The month 'months' before the month of 'now', the ones before it expire
+    """
+
+    index = now.year * 12 + now.month - 1 - months
+    return month_of(datetime(index // 12, index % 12 + 1, 1))
+
+
+async def expire_history() -> List[str]:
+    """
+    Drops the partitions of the history older than
+    options.HISTORY_RETENTION_MONTHS, returns their months
+    """
+
+    if options.HISTORY_RETENTION_MONTHS is None:
+        return []
+
+    # the dates are stored as the wall clock, the imports send UTC
+    before = first_kept_month(datetime.utcnow(),
+                              options.HISTORY_RETENTION_MONTHS)
+    async with write_session() as db:
+        dropped = await db.drop_history(before)
+        await db.commit()
+
+    if dropped:
+        logger.info(f"Dropped the expired history of {', '.join(dropped)}")
+    return dropped
+
+
+class Retention:
+    """
+    Checks for the expired months on start and then every CHECK_INTERVAL,
+    a month is dropped as a whole, so it doesn't hold the lock for long
+    """
+
+    def __init__(self) -> None:
+        self.stopping: Optional[asyncio.Event] = None
+        self.worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.stopping = asyncio.Event()
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        # not cancelled, so it doesn't leave the transaction unfinished
+        if self.worker is None:
+            return
+        self.stopping.set()  # type: ignore
+        await self.worker
+        self.worker = None
+
+    async def run(self) -> None:
+        assert self.stopping is not None
+
+        while not self.stopping.is_set():
+            try:
+                await expire_history()
+            except Exception as e:
+                logger.error(f"Retention will be retried: {e!r}")
+
+            try:
+                await asyncio.wait_for(self.stopping.wait(), CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
@@ -133,6 +133,23 @@ class StatResponse(BaseModel):
     items: List[StatUnit]
 
 
+class DeleteRequest(BaseModel):
+    ids: List[UUID]
+
+
 class Error(BaseModel):
     code: int
     message: str
+
+
+class JobStatus(str, Enum):
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+
+class Job(BaseModel):
+    id: UUID
+    status: JobStatus
+    error: Optional[Error] = None
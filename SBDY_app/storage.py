@@ -0,0 +1,384 @@
+"""
+Interface of the storage backends, the one in use is chosen on startup
+"""
+
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import (Any, AsyncContextManager, AsyncGenerator, Callable, Dict,
+                    Iterable, List, Optional, Tuple)
+from uuid import UUID
+
+from fastapi import Depends
+
+from . import events, options, tree_cache
+from .schemas import Import, JobStatus
+from .typedefs import Deltas, ShopUnits, ShopUnitStates
+
+
+def month_of(date: datetime) -> str:
+    """
+    Month of the partition of the history that has the date,
+    as "<year>_<month>", so the months sort in order as text
+    """
+
+    return f"{date.year:04d}_{date.month:02d}"
+
+
+class Transaction(ABC):
+    """
+    Operations of the app on the stored units, the jobs and the imports,
+    the changes are seen by the others after 'commit',
+    the units and the rows are returned as plain objects with the fields
+    of the models, so the callers can't change the stored ones.
+
+    The events of the changes are written to the event log on commit,
+    before the changes themselves, with the number of the last of them.
+    The tree cache gets the changed units after the commit
+    """
+
+    def __init__(self) -> None:
+        self.events: List[events.Event] = []
+        self.tree_changes = tree_cache.Changes()
+
+    def log_event(self, event: events.Event) -> None:
+        self.events.append(event)
+
+    def units_changed(self, ids: Iterable[UUID], *,
+                      new: Iterable[UUID] = (),
+                      removed: Iterable[UUID] = ()) -> None:
+        """
+        Notes the units that the transaction changes for the tree cache,
+        the 'new' ones among them, and the 'removed' subtrees
+        """
+
+        self.tree_changes.changed.update(ids)
+        self.tree_changes.new.update(new)
+        self.tree_changes.removed.update(removed)
+
+    async def commit(self) -> None:
+        changes, self.tree_changes = self.tree_changes, tree_cache.Changes()
+        # read before the commit, as this transaction sees them
+        units: ShopUnits = {}
+        if tree_cache.cache.enabled and changes.changed:
+            units = await self.shop_units(changes.changed)
+
+        if not self.events:
+            await self.commit_changes()
+        else:
+            pending, self.events = self.events, []
+            # in place, so the cancelled commit can't leave it half written
+            mark = events.log.mark()
+            try:
+                sequence = events.log.append(pending)
+                await self.set_last_event(sequence)
+                await self.commit_changes()
+            except BaseException:
+                events.log.truncate(mark)
+                raise
+
+        if tree_cache.cache.enabled:
+            tree_cache.cache.apply(changes, units)
+
+    @asynccontextmanager
+    async def begin_nested(self) -> AsyncGenerator[None, None]:
+        """
+        Savepoint, the changes and the events made inside
+        are undone if it raises
+        """
+
+        mark = len(self.events)
+        try:
+            async with self.savepoint():
+                yield
+        except BaseException:
+            del self.events[mark:]
+            raise
+
+    @abstractmethod
+    async def commit_changes(self) -> None:
+        ...
+
+    @abstractmethod
+    def savepoint(self) -> AsyncContextManager[Any]:
+        ...
+
+    @abstractmethod
+    async def last_event(self) -> int:
+        """
+        Sequence number of the last event of the log that is applied
+        """
+
+    @abstractmethod
+    async def set_last_event(self, sequence: int) -> None:
+        ...
+
+    ### units ###
+
+    @abstractmethod
+    async def shop_unit_exists(self, id: UUID) -> bool:
+        ...
+
+    @abstractmethod
+    async def shop_unit(self, id: UUID, *,
+                        recursive: bool = True) -> Optional[ShopUnits]:
+        """
+        The unit with all its descendants, as they are linked by 'children'
+        """
+
+    @abstractmethod
+    async def shop_units(self, ids: Iterable[UUID]) -> ShopUnits:
+        """
+        The units that are there with all their fields,
+        not linked to their children
+        """
+
+    @abstractmethod
+    async def offers_by_date(self, start: datetime, end: datetime, *,
+                             with_end: bool = True) -> ShopUnits:
+        ...
+
+    @abstractmethod
+    async def shop_unit_states(self, ids: Iterable[UUID]) -> ShopUnitStates:
+        """
+        The stored units, the deleted ones too, if they aren't purged
+        """
+
+    @abstractmethod
+    async def shop_units_parents(self,
+                                 ids: Iterable[UUID]) -> ShopUnitStates:
+        """
+        The units with all their ancestors
+        """
+
+    @abstractmethod
+    async def type_changed(self, imports: Iterable[Import]) -> bool:
+        ...
+
+    @abstractmethod
+    async def stat_units_by_date(self, id: UUID, start: datetime,
+                                 end: datetime, *,
+                                 with_end: bool = False) -> List[Any]:
+        """
+        The history of the unit in the range of dates,
+        in the order of the changes
+        """
+
+    @abstractmethod
+    async def upsert_shop_units(self, date: datetime,
+                                imports: Iterable[Import]) -> None:
+        """
+        Inserts the new units and updates the existing ones,
+        categories keep their date and aggregates, offers take everything
+        """
+
+    @abstractmethod
+    async def update_aggregates(self, totals: Deltas, *,
+                                date: Optional[datetime] = None,
+                                parents: Iterable[UUID] = ()) -> None:
+        """
+        Adds the 'totals' to the aggregates of the units, if 'date'
+        is given, it's also set to all the 'parents', even if they
+        have no change
+        """
+
+    @abstractmethod
+    async def create_stat_units(self, ids: Iterable[UUID]) -> None:
+        """
+        Writes the current state of the units as their history,
+        to the partitions of the months of their dates, with
+        options.COMPACT_HISTORY only the changes of the state are stored
+        """
+
+    @abstractmethod
+    async def compact_history(self) -> Optional[str]:
+        """
+        Compacts the next month of the history written without
+        options.COMPACT_HISTORY, returns it, None if there is none left
+        """
+
+    @abstractmethod
+    async def drop_history(self, before: str) -> List[str]:
+        """
+        Drops the partitions of the history of the months
+        before the 'before' one as a whole, returns their months
+        """
+
+    @abstractmethod
+    async def add_tree_nodes(self,
+                             links: List[Tuple[UUID, Optional[UUID]]]
+                             ) -> None:
+        """
+        Links the new units to their parents, parents have to
+        either be linked already or go before their children in 'links'
+        """
+
+    @abstractmethod
+    async def move_tree_node(self, id: UUID,
+                             parent_id: Optional[UUID]) -> None:
+        """
+        Links the unit with all its descendants to the 'parent_id'
+        """
+
+    ### deletion ###
+
+    @abstractmethod
+    async def dead_units(self, ids: Iterable[UUID]) -> Dict[UUID, int]:
+        """
+        Finds which of the units are deleted, but not purged yet,
+        maps them to the keys of the roots of their deleted subtrees
+        """
+
+    @abstractmethod
+    async def bury_subtrees(self, ids: Iterable[UUID]) -> None:
+        """
+        Deletes the units with their descendants and their history,
+        they are no longer seen, but may be purged later
+        """
+
+    @abstractmethod
+    async def purge_subtree(self, key: int) -> None:
+        ...
+
+    @abstractmethod
+    async def purge_batch(self, size: int) -> bool:
+        """
+        Purges up to 'size' units of some deleted subtree,
+        returns False if there was nothing to purge
+        """
+
+    ### jobs ###
+
+    @abstractmethod
+    async def create_job(self, id: UUID, request: str) -> None:
+        ...
+
+    @abstractmethod
+    async def job(self, id: UUID) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def next_job(self) -> Optional[Any]:
+        """
+        The oldest job that is queued or was interrupted while running
+        """
+
+    @abstractmethod
+    async def set_job_status(self, id: UUID, status: JobStatus, *,
+                             error: Optional[str] = None) -> None:
+        ...
+
+    ### applied imports ###
+
+    @abstractmethod
+    async def applied_import(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def remember_import(self, key: str, applied: int, skipped: int,
+                              keep: int) -> None:
+        """
+        Remembers the import by its key, forgetting all but the 'keep' latest
+        """
+
+
+class Storage(ABC):
+    """
+    Where the units are kept, gives out the transactions
+    """
+
+    @abstractmethod
+    async def startup(self) -> None:
+        ...
+
+    @abstractmethod
+    async def shutdown(self) -> None:
+        ...
+
+    @abstractmethod
+    async def clear(self) -> None:
+        """
+        Forgets everything, only for the dev mode
+        """
+
+    @abstractmethod
+    def read_session(self) -> AsyncContextManager[Transaction]:
+        """
+        Transaction that never writes, it sees the last commit
+        """
+
+    @abstractmethod
+    def write_session(self) -> AsyncContextManager[Transaction]:
+        """
+        Transaction of the only writer at a time, it's committed on exit,
+        unless it raises, then it's rolled back
+        """
+
+
+def sqlite_storage() -> Storage:
+    from .database import SqliteStorage
+    return SqliteStorage()
+
+
+def memory_storage() -> Storage:
+    from .memory import MemoryStorage
+    return MemoryStorage()
+
+
+# imported when chosen, so the unused backend isn't even loaded
+BACKENDS: Dict[str, Callable[[], Storage]] = {
+    "sqlite": sqlite_storage,
+    "memory": memory_storage,
+}
+
+backend: Optional[Storage] = None
+
+
+def current() -> Storage:
+    if backend is None:
+        raise RuntimeError("Storage is used before the startup of the app")
+    return backend
+
+
+async def startup() -> None:
+    """
+    Starts the backend of options.STORAGE_BACKEND
+    """
+
+    global backend
+    if options.STORAGE_BACKEND not in BACKENDS:
+        raise ValueError(
+            f"Unknown storage backend {options.STORAGE_BACKEND!r},"
+            f" known are {', '.join(BACKENDS)}")
+
+    backend = BACKENDS[options.STORAGE_BACKEND]()
+    await backend.startup()
+
+
+async def shutdown() -> None:
+    global backend
+    if backend is not None:
+        await backend.shutdown()
+        backend = None
+
+
+def read_session() -> AsyncContextManager[Transaction]:
+    return current().read_session()
+
+
+def write_session() -> AsyncContextManager[Transaction]:
+    return current().write_session()
+
+
+async def get_read_db() -> AsyncGenerator[Transaction, None]:
+    async with read_session() as db:
+        yield db
+
+
+async def get_write_db() -> AsyncGenerator[Transaction, None]:
+    async with write_session() as db:
+        yield db
+
+
+read_db_injection = Depends(get_read_db)
+write_db_injection = Depends(get_write_db)
@@ -0,0 +1,58 @@
+"""
+Reading of the newline-delimited JSON (NDJSON) streams
+"""
+
+from typing import AsyncIterable, AsyncIterator, List, Set
+from uuid import UUID
+
+from pydantic import ValidationError
+
+from .exceptions import ValidationFailed
+from .schemas import Import
+
+
+async def lines(stream: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Splits the stream into the lines, skipping the blank ones,
+    only the current unfinished line is kept in memory
+    """
+
+    rest = b""
+    async for data in stream:
+        rest += data
+        *complete, rest = rest.split(b"\n")
+        for line in complete:
+            if line.strip():
+                yield line
+
+    if rest.strip():
+        yield rest
+
+
+async def import_chunks(stream: AsyncIterable[bytes],
+                        size: int) -> AsyncIterator[List[Import]]:
+    """
+    Parses every line as an Import and groups them into chunks of 'size',
+    raises ValidationFailed on the first invalid line
+    or the first 'id' repeated anywhere in the stream
+    """
+
+    seen: Set[UUID] = set()
+    chunk: List[Import] = []
+    async for line in lines(stream):
+        try:
+            item = Import.parse_raw(line)
+        except ValidationError as e:
+            raise ValidationFailed from e
+
+        if item.id in seen:
+            raise ValidationFailed
+        seen.add(item.id)
+        chunk.append(item)
+
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
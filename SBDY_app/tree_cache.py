@@ -0,0 +1,243 @@
+"""
+Resident cache of the catalog tree for /nodes (options.TREE_CACHE_BYTES),
+the commits of the imports and the deletions bring it up to date
+"""
+
+import sys
+from bisect import insort
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from . import options
+from .typedefs import ShopUnits
+
+
+Row = Dict[str, Any]
+# '_unique_id' and id of the child, so the children keep their order
+Child = Tuple[int, UUID]
+
+# bytes of a cached unit besides its row, which is measured:
+# its entries in the three dicts, its list of the children
+# and its item in the list of its parent
+UNIT_OVERHEAD = 3 * 100 + sys.getsizeof([]) + sys.getsizeof((0, None))
+
+
+def row_size(row: Row) -> int:
+    # the values are mostly small and unique, so they are counted too
+    return (sys.getsizeof(row) + sum(map(sys.getsizeof, row.values()))
+            + UNIT_OVERHEAD)
+
+
+class Changes:
+    """
+    Units changed by the transaction, the cache follows them on its commit,
+    the 'new' ones have no children but the other new ones,
+    the 'removed' ones are deleted with their subtrees
+    """
+
+    def __init__(self) -> None:
+        self.changed: Set[UUID] = set()
+        self.new: Set[UUID] = set()
+        self.removed: Set[UUID] = set()
+
+
+class TreeCache:
+    """
+    The fields of the units with their aggregates and the lists of their
+    children. A unit is cached only with its whole subtree, so /nodes of it
+    is answered without the storage, the subtree of the missed one
+    is loaded at once.
+
+    The commits update the cached units with their committed states,
+    every commit changes the version, so the subtree loaded before it
+    isn't cached after it. The least recently requested subtrees
+    are evicted, with their ancestors, when it's over the budget
+    """
+
+    def __init__(self) -> None:
+        self.version = 0
+        self.clear()
+
+    def clear(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.units: Dict[UUID, Row] = {}
+        self.children: Dict[UUID, List[Child]] = {}
+        self.sizes: Dict[UUID, int] = {}
+        self.size = 0
+        # the requested units and the roots of the cached subtrees,
+        # the least recently requested first
+        self.recent: Dict[UUID, None] = OrderedDict()
+        self.version += 1
+
+    @property
+    def enabled(self) -> bool:
+        return options.TREE_CACHE_BYTES > 0
+
+    def counters(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "units": len(self.units),
+                "bytes": self.size, "budget": options.TREE_CACHE_BYTES}
+
+    ### reads ###
+
+    async def shop_unit(self, id: UUID, db: Any) -> Optional[ShopUnits]:
+        """
+        The unit with all its descendants as 'Transaction.shop_unit'
+        gives them, from the cache if it has the unit, otherwise
+        from the transaction 'db', and then they are cached
+        """
+
+        if not self.enabled:
+            return await db.shop_unit(id)
+
+        if id in self.units:
+            self.hits += 1
+            self.touch(id)
+            return self.subtree(id)
+
+        self.misses += 1
+        version = self.version
+        units = await db.shop_unit(id)
+        # a commit in between could have changed them
+        if units is not None and version == self.version:
+            self.fill(id, units)
+        return units
+
+    def subtree(self, id: UUID) -> ShopUnits:
+        # the new objects, so the callers can't change the cached ones
+        units: ShopUnits = {id: SimpleNamespace(**self.units[id])}
+        stack = [id]
+        while stack:
+            parent = units[stack.pop()]
+            parent.children = []
+            for _, child_id in self.children[parent.id]:
+                child = units[child_id] = SimpleNamespace(
+                    **self.units[child_id])
+                parent.children.append(child)
+                stack.append(child_id)
+        return units
+
+    def touch(self, id: UUID) -> None:
+        self.recent[id] = None
+        self.recent.move_to_end(id)  # type: ignore
+
+    def fill(self, id: UUID, units: ShopUnits) -> None:
+        for unit in units.values():
+            self.put(unit, [(child._unique_id, child.id)
+                            for child in unit.children])
+        self.touch(id)
+        self.shrink()
+
+    ### changes ###
+
+    def put(self, unit: Any, children: Optional[List[Child]] = None) -> None:
+        # the children are kept, if they aren't given
+        row = {name: value for name, value in vars(unit).items()
+               if name != "children"}
+        self.size += row_size(row) - self.sizes.get(unit.id, 0)
+        self.sizes[unit.id] = row_size(row)
+        self.units[unit.id] = row
+        if children is not None:
+            self.children[unit.id] = sorted(children)
+
+    def drop(self, id: UUID) -> None:
+        # only the unit, its children stay as they are
+        del self.units[id], self.children[id]
+        self.size -= self.sizes.pop(id)
+        self.recent.pop(id, None)
+
+    def unlink(self, id: UUID) -> None:
+        row = self.units[id]
+        children = self.children.get(row["parentId"], None)
+        if children is not None:
+            children.remove((row["_unique_id"], id))
+
+    def remove_subtree(self, id: UUID) -> None:
+        stack = [id]
+        while stack:
+            current = stack.pop()
+            stack.extend(child_id for _, child_id in self.children[current])
+            self.drop(current)
+
+    def remove_path(self, id: Optional[UUID]) -> None:
+        """
+        Removes the unit and its ancestors, as their subtrees aren't
+        cached whole anymore, their other children become the roots
+        """
+
+        while id is not None and id in self.units:
+            parent_id = self.units[id]["parentId"]
+            for _, child_id in self.children[id]:
+                if child_id in self.units:
+                    self.recent[child_id] = None
+                    self.recent.move_to_end(child_id,  # type: ignore
+                                            last=False)
+            self.drop(id)
+            id = parent_id
+
+    def evict(self, id: UUID) -> None:
+        parent_id = self.units[id]["parentId"]
+        self.remove_subtree(id)
+        self.remove_path(parent_id)
+        self.evictions += 1
+
+    def shrink(self) -> None:
+        while self.size > options.TREE_CACHE_BYTES and self.recent:
+            id, _ = self.recent.popitem(last=False)  # type: ignore
+            if id in self.units:
+                self.evict(id)
+
+    def apply(self, changes: Changes, units: ShopUnits) -> None:
+        """
+        Brings the cached units up to the committed 'units',
+        the states of the changed ones that are still there
+        """
+
+        self.version += 1
+
+        for id in changes.removed:
+            if id in self.units:
+                self.unlink(id)
+                self.remove_subtree(id)
+
+        # the units that are new or change their parent
+        linked: List[Any] = []
+        for id in changes.changed:
+            unit = units.get(id, None)
+            row = self.units.get(id, None)
+            if unit is None:
+                # deleted, or not created at all
+                if row is not None:
+                    self.unlink(id)
+                    self.remove_subtree(id)
+            elif row is not None and row["parentId"] == unit.parentId:
+                self.put(unit)
+            elif row is not None:
+                self.unlink(id)
+                self.put(unit)
+                linked.append(unit)
+            elif id in changes.new:
+                self.put(unit, [])
+                linked.append(unit)
+            else:
+                # its subtree isn't cached, the new parent can't have it
+                linked.append(unit)
+
+        for unit in linked:
+            parent_id = unit.parentId
+            if parent_id not in self.units:
+                if unit.id in self.units:
+                    self.touch(unit.id)
+            elif unit.id in self.units:
+                insort(self.children[parent_id], (unit._unique_id, unit.id))
+            else:
+                self.remove_path(parent_id)
+
+        self.shrink()
+
+
+cache = TreeCache()
@@ -1,10 +1,13 @@
-from typing import TYPE_CHECKING, Any, Callable, Dict, Type, TypeVar
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple, Type,
+                    TypeVar)
 from uuid import UUID
 
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession as DB
 
 if TYPE_CHECKING:
+    from sqlalchemy.engine import Row
+
     from .models import ShopUnit
 
 
@@ -12,3 +15,6 @@ AnyCallable = Callable[..., Any]
 BaseModelT = TypeVar("BaseModelT", bound=Type[BaseModel])
 T = TypeVar("T", bound=Any)
 ShopUnits = Dict[UUID, "ShopUnit"]
+ShopUnitStates = Dict[UUID, "Row"]  # plain rows with some of the columns
+Links = Dict[UUID, Optional[UUID]]  # id -> parentId
+Deltas = Dict[UUID, Tuple[int, int]]  # price and sub offers count
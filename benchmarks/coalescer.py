@@ -0,0 +1,62 @@
+"""
+Throughput of concurrent importers, with and without the group commit,
+drives the handlers of the app in the dev mode, so it resets its database
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from SBDY_app import app, options
+from SBDY_app.app import commit_import
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import run
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--importers", type=int, nargs="+", default=[1, 8, 64])
+parser.add_argument("--requests", type=int, default=512,
+                    help="total number of imports for every run")
+parser.add_argument("--items", type=int, default=5,
+                    help="number of offers in every import")
+
+
+async def importers(count: int, requests: int, items: int) -> float:
+    root = Import(id=uuid4(), name="root", type=ShopUnitType.CATEGORY)
+    await commit_import(
+        ImpRequest(items=[root], updateDate=datetime(2022, 6, 22)))
+
+    async def importer(number: int) -> None:
+        for i in range(number, requests, count):
+            await commit_import(ImpRequest(items=[
+                Import(id=uuid4(), name="offer", parentId=root.id,
+                       type=ShopUnitType.OFFER, price=random.randint(0, 100))
+                for _ in range(items)
+            ], updateDate=datetime(2022, 6, 22) + timedelta(seconds=i)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(importer(i) for i in range(count)))
+    return requests / (time.perf_counter() - start)
+
+
+async def main() -> None:
+    args = parser.parse_args()
+    options.DEV_MODE = True
+
+    for coalesce in (False, True):
+        options.COALESCE_IMPORTS = coalesce
+        for count in args.importers:
+            await app.router.startup()
+            rate = await importers(count, args.requests, args.items)
+            await app.router.shutdown()
+
+            name = f"{'coalesced' if coalesce else 'separate'}, {count}"
+            print(f"{name:<20} {rate:9.1f} imports/s")
+
+
+if __name__ == "__main__":
+    run(main)
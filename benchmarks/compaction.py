@@ -0,0 +1,130 @@
+"""
+History that only stores the changes of the states vs the full one,
+its size, the imports and the range reads, and the compaction
+of the full history, drives the handlers of the app in the dev mode,
+so it resets its database
+"""
+
+import argparse
+import random
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import Any, List, Tuple
+from uuid import UUID, uuid4
+
+from SBDY_app import app, options
+from SBDY_app.app import commit_import, statistic
+from SBDY_app.compaction import compact_month
+from SBDY_app.database import DATABASE_URL
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+from SBDY_app.storage import get_read_db
+
+from utils import report, report_latency, run
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--categories", type=int, default=10)
+parser.add_argument("--offers", type=int, default=10,
+                    help="number of offers in every category")
+parser.add_argument("--imports", type=int, default=2000)
+parser.add_argument("--changes", type=float, default=0.1,
+                    help="share of the imports that change the prices,"
+                         " the rest only rename an offer")
+parser.add_argument("--repeat", type=int, default=200)
+
+START = datetime(2022, 6, 1)
+
+
+def stored_history() -> str:
+    # runs and marks of all the partitions, and the bytes of them
+    # with their indexes, needs SQLite with dbstat
+    path = DATABASE_URL.split("///", 1)[1]
+    with closing(sqlite3.connect(path)) as conn:
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master"
+            " WHERE type = 'table' AND name LIKE 'stat_%'")]
+        counts = {table: conn.execute(f"SELECT count(*) FROM {table}")
+                  .fetchone()[0] for table in tables}
+        size, = conn.execute(
+            "SELECT sum(pgsize) FROM dbstat"
+            " WHERE name LIKE 'stat_%' OR name LIKE 'ix_stat_%'").fetchone()
+    marks = sum(count for table, count in counts.items()
+                if table.endswith("_marks"))
+    return (f"{sum(counts.values()) - marks:>8} runs + {marks:>8} marks,"
+            f" {size / 1024:8.0f} KiB")
+
+
+async def latencies(repeat: int, id: UUID, *dates: datetime) -> List[float]:
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        async for db in get_read_db():
+            await statistic(id, *dates, db=db)
+        result.append(time.perf_counter() - start)
+    return result
+
+
+async def import_history(args: argparse.Namespace) -> Tuple[Import, float]:
+    root = Import(id=uuid4(), name="root", type=ShopUnitType.CATEGORY)
+    categories = [Import(id=uuid4(), name="category", parentId=root.id,
+                         type=ShopUnitType.CATEGORY)
+                  for _ in range(args.categories)]
+    offers = [Import(id=uuid4(), name="offer", parentId=category.id,
+                     type=ShopUnitType.OFFER, price=100)
+              for category in categories for _ in range(args.offers)]
+    await commit_import(ImpRequest(items=[root, *categories, *offers],
+                                   updateDate=START))
+
+    # the same imports in every mode
+    random.seed(69)
+    step = timedelta(days=60) / args.imports
+    start = time.perf_counter()
+    for number in range(1, args.imports + 1):
+        offer = random.choice(offers)
+        update: Any = {"name": f"offer {number}"}
+        if random.random() < args.changes:
+            update["price"] = random.randint(0, 200)
+        await commit_import(ImpRequest(items=[offer.copy(update=update)],
+                                       updateDate=START + step * number))
+    return root, time.perf_counter() - start
+
+
+async def main() -> None:
+    args = parser.parse_args()
+    options.DEV_MODE = True
+    options.STORAGE_BACKEND = "sqlite"
+
+    for compact in (False, True):
+        options.COMPACT_HISTORY = compact
+        name = "compact" if compact else "full"
+        await app.router.startup()
+
+        root, elapsed = await import_history(args)
+        print(f"{name:<9} {stored_history()},"
+              f" imports {elapsed / args.imports * 1000:7.3f} ms each")
+
+        report_latency(f"{name} /node/{{id}}/statistic (a day)",
+                       await latencies(args.repeat, root.id,
+                                       START + timedelta(days=30),
+                                       START + timedelta(days=31)))
+        report_latency(f"{name} /node/{{id}}/statistic (all)",
+                       await latencies(args.repeat // 10, root.id))
+
+        if not compact:
+            # what the compactor does on the next start
+            timings = []
+            while True:
+                start = time.perf_counter()
+                if await compact_month() is None:
+                    break
+                timings.append(time.perf_counter() - start)
+            report("compaction of a month", timings)
+            print(f"compacted {stored_history()}")
+
+        await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,92 @@
+"""
+Range reads of the history partitioned by months and the retention
+that drops the oldest of them,
+drives the handlers of the app in the dev mode, so it resets its database
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+from typing import Any, List
+from uuid import UUID, uuid4
+
+from SBDY_app import app, options
+from SBDY_app.app import commit_import, statistic
+from SBDY_app.retention import expire_history, first_kept_month
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+from SBDY_app.storage import get_read_db
+
+from utils import report, report_latency, run
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--months", type=int, default=24)
+parser.add_argument("--imports", type=int, default=20,
+                    help="number of imports in every month")
+parser.add_argument("--offers", type=int, default=100,
+                    help="number of offers changed by every import")
+parser.add_argument("--repeat", type=int, default=500)
+parser.add_argument("--storage", choices=["sqlite", "memory"],
+                    default="sqlite", help="storage backend of the app")
+
+
+async def latencies(repeat: int, id: UUID, *dates: datetime) -> List[float]:
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        async for db in get_read_db():
+            await statistic(id, *dates, db=db)
+        result.append(time.perf_counter() - start)
+    return result
+
+
+async def main() -> None:
+    args = parser.parse_args()
+    options.DEV_MODE = True
+    options.STORAGE_BACKEND = args.storage
+    await app.router.startup()
+
+    # the months before the current one, so the retention can drop them
+    now = datetime.utcnow()
+    months = [datetime.strptime(first_kept_month(now, ago), "%Y_%m")
+              for ago in range(args.months, 0, -1)]
+
+    category = Import(id=uuid4(), name="category",
+                      type=ShopUnitType.CATEGORY)
+    offers = [Import(id=uuid4(), name="offer", parentId=category.id,
+                     type=ShopUnitType.OFFER, price=0)
+              for _ in range(args.offers)]
+    await commit_import(ImpRequest(items=[category] + offers,
+                                   updateDate=months[0]))
+
+    step = timedelta(days=28) / args.imports
+    for month in months:
+        for number in range(args.imports):
+            date = month + step * number
+            items: List[Any] = [offer.copy(update={"price": number})
+                                for offer in offers]
+            await commit_import(ImpRequest(items=items, updateDate=date))
+    rows = (args.months * args.imports + 1) * (args.offers + 1)
+    print(f"{rows} rows of the history in {args.months} months")
+
+    report_latency("/node/{id}/statistic (a day)", await latencies(
+        args.repeat, category.id, date - timedelta(days=1), date))
+    report_latency("/node/{id}/statistic (a month)", await latencies(
+        args.repeat, category.id, date - timedelta(days=31), date))
+    report_latency("/node/{id}/statistic (all)", await latencies(
+        args.repeat // 10, category.id))
+
+    # a month at a time, the oldest one first
+    timings = []
+    for keep in range(args.months, args.months // 2, -1):
+        options.HISTORY_RETENTION_MONTHS = keep - 1
+        start = time.perf_counter()
+        assert len(await expire_history()) == 1
+        timings.append(time.perf_counter() - start)
+    report("retention of a month", timings)
+
+    await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,115 @@
+"""
+Latency of the reads while the imports are written, with and without WAL,
+drives the handlers of the app in the dev mode, so it resets its database
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+from typing import List
+from uuid import UUID, uuid4
+
+from SBDY_app import app, options
+from SBDY_app.app import commit_import, nodes, statistic
+from SBDY_app.storage import get_read_db
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import report_latency, run
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--readers", type=int, default=16)
+parser.add_argument("--writers", type=int, default=4)
+parser.add_argument("--seconds", type=float, default=5)
+parser.add_argument("--categories", type=int, default=20)
+parser.add_argument("--offers", type=int, default=50,
+                    help="number of offers in every category")
+
+START = datetime(2022, 6, 22)
+
+
+async def fill(categories: int, offers: int) -> List[Import]:
+    root = Import(id=uuid4(), name="root", type=ShopUnitType.CATEGORY)
+    items = [root]
+    for _ in range(categories):
+        category = Import(id=uuid4(), name="category", parentId=root.id,
+                          type=ShopUnitType.CATEGORY)
+        items.append(category)
+        items.extend(Import(id=uuid4(), name="offer", parentId=category.id,
+                            type=ShopUnitType.OFFER, price=42)
+                     for _ in range(offers))
+    await commit_import(ImpRequest(items=items, updateDate=START))
+    return items
+
+
+async def read_node(id: UUID) -> None:
+    async for db in get_read_db():
+        await nodes(id, db)
+
+
+async def read_statistic(id: UUID) -> None:
+    async for db in get_read_db():
+        await statistic(id, db=db)
+
+
+async def mixed_load(args: argparse.Namespace) -> None:
+    items = await fill(args.categories, args.offers)
+    categories = [i for i in items[1:] if i.type == ShopUnitType.CATEGORY]
+    offers = [i for i in items if i.type == ShopUnitType.OFFER]
+
+    deadline = time.perf_counter() + args.seconds
+    latencies: List[float] = []
+    imports, errors = 0, 0
+
+    async def reader(rng: random.Random) -> None:
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            if rng.random() < 0.5:
+                read = read_node(rng.choice(categories).id)
+            else:
+                read = read_statistic(rng.choice(offers).id)
+            start = time.perf_counter()
+            try:
+                await read
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    async def writer(rng: random.Random) -> None:
+        nonlocal imports, errors
+        while time.perf_counter() < deadline:
+            changed = [offer.copy(update={"price": rng.randint(0, 100)})
+                       for offer in rng.sample(offers, 10)]
+            date = START + timedelta(seconds=imports + 1)
+            try:
+                await commit_import(ImpRequest(items=changed,
+                                               updateDate=date))
+                imports += 1
+            except Exception:
+                errors += 1
+
+    await asyncio.gather(
+        *(reader(random.Random(i)) for i in range(args.readers)),
+        *(writer(random.Random(-i)) for i in range(1, args.writers + 1)))
+
+    name = f"{'WAL' if options.WAL_MODE else 'rollback journal'}"
+    report_latency(f"{name}: reads", latencies)
+    print(f"{name:<40} {len(latencies) / args.seconds:9.1f} reads/s"
+          f" | {imports / args.seconds:9.1f} imports/s | {errors} errors")
+
+
+async def main() -> None:
+    args = parser.parse_args()
+    options.DEV_MODE = True
+
+    for wal in (False, True):
+        options.WAL_MODE = wal
+        await app.router.startup()
+        await mixed_load(args)
+        await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    run(main)
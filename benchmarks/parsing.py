@@ -0,0 +1,66 @@
+"""
+Stalls of the event loop while a big import is parsed:
+parsing on the event loop against parsing in the worker processes,
+the stall is how late a ticker that should wake up every millisecond is
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import List
+from uuid import uuid4
+
+from SBDY_app import options, parsing
+
+from utils import report, run
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--items", type=int, default=50_000)
+parser.add_argument("--processes", type=int, default=2)
+parser.add_argument("--repeat", type=int, default=5)
+
+
+def big_import(items: int) -> bytes:
+    root = {"id": str(uuid4()), "name": "root", "type": "CATEGORY"}
+    return json.dumps({"items": [root] + [
+        {"id": str(uuid4()), "name": "offer", "parentId": root["id"],
+         "type": "OFFER", "price": random.randint(0, 10**5)}
+        for _ in range(items)
+    ], "updateDate": "2022-06-22T00:00:00.000Z"}).encode("utf-8")
+
+
+async def stalls(body: bytes, repeat: int) -> List[float]:
+    result = []
+    for _ in range(repeat):
+        stall = 0.0
+        parse = asyncio.create_task(parsing.parse_import(body))
+        while not parse.done():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stall = max(stall, time.perf_counter() - start - 0.001)
+        await parse
+        result.append(stall)
+    return result
+
+
+async def main() -> None:
+    args = parser.parse_args()
+
+    body = big_import(args.items)
+    print(f"{args.items} items, {len(body) / 2**20:.1f} MiB")
+
+    options.PARSE_IN_PROCESS_SIZE = 0
+    options.PARSE_PROCESSES = 0
+    report("worst stall, on the event loop", await stalls(body, args.repeat))
+
+    options.PARSE_PROCESSES = args.processes
+    await parsing.parse_import(body)  # start up the workers
+    report("worst stall, in the workers", await stalls(body, args.repeat))
+    parsing.shutdown()
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,79 @@
+"""
+Latency of the GET handlers one after another, without the HTTP layer,
+drives the handlers of the app in the dev mode, so it resets its database
+"""
+
+import argparse
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, List
+from uuid import uuid4
+
+from SBDY_app import app, options, tree_cache
+from SBDY_app.app import commit_import, nodes, sales, statistic
+from SBDY_app.storage import get_read_db
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import report_latency, run
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--repeat", type=int, default=2000)
+parser.add_argument("--categories", type=int, default=20)
+parser.add_argument("--offers", type=int, default=50,
+                    help="number of offers in every category")
+parser.add_argument("--storage", choices=["sqlite", "memory"],
+                    default="sqlite", help="storage backend of the app")
+parser.add_argument("--tree-cache-bytes", type=int, default=0,
+                    help="budget of the tree cache of /nodes, 0 is none")
+
+DATE = datetime(2022, 6, 22)
+
+
+async def latencies(handler: Callable[..., Awaitable[Any]],
+                    repeat: int, *args: Any) -> List[float]:
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        async for db in get_read_db():
+            await handler(*args, db=db)
+        result.append(time.perf_counter() - start)
+    return result
+
+
+async def main() -> None:
+    args = parser.parse_args()
+    options.DEV_MODE = True
+    options.STORAGE_BACKEND = args.storage
+    options.TREE_CACHE_BYTES = args.tree_cache_bytes
+    await app.router.startup()
+
+    root = Import(id=uuid4(), name="root", type=ShopUnitType.CATEGORY)
+    items = [root]
+    for _ in range(args.categories):
+        category = Import(id=uuid4(), name="category", parentId=root.id,
+                          type=ShopUnitType.CATEGORY)
+        items.append(category)
+        items.extend(Import(id=uuid4(), name="offer", parentId=category.id,
+                            type=ShopUnitType.OFFER, price=42)
+                     for _ in range(args.offers))
+    await commit_import(ImpRequest(items=items, updateDate=DATE))
+
+    report_latency("/nodes of the root",
+                   await latencies(nodes, args.repeat // 20, root.id))
+    report_latency("/nodes of a category",
+                   await latencies(nodes, args.repeat, items[1].id))
+    report_latency("/nodes of an offer",
+                   await latencies(nodes, args.repeat, items[2].id))
+    report_latency("/node/{id}/statistic",
+                   await latencies(statistic, args.repeat, items[2].id))
+    report_latency("/sales (every offer)",
+                   await latencies(sales, args.repeat // 20, DATE))
+    if options.TREE_CACHE_BYTES:
+        print(f"tree cache {tree_cache.cache.counters()}")
+
+    await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,80 @@
+"""
+Startup of the app after a crash, the snapshot of the memory storage
+plus the tail of the event log vs the whole log replayed,
+drives the handlers of the app in the dev mode, so it resets its database
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from SBDY_app import app, options
+from SBDY_app.app import commit_import
+from SBDY_app.memory import SNAPSHOT_PATH
+from SBDY_app.replay import replay
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import run
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--imports", type=int, default=2000,
+                    help="number of imports in the log")
+parser.add_argument("--items", type=int, default=10,
+                    help="number of offers in every import")
+parser.add_argument("--tails", type=int, nargs="+", default=[10, 100, 1000],
+                    help="numbers of the imports after the snapshot")
+
+
+async def import_offers(parent: Import, number: int, items: int) -> None:
+    await commit_import(ImpRequest(items=[
+        Import(id=uuid4(), name="offer", parentId=parent.id,
+               type=ShopUnitType.OFFER, price=number % 100)
+        for _ in range(items)
+    ], updateDate=datetime(2022, 6, 22) + timedelta(seconds=number)))
+
+
+async def main() -> None:
+    args = parser.parse_args()
+    options.STORAGE_BACKEND = "memory"
+
+    for tail in args.tails:
+        options.DEV_MODE = True
+        await app.router.startup()
+        # kept from now on, the snapshot is written on shutdown
+        options.DEV_MODE = False
+
+        root = Import(id=uuid4(), name="root", type=ShopUnitType.CATEGORY)
+        await commit_import(
+            ImpRequest(items=[root], updateDate=datetime(2022, 6, 22)))
+        for number in range(args.imports - tail):
+            await import_offers(root, number, args.items)
+        await app.router.shutdown()
+        snapshot = SNAPSHOT_PATH.read_bytes()
+
+        await app.router.startup()
+        for number in range(args.imports - tail, args.imports):
+            await import_offers(root, number, args.items)
+        await app.router.shutdown()
+
+        # as if it crashed before the snapshot of the tail
+        SNAPSHOT_PATH.write_bytes(snapshot)
+        start = time.perf_counter()
+        await app.router.startup()
+        elapsed = time.perf_counter() - start
+        await app.router.shutdown()
+        print(f"snapshot + tail of {tail:<6} {elapsed * 1000:9.1f} ms")
+
+    start = time.perf_counter()
+    await replay(rebuild=True)
+    elapsed = time.perf_counter() - start
+    print(f"whole log of {args.imports + 1:<11} {elapsed * 1000:9.1f} ms")
+
+    options.DEV_MODE = True
+    await app.router.startup()
+    await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,64 @@
+"""
+Subtree and ancestor chain lookups:
+the closure table (tree) against the recursive CTE,
+with the sizes of the tables and indexes they use
+"""
+
+import argparse
+
+from SBDY_app import crud
+from SBDY_app.crud import Query
+from SBDY_app.schemas import ShopUnitType
+
+from utils import (catalog, fill, measure, report, run, storage_sizes,
+                   temporary_db)
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--depth", type=int, default=12)
+parser.add_argument("--fanout", type=int, default=2)
+parser.add_argument("--offers", type=int, default=4)
+parser.add_argument("--repeat", type=int, default=20)
+
+
+async def main() -> None:
+    args = parser.parse_args()
+
+    rows = catalog(args.depth, args.fanout, args.offers)
+    root = rows[0]["id"]
+    middle = next(row["id"] for row in rows[len(rows) // 2:]
+                  if row["type"] == ShopUnitType.CATEGORY)
+    leaf = rows[-1]["id"]
+    print(f"{len(rows)} units, depth {args.depth}")
+
+    async with temporary_db() as db:
+        await fill(db, rows)
+
+        for name, size in (await storage_sizes(db)).items():
+            print(f"{name:<40} {size / 1024:9.0f} KiB")
+
+        cases = {
+            "subtree of the root": (Query.get_children, root),
+            "subtree of a middle category": (Query.get_children, middle),
+            "ancestors of a leaf": (Query.get_parents, leaf),
+        }
+        recursive = {
+            Query.get_children: Query.get_children_recursive,
+            Query.get_parents: Query.get_parents_recursive,
+        }
+
+        for name, (query, id) in cases.items():
+            for label, build in (("tree", query),
+                                 ("cte", recursive[query])):
+                selection = build(Query.shop_units([id]))
+
+                async def fetch():
+                    await crud.fetch_all(db, selection)
+                    db.expunge_all()
+
+                report(f"{label}: {name}",
+                       await measure(fetch, args.repeat))
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,70 @@
+"""
+Ancestor aggregation of an import with a lot of offers under deep categories:
+the batched bottom-up pass against the walk up the chain for every offer
+"""
+
+import argparse
+import random
+from types import SimpleNamespace
+from typing import Optional
+from uuid import UUID
+
+from SBDY_app.app import add_delta, update_parents
+from SBDY_app.schemas import ShopUnitType
+from SBDY_app.typedefs import Deltas, ShopUnits
+
+from utils import catalog, clock, report, setup
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--depth", type=int, default=12)
+parser.add_argument("--offers", type=int, default=10_000)
+parser.add_argument("--repeat", type=int, default=10)
+
+
+def update_parents_per_offer(parents: ShopUnits, parent_id: Optional[UUID],
+                             diff: int, count: int = 0) -> None:
+    # the way it was done before, one walk for every offer
+    while parent_id is not None:
+        parent = parents[parent_id]
+        parent.price += diff
+        parent.sub_offers_count += count
+        parent_id = parent.parentId
+
+
+def main() -> None:
+    args = parser.parse_args()
+
+    # a chain of categories with the offers spread among them
+    rows = catalog(args.depth, fanout=1, offers=0)
+    categories = [row["id"] for row in rows]
+    offers = [(random.choice(categories), random.randint(0, 10**5))
+              for _ in range(args.offers)]
+    print(f"{len(offers)} offers, depth {args.depth}")
+
+    def parents() -> ShopUnits:
+        return {row["id"]: SimpleNamespace(**row) for row in rows
+                if row["type"] == ShopUnitType.CATEGORY}  # type: ignore
+
+    def per_offer():
+        units = parents()
+        for parent_id, price in offers:
+            update_parents_per_offer(units, parent_id, price, count=1)
+
+    def batched():
+        units = parents()
+        links = {id: unit.parentId for id, unit in units.items()}
+        deltas: Deltas = {}
+        for parent_id, price in offers:
+            add_delta(deltas, parent_id, price, count=1)
+        for id, (diff, count) in update_parents(links, deltas).items():
+            units[id].price += diff
+            units[id].sub_offers_count += count
+
+    report("per offer", clock(per_offer, args.repeat))
+    report("batched", clock(batched, args.repeat))
+
+
+if __name__ == "__main__":
+    setup()
+    main()
@@ -0,0 +1,148 @@
+"""
+Things that simplify the benchmarking process and help with it
+"""
+
+from __future__ import annotations
+
+import asyncio
+import random
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+from statistics import mean, median
+from typing import (Any, AsyncGenerator, Awaitable, Callable, Dict, List,
+                    Optional)
+from uuid import UUID, uuid4
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+from SBDY_app import crud
+from SBDY_app.models import Base, ShopUnit
+from SBDY_app.schemas import ShopUnitType
+from SBDY_app.typedefs import DB
+
+
+def setup() -> None:
+    random.seed(69)
+
+
+### database ###
+
+@asynccontextmanager
+async def temporary_db() -> AsyncGenerator[DB, None]:
+    with tempfile.TemporaryDirectory() as folder:
+        url = f"sqlite+aiosqlite:///{Path(folder) / 'bench.db'}"
+        engine = create_async_engine(url, future=True)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)  # type: ignore
+
+        Session = sessionmaker(bind=engine, class_=DB,
+                               expire_on_commit=False)
+        async with Session() as db:
+            yield db
+        await engine.dispose()
+
+
+async def storage_sizes(db: DB) -> Dict[str, int]:
+    # bytes taken by every table and index, needs SQLite with dbstat
+    result = await db.execute(text(
+        "SELECT name, sum(pgsize) FROM dbstat GROUP BY name ORDER BY name"))
+    return dict(result.all())  # type: ignore
+
+
+### catalog ###
+
+def catalog(depth: int, fanout: int, offers: int,
+            date: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """
+    Rows for a tree of categories 'depth' levels deep,
+    each category has 'fanout' subcategories and 'offers' offers
+    """
+
+    if date is None:
+        date = datetime(2022, 6, 22)
+
+    rows: List[Dict[str, Any]] = []
+
+    def unit(parent_id: Optional[UUID], tp: ShopUnitType) -> UUID:
+        id = uuid4()
+        rows.append({
+            "id": id, "parentId": parent_id, "name": str(id)[:8],
+            "type": tp, "price": 0, "sub_offers_count": 0, "date": date})
+        return id
+
+    level = [unit(None, ShopUnitType.CATEGORY)]
+    for _ in range(depth):
+        next_level = []
+        for parent_id in level:
+            for _ in range(offers):
+                unit(parent_id, ShopUnitType.OFFER)
+                rows[-1]["price"] = random.randint(0, 10**5)
+            for _ in range(fanout):
+                next_level.append(unit(parent_id, ShopUnitType.CATEGORY))
+        level = next_level
+
+    # keep the aggregates of the categories consistent
+    by_id = {row["id"]: row for row in rows}
+    for row in rows:
+        if row["type"] != ShopUnitType.OFFER:
+            continue
+        parent = by_id.get(row["parentId"], None)
+        while parent is not None:
+            parent["price"] += row["price"]
+            parent["sub_offers_count"] += 1
+            parent = by_id.get(parent["parentId"], None)
+
+    return rows
+
+
+async def fill(db: DB, rows: List[Dict[str, Any]]) -> None:
+    await db.execute(insert(ShopUnit), rows)
+    await crud.rebuild_tree(db)
+    await db.commit()
+
+
+### timing ###
+
+async def measure(func: Callable[[], Awaitable[Any]],
+                  repeat: int = 10) -> List[float]:
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        result.append(time.perf_counter() - start)
+    return result
+
+
+def clock(func: Callable[[], Any], repeat: int = 10) -> List[float]:
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        result.append(time.perf_counter() - start)
+    return result
+
+
+def report(name: str, timings: List[float]) -> None:
+    print(f"{name:<40} median {median(timings) * 1000:9.3f} ms"
+          f" | mean {mean(timings) * 1000:9.3f} ms"
+          f" | min {min(timings) * 1000:9.3f} ms")
+
+
+def report_latency(name: str, timings: List[float]) -> None:
+    ordered = sorted(timings)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+    print(f"{name:<40} p50 {percentile(0.5):9.3f} ms"
+          f" | p99 {percentile(0.99):9.3f} ms"
+          f" | count {len(ordered)}")
+
+
+def run(main: Callable[[], Awaitable[None]]) -> None:
+    setup()
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+from uuid import uuid4
+
+import pytest
+from SBDY_app import options
+from SBDY_app.app import compactor
+from SBDY_app.database import DATABASE_URL
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import (Client, default, do_test, generate_client, setup,
+                   sqlite_only)
+
+setup()
+
+CATEGORY = Import(id=uuid4(), name="category", type=ShopUnitType.CATEGORY)
+CATEGORY.price = None
+FIRST = Import(id=uuid4(), name="first", parentId=CATEGORY.id,
+               type=ShopUnitType.OFFER, price=10)
+SECOND = Import(id=uuid4(), name="second", parentId=CATEGORY.id,
+                type=ShopUnitType.OFFER, price=20)
+
+START = datetime(2022, 6, 30, 22)
+HOUR = timedelta(hours=1)
+
+# the imports an hour after each other, over the end of June,
+# the category keeps its price through most of them
+IMPORTS: List[List[Import]] = [
+    [CATEGORY, FIRST, SECOND],
+    [FIRST.copy(update={"price": 20}), SECOND.copy(update={"price": 10})],
+    [FIRST.copy(update={"price": 20})],
+    [FIRST.copy(update={"price": 20})],
+    [SECOND.copy(update={"name": "renamed", "price": 10})],
+    [FIRST.copy(update={"price": 30})],
+    [FIRST.copy(update={"price": 20})],
+    [SECOND.copy(update={"parentId": None, "price": 10})],
+]
+
+
+def import_history(client: Client) -> None:
+    for number, items in enumerate(IMPORTS):
+        data = default(ImpRequest, items=items,
+                       updateDate=START + HOUR * number)
+        response = client.imports(data.json())
+        assert response.status_code == 200
+
+
+def histories(client: Client) -> List[Any]:
+    ranges: List[Tuple[Any, ...]] = [
+        (), (START, START + HOUR * 3), (START + HOUR * 3, START + HOUR * 7)]
+    result = []
+    for id in (CATEGORY.id, FIRST.id, SECOND.id):
+        for dates in ranges:
+            response = client.stats(id, *dates)
+            assert response.status_code == 200
+            result.append(response.json())
+    return result
+
+
+def stored_rows() -> Dict[str, int]:
+    path = DATABASE_URL.split("///", 1)[1]
+    with closing(sqlite3.connect(path)) as conn:
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master"
+            " WHERE type = 'table' AND name LIKE 'stat_%'")]
+        return {table: conn.execute(f"SELECT count(*) FROM {table}")
+                .fetchone()[0] for table in tables}
+
+
+def full_history(monkeypatch: pytest.MonkeyPatch) -> List[Any]:
+    monkeypatch.setattr(options, "DEV_MODE", True)
+    monkeypatch.setattr(options, "COMPACT_HISTORY", False)
+    with generate_client() as client:
+        import_history(client)
+        return histories(client)
+
+
+def wait_for_compaction() -> None:
+    deadline = time.monotonic() + 10
+    while compactor.worker is not None and not compactor.worker.done():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_compact_writes(monkeypatch: pytest.MonkeyPatch):
+    expected = full_history(monkeypatch)
+
+    monkeypatch.setattr(options, "COMPACT_HISTORY", True)
+    with generate_client() as client:
+        import_history(client)
+        assert histories(client) == expected
+
+
+def test_compaction(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(options, "DEV_MODE", True)
+    with generate_client() as client:
+        import_history(client)
+        expected = histories(client)
+        # kept for the next start
+        monkeypatch.setattr(options, "DEV_MODE", False)
+
+    monkeypatch.setattr(options, "COMPACT_HISTORY", True)
+    with generate_client() as client:
+        wait_for_compaction()
+        assert histories(client) == expected
+
+        # the imports after it go on with the same runs
+        items = client.stats(FIRST.id).json()["items"]
+        data = default(ImpRequest, items=[FIRST.copy(update={"price": 20})],
+                       updateDate=START + HOUR * 8)
+        assert client.imports(data.json()).status_code == 200
+        assert client.stats(FIRST.id).json()["items"] == items + [
+            {**items[-1], "date": "2022-07-01T06:00:00.000Z"}]
+        monkeypatch.setattr(options, "DEV_MODE", True)
+
+
+@sqlite_only
+def test_stored_rows(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(options, "DEV_MODE", True)
+    monkeypatch.setattr(options, "COMPACT_HISTORY", True)
+    with generate_client() as client:
+        import_history(client)
+        compact = stored_rows()
+
+        # from the full history, by the compaction on the next start
+        monkeypatch.setattr(options, "COMPACT_HISTORY", False)
+        client.cleanup_database()
+        import_history(client)
+        full = stored_rows()
+        monkeypatch.setattr(options, "DEV_MODE", False)
+
+    monkeypatch.setattr(options, "COMPACT_HISTORY", True)
+    with generate_client():
+        wait_for_compaction()
+        assert stored_rows() == compact
+        monkeypatch.setattr(options, "DEV_MODE", True)
+
+    # every state is either a run or a mark of one
+    for month in ("2022_06", "2022_07"):
+        runs, marks = f"stat_{month}", f"stat_{month}_marks"
+        assert full[marks] == 0
+        assert compact[runs] + compact[marks] == full[runs]
+        assert compact[runs] < full[runs]
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,236 @@
+import asyncio
+import random
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing
+from datetime import datetime, timedelta
+from math import ceil
+from typing import Any, List, Tuple
+from uuid import UUID
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from SBDY_app import coalescer, options
+from SBDY_app.coalescer import Coalescer
+from SBDY_app.database import DATABASE_URL
+from SBDY_app.schemas import Import, ImpRequest, ShopUnit, ShopUnitType
+
+from utils import (ERROR_400, Client, client, default, do_test,
+                   generate_client, setup, sqlite_only)
+
+setup()
+
+WORKERS = 8
+IMPORTS = 10
+
+
+def category(parent_id: Any = None) -> Import:
+    imp = default(Import, parentId=parent_id,
+                  type=ShopUnitType.CATEGORY, price=None)
+    imp.price = None
+    return imp
+
+
+def aggregate(unit: ShopUnit) -> Tuple[int, int]:
+    """
+    Checks the price of the 'unit' and all its children against the
+    offers in them, returns the sum of the prices and the number of offers
+    """
+
+    if unit.type == ShopUnitType.OFFER:
+        assert unit.price is not None
+        return unit.price, 1
+
+    assert unit.children is not None
+    total, count = 0, 0
+    for child in unit.children:
+        child_total, child_count = aggregate(child)
+        total += child_total
+        count += child_count
+
+    if count == 0:
+        assert unit.price is None
+    else:
+        assert unit.price == ceil(total / count)
+    return total, count
+
+
+def import_concurrently(client: Client) -> int:
+    root = category()
+    middle = [category(root.id) for _ in range(3)]
+    leaves = [category(parent.id) for parent in middle for _ in range(2)]
+    data = default(ImpRequest, items=[root] + middle + leaves)
+    response = client.imports(data.json())
+    assert response.status_code == 200
+
+    # the same offers are changed and moved around by everyone
+    offers = [default(UUID) for _ in range(20)]
+
+    def worker(seed: int) -> List[int]:
+        rng = random.Random(seed)
+        statuses = []
+        for _ in range(IMPORTS):
+            items = [default(Import, id=id, price=rng.randint(0, 10**5),
+                             parentId=rng.choice(leaves + middle).id)
+                     for id in rng.sample(offers, 5)]
+            data = default(ImpRequest, items=items)
+            statuses.append(client.imports(data.json()).status_code)
+        return statuses
+
+    with ThreadPoolExecutor(WORKERS) as executor:
+        results = list(executor.map(worker, range(WORKERS)))
+    assert all(status == 200 for statuses in results for status in statuses)
+
+    response = client.nodes(root.id)
+    assert response.status_code == 200
+    total, count = aggregate(ShopUnit(**response.json()))
+    assert count == len(offers)
+    return 1 + WORKERS * IMPORTS
+
+
+def test_concurrent_imports(client: Client):
+    import_concurrently(client)
+
+
+def test_coalesced_imports(client: Client, monkeypatch: pytest.MonkeyPatch):
+    groups: List[int] = []
+    commit = Coalescer.commit
+
+    async def counted_commit(self: Coalescer, group: Any) -> None:
+        groups.append(len(group))
+        await commit(self, group)
+
+    monkeypatch.setattr(Coalescer, "commit", counted_commit)
+
+    original = options.COALESCE_IMPORTS
+    options.COALESCE_IMPORTS = True
+
+    try:
+        # every import goes through the coalescer
+        imported = import_concurrently(client)
+        assert sum(groups) == imported
+
+        # invalid imports fail alone, the rest of the group is committed
+        root = category()
+        response = client.imports(default(ImpRequest, items=[root]).json())
+        assert response.status_code == 200
+
+        valid = [default(Import, parentId=root.id) for _ in range(WORKERS)]
+        invalid = [default(Import) for _ in range(WORKERS)]
+        items = [imp for pair in zip(valid, invalid) for imp in pair]
+
+        def send(imp: Import) -> Any:
+            return client.imports(default(ImpRequest, items=[imp]).json())
+
+        with ThreadPoolExecutor(WORKERS) as executor:
+            responses = list(executor.map(send, items))
+
+        for imp, response in zip(items, responses):
+            if imp in valid:
+                assert response.status_code == 200
+            else:
+                assert response.status_code == 400
+                assert response.json() == ERROR_400
+
+        response = client.nodes(root.id)
+        assert response.status_code == 200
+        unit = ShopUnit(**response.json())
+        assert {child.id for child in unit.children} == {
+            imp.id for imp in valid}
+        aggregate(unit)
+    finally:
+        options.COALESCE_IMPORTS = original
+
+
+class Session:
+    """
+    Stands in for the database session of a group
+    """
+
+    def __init__(self, sessions: List["Session"]):
+        sessions.append(self)
+        self.commits = 0
+
+    @asynccontextmanager
+    async def begin_nested(self):
+        yield
+
+    async def commit(self) -> None:
+        self.commits += 1
+
+
+def submit_together(group_commit: Coalescer, count: int) -> List[Any]:
+    start = datetime(2022, 6, 22)
+    requests = [default(ImpRequest, items=[default(Import, parentId=None)],
+                        updateDate=start + timedelta(days=count - i))
+                for i in range(count)]
+
+    async def submit_all() -> List[Any]:
+        return await asyncio.wait_for(asyncio.gather(
+            *(group_commit.submit(req) for req in requests),
+            return_exceptions=True), timeout=5)
+
+    return asyncio.run(submit_all())
+
+
+def test_group_commit(monkeypatch: pytest.MonkeyPatch):
+    sessions: List[Session] = []
+    applied: List[datetime] = []
+
+    @asynccontextmanager
+    async def write_session():
+        yield Session(sessions)
+
+    async def apply(db: Any, req: ImpRequest) -> None:
+        applied.append(req.updateDate)
+
+    monkeypatch.setattr(coalescer, "write_session", write_session)
+
+    # submitted before the worker runs, so they share one commit
+    assert submit_together(Coalescer(apply), 5) == [None] * 5
+    assert len(sessions) == 1
+    assert sessions[0].commits == 1
+    assert applied == sorted(applied)
+
+
+def test_group_session_failed(monkeypatch: pytest.MonkeyPatch):
+    @asynccontextmanager
+    async def write_session():
+        raise OperationalError("BEGIN IMMEDIATE", {}, "database is locked")
+        yield
+
+    async def apply(db: Any, req: ImpRequest) -> None:
+        raise AssertionError("Nothing should be applied")
+
+    monkeypatch.setattr(coalescer, "write_session", write_session)
+
+    # every submitter gets the error instead of waiting forever
+    results = submit_together(Coalescer(apply), 5)
+    assert all(isinstance(result, OperationalError) for result in results)
+
+
+@sqlite_only
+def test_wal_reads_during_write(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(options, "WAL_MODE", True)
+
+    id = default(UUID)
+    data = default(ImpRequest, items=[default(Import, id=id, parentId=None)])
+    path = DATABASE_URL.split("///", 1)[1]
+
+    with generate_client() as client:
+        response = client.imports(data.json())
+        assert response.status_code == 200
+
+        # the readers see the last commit while someone else writes
+        with closing(sqlite3.connect(path, isolation_level=None)) as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+            conn.execute("BEGIN EXCLUSIVE")
+            conn.execute("DELETE FROM shop")
+
+            response = client.nodes(id)
+            assert response.status_code == 200
+            conn.execute("ROLLBACK")
+
+
+if __name__ == "__main__":
+    do_test(__file__)
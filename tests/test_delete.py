@@ -1,7 +1,16 @@
+import sqlite3
+import time
+from contextlib import closing
+from typing import Dict
 from uuid import UUID
+
+import pytest
+from SBDY_app import purger
+from SBDY_app.database import DATABASE_URL
 from SBDY_app.schemas import ImpRequest, Import, ShopUnit, ShopUnitType
 
-from utils import ERROR_400, ERROR_404, Client, client, default, do_test, setup
+from utils import (ERROR_400, ERROR_404, Client, client, default, do_test,
+                   setup, sqlite_only)
 
 setup()
 
@@ -85,6 +94,140 @@ def test_parent_change(client: Client):
     assert ShopUnit(**response.json()).price is None
 
 
+def test_delete_subcategory(client: Client):
+    id1, id2 = default(UUID), default(UUID)
+    items = [
+        default(Import, id=id1, parentId=None,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, id=id2, parentId=id1,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, parentId=id2, price=10),
+        default(Import, parentId=id2, price=20)]
+    items[0].price = items[1].price = None
+    response = client.imports(default(ImpRequest, items=items).json())
+    assert response.status_code == 200
+
+    response = client.delete(id2)
+    assert response.status_code == 200
+
+    # both offers are gone from the aggregates of the parent
+    offer = default(Import, parentId=id1, price=69)
+    response = client.imports(default(ImpRequest, items=[offer]).json())
+    assert response.status_code == 200
+
+    response = client.nodes(id1)
+    assert response.status_code == 200
+    assert ShopUnit(**response.json()).price == 69
+
+    # as well as the history of the descendants
+    items[2].parentId = None
+    response = client.imports(default(ImpRequest, items=[items[2]]).json())
+    assert response.status_code == 200
+
+    response = client.stats(items[2].id)
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 1
+
+
+def stored_rows() -> Dict[str, int]:
+    path = DATABASE_URL.split("///", 1)[1]
+    with closing(sqlite3.connect(path)) as conn:
+        rows = {table: conn.execute(f"SELECT count(*) FROM {table}")
+                .fetchone()[0] for table in ("shop", "tombstones")}
+        # the history of all the months
+        rows["stat"] = sum(
+            conn.execute(f"SELECT count(*) FROM stat_{month}").fetchone()[0]
+            for month, in conn.execute("SELECT month FROM history_partitions"))
+        return rows
+
+
+@sqlite_only
+def test_purge(client: Client, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(purger, "PURGE_BATCH", 3)
+
+    id1, id2 = default(UUID), default(UUID)
+    items = [
+        default(Import, id=id1, parentId=None,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, id=id2, parentId=id1,
+                type=ShopUnitType.CATEGORY, price=None)]
+    items[0].price = items[1].price = None
+    offers = [default(Import, parentId=id2) for _ in range(10)]
+    data = default(ImpRequest, items=items + offers)
+    response = client.imports(data.json())
+    assert response.status_code == 200
+
+    response = client.delete(id2)
+    assert response.status_code == 200
+
+    # the subtree is not seen right away
+    for id in [id2] + [offer.id for offer in offers]:
+        assert client.nodes(id).status_code == 404
+        assert client.stats(id).status_code == 404
+        assert client.delete(id).status_code == 404
+    assert client.sales(data.updateDate).json() == {"items": []}
+
+    response = client.nodes(id1)
+    assert response.status_code == 200
+    assert response.json()["children"] == []
+    assert response.json()["price"] is None
+
+    # the deleted ones can't be parents
+    data = default(ImpRequest, items=[default(Import, parentId=id2)])
+    response = client.imports(data.json())
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+    # and it's purged in the background
+    deadline = time.monotonic() + 10
+    while stored_rows() != {"shop": 1, "stat": 1, "tombstones": 0}:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_delete_batch(client: Client):
+    id1, id2 = default(UUID), default(UUID)
+    items = [
+        default(Import, id=id1, parentId=None,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, id=id2, parentId=id1,
+                type=ShopUnitType.CATEGORY, price=None)]
+    items[0].price = items[1].price = None
+    offers = [default(Import, parentId=id1, price=10),
+              default(Import, parentId=id2, price=20),
+              default(Import, parentId=id2, price=30),
+              default(Import, parentId=id2, price=40)]
+    response = client.imports(default(ImpRequest, items=items + offers).json())
+    assert response.status_code == 200
+
+    # nothing is deleted if any of them is not found
+    response = client.delete_batch([offers[0].id, default(UUID)])
+    assert response.status_code == 404
+    assert response.json() == ERROR_404
+    assert client.nodes(offers[0].id).status_code == 200
+
+    # the offer under the deleted category is not subtracted twice
+    response = client.delete_batch([offers[1].id, offers[3].id, id2])
+    assert response.status_code == 200
+
+    response = client.nodes(id1)
+    assert response.status_code == 200
+    unit = ShopUnit(**response.json())
+    assert [child.id for child in unit.children] == [offers[0].id]
+    assert unit.price == 10
+
+    for id in [id2, offers[1].id, offers[2].id, offers[3].id]:
+        assert client.nodes(id).status_code == 404
+
+    response = client.delete_batch([id2])
+    assert response.status_code == 404
+    assert response.json() == ERROR_404
+
+    response = client.delete_batch(["abooba"])
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+
 def test_validation(client: Client):
     response = client.delete("abooba")
     assert response.status_code == 400
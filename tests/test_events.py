@@ -0,0 +1,158 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from uuid import UUID
+
+import pytest
+from SBDY_app import events, options
+from SBDY_app.events import EventLog
+from SBDY_app.memory import MemoryStorage
+from SBDY_app.replay import replay
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import Client, default, do_test, generate_client, setup
+
+setup()
+
+DATE = datetime(2022, 6, 22, 12)
+
+
+@pytest.fixture
+def log_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(events, "LOG_PATH", tmp_path)
+    return tmp_path
+
+
+def test_append(log_path: Path):
+    log = EventLog()
+    log.open()
+    assert log.append([{"n": 1}, {"n": 2}]) == 2
+    assert log.append([{"n": 3}]) == 3
+
+    log = EventLog()
+    log.open()
+    assert log.last_sequence == 3
+    assert list(log.read_after(1)) == [(2, {"n": 2}), (3, {"n": 3})]
+    assert list(log.read_after(3)) == []
+
+
+def test_torn_end(log_path: Path):
+    log = EventLog()
+    log.open()
+    log.append([{"n": 1}, {"n": 2}])
+    segment, = log_path.iterdir()
+    size = segment.stat().st_size
+    os.truncate(segment, size - 3)
+
+    # the torn record is cut off, the next one takes its number
+    log = EventLog()
+    log.open()
+    assert log.last_sequence == 1
+    assert log.append([{"n": 3}]) == 2
+    assert list(log.read_after(0)) == [(1, {"n": 1}), (2, {"n": 3})]
+
+
+def test_truncate(log_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(events, "SEGMENT_SIZE", 1)
+
+    log = EventLog()
+    log.open()
+    log.append([{"n": 1}])
+    mark = log.mark()
+    log.append([{"n": 2}])
+    assert len(list(log_path.iterdir())) == 2
+
+    log.truncate(mark)
+    assert len(list(log_path.iterdir())) == 1
+    assert log.append([{"n": 3}]) == 2
+    assert list(log.read_after(0)) == [(1, {"n": 1}), (2, {"n": 3})]
+
+
+def test_segments(log_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(events, "SEGMENT_SIZE", 100)
+
+    log = EventLog()
+    log.open()
+    for n in range(1, 51):
+        log.append([{"n": n}])
+    assert len(list(log_path.iterdir())) > 5
+
+    # only the segments with the tail are read
+    first, *rest = sorted(log_path.iterdir())
+    first.write_bytes(b"garbage")
+    assert [n for n, _ in log.read_after(45)] == [46, 47, 48, 49, 50]
+    with pytest.raises(events.CorruptedLog):
+        list(log.read_after(0))
+
+
+def import_catalog(client: Client) -> UUID:
+    id = default(UUID)
+    items = [
+        default(Import, id=id, parentId=None,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, parentId=id, type=ShopUnitType.OFFER, price=10),
+        default(Import, parentId=id, type=ShopUnitType.OFFER, price=21)]
+    items[0].price = None
+    data = default(ImpRequest, items=items, updateDate=DATE)
+    response = client.imports(data.json(), key="catalog")
+    assert response.status_code == 200
+
+    offer = items[1].copy(update={"price": 30})
+    data = default(ImpRequest, items=[offer], updateDate=DATE)
+    response = client.imports(data.json())
+    assert response.status_code == 200
+
+    response = client.delete(items[2].id)
+    assert response.status_code == 200
+    return id
+
+
+def responses(client: Client, id: UUID) -> list:
+    return [client.nodes(id).json(),
+            client.sales(DATE).json(),
+            client.stats(id, DATE, DATE + timedelta(hours=1)).json()]
+
+
+def test_rebuild(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(options, "DEV_MODE", True)
+    with generate_client() as client:
+        id = import_catalog(client)
+        expected = responses(client, id)
+        assert events.log.last_sequence == 3
+        monkeypatch.setattr(options, "DEV_MODE", False)
+
+    # from the empty storage, only by the log
+    assert asyncio.run(replay(rebuild=True)) == 3
+
+    with generate_client() as client:
+        assert responses(client, id) == expected
+        # the repeated import is known
+        response = client.imports("{}", key="catalog")
+        assert response.headers["X-Replayed"] == "true"
+        monkeypatch.setattr(options, "DEV_MODE", True)
+
+
+def test_recovery(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(options, "STORAGE_BACKEND", "memory")
+    monkeypatch.setattr(options, "DEV_MODE", True)
+    with generate_client() as client:
+        id = import_catalog(client)
+        expected = responses(client, id)
+        monkeypatch.setattr(options, "DEV_MODE", False)
+
+        # the app crashes before the snapshot
+        async def crash(self: MemoryStorage) -> None:
+            pass
+        monkeypatch.setattr(MemoryStorage, "save", crash)
+
+    monkeypatch.undo()
+    monkeypatch.setattr(options, "STORAGE_BACKEND", "memory")
+    monkeypatch.setattr(options, "DEV_MODE", False)
+    with generate_client() as client:
+        assert responses(client, id) == expected
+        monkeypatch.setattr(options, "DEV_MODE", True)
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,99 @@
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import List
+from uuid import UUID
+
+import pytest
+from SBDY_app import options, retention
+from SBDY_app.database import DATABASE_URL
+from SBDY_app.retention import first_kept_month
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import Client, client, default, do_test, setup, sqlite_only
+
+setup()
+
+
+def import_offer(client: Client, offer: Import, date: datetime,
+                 price: int) -> None:
+    data = default(ImpRequest, items=[offer.copy(update={"price": price})],
+                   updateDate=date)
+    response = client.imports(data.json())
+    assert response.status_code == 200
+
+
+def prices(client: Client, id: UUID, *dates: datetime) -> List[int]:
+    response = client.stats(id, *dates)
+    assert response.status_code == 200
+    return [item["price"] for item in response.json()["items"]]
+
+
+def test_months(client: Client):
+    offer = default(Import, parentId=None, type=ShopUnitType.OFFER)
+    import_offer(client, offer, datetime(2022, 6, 1, 1), 20)
+    import_offer(client, offer, datetime(2022, 5, 31, 23), 10)
+    import_offer(client, offer, datetime(2022, 7, 15), 30)
+
+    # in the order of the changes, whatever months they are in
+    assert prices(client, offer.id) == [20, 10, 30]
+    assert prices(client, offer.id, datetime(2022, 5, 31),
+                  datetime(2022, 6, 2)) == [20, 10]
+    assert prices(client, offer.id, datetime(2022, 6, 1),
+                  datetime(2022, 7, 15)) == [20]
+    assert prices(client, offer.id, datetime(2022, 8, 1)) == []
+
+
+@sqlite_only
+def test_partitions(client: Client):
+    offer = default(Import, parentId=None, type=ShopUnitType.OFFER)
+    import_offer(client, offer, datetime(2022, 5, 31, 23), 10)
+    import_offer(client, offer, datetime(2022, 6, 1, 1), 20)
+
+    path = DATABASE_URL.split("///", 1)[1]
+    with closing(sqlite3.connect(path)) as conn:
+        tables = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        assert {"stat_2022_05", "stat_2022_06"} <= tables
+        for month in ("2022_05", "2022_06"):
+            assert conn.execute(
+                f"SELECT count(*) FROM stat_{month}").fetchone() == (1,)
+
+
+def test_first_kept_month():
+    assert first_kept_month(datetime(2022, 6, 22), 0) == "2022_06"
+    assert first_kept_month(datetime(2022, 6, 22), 1) == "2022_05"
+    assert first_kept_month(datetime(2022, 1, 1), 1) == "2021_12"
+    assert first_kept_month(datetime(2022, 6, 22), 18) == "2020_12"
+
+
+@pytest.fixture
+def frequent_checks(monkeypatch: pytest.MonkeyPatch) -> None:
+    # before the app starts, so its first wait is short too
+    monkeypatch.setattr(retention, "CHECK_INTERVAL", 0.01)
+
+
+def test_retention(frequent_checks: None, client: Client,
+                   monkeypatch: pytest.MonkeyPatch):
+    now = datetime.utcnow().replace(microsecond=0)
+    offer = default(Import, parentId=None, type=ShopUnitType.OFFER)
+    import_offer(client, offer, now - timedelta(days=100), 10)
+    import_offer(client, offer, now, 20)
+    assert prices(client, offer.id) == [10, 20]
+
+    # the month 100 days ago is at least 3 months before
+    monkeypatch.setattr(options, "HISTORY_RETENTION_MONTHS", 2)
+    deadline = time.monotonic() + 10
+    while prices(client, offer.id) != [20]:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    # only the history goes, the unit stays
+    response = client.nodes(offer.id)
+    assert response.status_code == 200
+    assert response.json()["price"] == 20
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,77 @@
+import time
+from typing import Any
+from uuid import UUID
+
+from SBDY_app.schemas import Import, ImpRequest, Job, JobStatus, ShopUnitType
+
+from utils import ERROR_400, ERROR_404, Client, client, default, do_test, setup
+
+setup()
+
+
+def wait(client: Client, id: Any, timeout: float = 10) -> Job:
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.import_job(id)
+        assert response.status_code == 200
+        job = Job(**response.json())
+        if job.status in (JobStatus.DONE, JobStatus.FAILED):
+            return job
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_job(client: Client):
+    id = default(UUID)
+    category = default(Import, id=id, parentId=None,
+                       type=ShopUnitType.CATEGORY, price=None)
+    category.price = None
+    offer = default(Import, parentId=id)
+
+    # queued in order, so the parent goes first
+    first = client.imports_job(default(ImpRequest, items=[category]).json())
+    second = client.imports_job(default(ImpRequest, items=[offer]).json())
+    assert first.status_code == 202
+    assert second.status_code == 202
+    assert first.json()["status"] == JobStatus.QUEUED
+
+    assert wait(client, first.json()["id"]).status == JobStatus.DONE
+    assert wait(client, second.json()["id"]).status == JobStatus.DONE
+
+    response = client.nodes(id)
+    assert response.status_code == 200
+    assert response.json()["price"] == offer.price
+
+
+def test_failed_job(client: Client):
+    # the parent doesn't exist
+    data = default(ImpRequest, items=[default(Import)])
+    response = client.imports_job(data.json())
+    assert response.status_code == 202
+
+    job = wait(client, response.json()["id"])
+    assert job.status == JobStatus.FAILED
+    assert job.error == ERROR_400
+
+    # the queue goes on after a failed job
+    item = default(Import, parentId=None)
+    response = client.imports_job(default(ImpRequest, items=[item]).json())
+    assert wait(client, response.json()["id"]).status == JobStatus.DONE
+    assert client.nodes(item.id).status_code == 200
+
+
+def test_validation(client: Client):
+    # invalid requests are not queued at all
+    data = default(ImpRequest, items=[])
+    data.items = [default(Import, parentId=None)] * 2
+    response = client.imports_job(data.json())
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+    response = client.import_job(default(UUID))
+    assert response.status_code == 404
+    assert response.json() == ERROR_404
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -4,6 +4,7 @@ from math import ceil
 from random import shuffle
 from uuid import UUID
 
+from SBDY_app import options
 from SBDY_app.patches import serialize_datetime
 from SBDY_app.schemas import Import, ImpRequest, ShopUnit, ShopUnitType
 
@@ -232,6 +233,183 @@ def test_change_to_nonexisting_category_parent(client: Client):
     assert response.json() == ERROR_400
 
 
+def test_cycle(client: Client):
+    imp1 = default(Import, price=None, type=ShopUnitType.CATEGORY)
+    imp2 = default(Import, parentId=imp1.id, price=None,
+                   type=ShopUnitType.CATEGORY)
+    imp1.parentId = imp2.id
+    imp1.price = imp2.price = None
+    data = default(ImpRequest, items=[imp1, imp2])
+    response = client.imports(data.json())
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+
+def test_deep_category_price(client: Client):
+    ids = [default(UUID) for _ in range(50)]
+    items = []
+    for id, parent_id in zip(ids, [None] + ids[:-1]):
+        imp = default(Import, id=id, parentId=parent_id,
+                      type=ShopUnitType.CATEGORY, price=None)
+        imp.price = None
+        items.append(imp)
+    items += [default(Import, parentId=id, price=i * 10)
+              for i, id in enumerate(ids)]
+    response = client.imports(default(ImpRequest, items=items).json())
+    assert response.status_code == 200
+
+    for i, id in enumerate(ids):
+        prices = [j * 10 for j in range(i, len(ids))]
+        response = client.nodes(id)
+        assert response.status_code == 200
+        assert response.json()["price"] == ceil(sum(prices) / len(prices))
+
+
+def test_many_items(client: Client):
+    id = default(UUID)
+    category = default(Import, id=id, parentId=None,
+                       type=ShopUnitType.CATEGORY, price=None)
+    category.price = None
+    offers = [default(Import, parentId=id) for _ in range(2000)]
+    data = default(ImpRequest, items=[category] + offers)
+    response = client.imports(data.json())
+    assert response.status_code == 200
+
+    response = client.nodes(id)
+    assert response.status_code == 200
+    unit = ShopUnit(**response.json())
+    assert len(unit.children) == len(offers)
+    assert unit.price == ceil(sum(i.price for i in offers) / len(offers))
+
+    category.type = ShopUnitType.OFFER
+    category.price = 69
+    data = default(ImpRequest, items=offers + [category])
+    response = client.imports(data.json())
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+
+def test_skip_unchanged(client: Client):
+    id = default(UUID)
+    category = default(Import, id=id, parentId=None,
+                       type=ShopUnitType.CATEGORY, price=None)
+    category.price = None
+    offers = [default(Import, parentId=id) for _ in range(5)]
+    dates = [datetime(2022, 6, 22 + i) for i in range(3)]
+
+    original = options.SKIP_UNCHANGED
+    options.SKIP_UNCHANGED = True
+
+    try:
+        data = ImpRequest(items=[category] + offers, updateDate=dates[0])
+        response = client.imports(data.json())
+        assert response.status_code == 200
+        assert response.headers["X-Skipped-Items"] == "0"
+        assert response.headers["X-Applied-Items"] == "6"
+
+        # only the changed offer and its ancestors are touched
+        offers[0].price += 1
+        data = ImpRequest(items=[category] + offers, updateDate=dates[1])
+        response = client.imports(data.json())
+        assert response.status_code == 200
+        assert response.headers["X-Skipped-Items"] == "5"
+        assert response.headers["X-Applied-Items"] == "1"
+
+        data = ImpRequest(items=[category] + offers, updateDate=dates[2])
+        response = client.imports(data.json())
+        assert response.status_code == 200
+        assert response.headers["X-Skipped-Items"] == "6"
+    finally:
+        options.SKIP_UNCHANGED = original
+
+    response = client.nodes(id)
+    assert response.status_code == 200
+    unit = ShopUnit(**response.json())
+    assert unit.date.replace(tzinfo=None) == dates[1]
+    assert unit.price == ceil(sum(i.price for i in offers) / len(offers))
+    assert {c.id: c.date.replace(tzinfo=None) for c in unit.children} == {
+        offer.id: dates[1] if offer is offers[0] else dates[0]
+        for offer in offers}
+
+    response = client.stats(offers[1].id)
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 1
+
+
+def test_idempotency_key(client: Client):
+    offer = default(Import, parentId=None, price=10)
+    data = default(ImpRequest, items=[offer])
+    response = client.imports(data.json(), key="abooba")
+    assert response.status_code == 200
+    assert "X-Replayed" not in response.headers
+
+    # the same key is not applied again, even with the other content
+    offer.price = 20
+    data = default(ImpRequest, items=[offer])
+    response = client.imports(data.json(), key="abooba")
+    assert response.status_code == 200
+    assert response.headers["X-Replayed"] == "true"
+    assert response.headers["X-Applied-Items"] == "1"
+
+    response = client.nodes(offer.id)
+    assert response.status_code == 200
+    assert response.json()["price"] == 10
+
+    response = client.stats(offer.id)
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 1
+
+    # invalid imports are not remembered
+    data = default(ImpRequest, items=[default(Import)])
+    for _ in range(2):
+        response = client.imports(data.json(), key="amogus")
+        assert response.status_code == 400
+        assert response.json() == ERROR_400
+
+    # only the latest are remembered
+    original = options.REMEMBERED_IMPORTS
+    options.REMEMBERED_IMPORTS = 1
+
+    try:
+        data = default(ImpRequest, items=[default(Import, parentId=None)])
+        response = client.imports(data.json(), key="sus")
+        assert "X-Replayed" not in response.headers
+        response = client.imports(data.json(), key="abooba")
+        assert "X-Replayed" not in response.headers
+    finally:
+        options.REMEMBERED_IMPORTS = original
+
+
+def test_deduplicate_imports(client: Client):
+    offer = default(Import, parentId=None, price=10)
+    data = default(ImpRequest, items=[offer])
+
+    original = options.DEDUPLICATE_IMPORTS
+    options.DEDUPLICATE_IMPORTS = True
+
+    try:
+        response = client.imports(data.json())
+        assert response.status_code == 200
+        assert "X-Replayed" not in response.headers
+
+        response = client.imports(data.json())
+        assert response.status_code == 200
+        assert response.headers["X-Replayed"] == "true"
+
+        # the other content is the other import
+        offer.price = 20
+        data = default(ImpRequest, items=[offer])
+        response = client.imports(data.json())
+        assert response.status_code == 200
+        assert "X-Replayed" not in response.headers
+    finally:
+        options.DEDUPLICATE_IMPORTS = original
+
+    response = client.stats(offer.id)
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 2
+
+
 def test_not_required_Import_fields(client: Client):
     string = default(ImpRequest).json(exclude={"items": {0: {"parentId"}}})
     response = client.imports(string)
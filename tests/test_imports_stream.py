@@ -0,0 +1,107 @@
+from datetime import datetime
+from math import ceil
+from uuid import UUID
+
+import pytest
+from SBDY_app import options
+from SBDY_app.schemas import Import, ShopUnit, ShopUnitType
+
+from utils import ERROR_400, Client, client, default, do_test, setup
+
+setup()
+
+CHUNK_SIZE = 3
+
+
+@pytest.fixture(autouse=True)
+def small_chunks():
+    original = options.STREAM_CHUNK_SIZE
+    options.STREAM_CHUNK_SIZE = CHUNK_SIZE
+    yield
+    options.STREAM_CHUNK_SIZE = original
+
+
+def ndjson(*items: Import) -> str:
+    return "\n".join(item.json() for item in items) + "\n"
+
+
+def test_stream(client: Client):
+    id = default(UUID)
+    category = default(Import, id=id, parentId=None,
+                       type=ShopUnitType.CATEGORY, price=None)
+    category.price = None
+    offers = [default(Import, parentId=id) for _ in range(7)]
+
+    response = client.imports_stream(
+        ndjson(category, *offers), default(datetime))
+    assert response.status_code == 200
+    assert response.json() == {"chunks": 3, "items": 8}
+
+    response = client.nodes(id)
+    assert response.status_code == 200
+    unit = ShopUnit(**response.json())
+    assert len(unit.children) == len(offers)
+    assert unit.price == ceil(sum(i.price for i in offers) / len(offers))
+
+
+def test_empty_stream(client: Client):
+    response = client.imports_stream("\n\n", default(datetime))
+    assert response.status_code == 200
+    assert response.json() == {"chunks": 0, "items": 0}
+
+
+def test_invalid_item(client: Client):
+    id = default(UUID)
+    category = default(Import, id=id, parentId=None,
+                       type=ShopUnitType.CATEGORY, price=None)
+    category.price = None
+    offers = [default(Import, parentId=id) for _ in range(4)]
+
+    # the second chunk has an offer without a parent
+    lines = ndjson(category, *offers[:2], offers[2], default(Import))
+    response = client.imports_stream(lines, default(datetime))
+    assert response.status_code == 400
+    assert response.json() == {**ERROR_400.dict(), "chunks": 1, "items": 3}
+
+    response = client.nodes(id)
+    assert response.status_code == 200
+    assert len(response.json()["children"]) == 2
+
+    # not even a json
+    response = client.imports_stream("abooba\n", default(datetime))
+    assert response.status_code == 400
+    assert response.json() == {**ERROR_400.dict(), "chunks": 0, "items": 0}
+
+
+def test_repeated_id(client: Client):
+    id = default(UUID)
+    category = default(Import, id=id, parentId=None,
+                       type=ShopUnitType.CATEGORY, price=None)
+    category.price = None
+    offer = default(Import, parentId=id, price=10)
+    repeated = default(Import, id=offer.id, parentId=id, price=30)
+
+    # the same id in different chunks is rejected, as by /imports
+    lines = ndjson(category, offer, default(Import, parentId=id), repeated)
+    response = client.imports_stream(lines, default(datetime))
+    assert response.status_code == 400
+    assert response.json() == {**ERROR_400.dict(), "chunks": 1, "items": 3}
+
+    response = client.nodes(offer.id)
+    assert response.status_code == 200
+    assert response.json()["price"] == 10
+
+
+def test_validation(client: Client):
+    response = client.imports_stream(ndjson(default(Import, parentId=None)))
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+    response = client.imports_stream(
+        ndjson(default(Import, parentId=None)), "abooba")
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+
+if __name__ == "__main__":
+    do_test(__file__)
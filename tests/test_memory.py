@@ -0,0 +1,151 @@
+import asyncio
+import pickle
+import time
+from datetime import datetime, timedelta
+from uuid import UUID
+
+import pytest
+from SBDY_app import options
+from SBDY_app.memory import SNAPSHOT_PATH, MemoryStorage, State
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import Client, default, do_test, generate_client, setup
+
+setup()
+
+DATE = datetime(2022, 6, 22, 12)
+
+
+def import_catalog(client: Client) -> UUID:
+    id = default(UUID)
+    items = [
+        default(Import, id=id, parentId=None,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, parentId=id, type=ShopUnitType.OFFER, price=10),
+        default(Import, parentId=id, type=ShopUnitType.OFFER, price=21)]
+    items[0].price = None
+    data = default(ImpRequest, items=items, updateDate=DATE)
+    response = client.imports(data.json())
+    assert response.status_code == 200
+    return id
+
+
+def responses(client: Client, id: UUID) -> list:
+    return [client.nodes(id).json(),
+            client.sales(DATE).json(),
+            client.stats(id, DATE, DATE + timedelta(hours=1)).json()]
+
+
+def test_snapshot(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(options, "STORAGE_BACKEND", "memory")
+    monkeypatch.setattr(options, "DEV_MODE", True)
+
+    with generate_client() as client:
+        id = import_catalog(client)
+        expected = responses(client, id)
+        # kept from now on, so it's saved on shutdown
+        monkeypatch.setattr(options, "DEV_MODE", False)
+    assert SNAPSHOT_PATH.exists()
+
+    with generate_client() as client:
+        assert responses(client, id) == expected
+        monkeypatch.setattr(options, "DEV_MODE", True)
+    assert not SNAPSHOT_PATH.exists()
+
+
+def test_periodic_snapshot(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(options, "STORAGE_BACKEND", "memory")
+    monkeypatch.setattr(options, "DEV_MODE", True)
+    monkeypatch.setattr(options, "SNAPSHOT_INTERVAL", 0.01)
+
+    with generate_client() as client:
+        id = import_catalog(client)
+
+        deadline = time.monotonic() + 10
+        while not SNAPSHOT_PATH.exists():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        state = pickle.loads(SNAPSHOT_PATH.read_bytes())
+        assert id in state.units
+        assert len(state.offers) == 2
+
+
+def test_rollback():
+    storage = MemoryStorage()
+    offer = default(Import, parentId=None, type=ShopUnitType.OFFER, price=10)
+
+    async def scenario() -> None:
+        async with storage.write_session() as db:
+            await db.upsert_shop_units(DATE, [offer])
+            await db.create_stat_units([offer.id])
+
+        changed = offer.copy(update={"price": 20})
+        with pytest.raises(RuntimeError):
+            async with storage.write_session() as db:
+                await db.upsert_shop_units(DATE, [changed])
+                await db.create_stat_units([changed.id])
+                raise RuntimeError
+
+        # only the changes in the failed savepoint are undone
+        async with storage.write_session() as db:
+            await db.bury_subtrees([offer.id])
+            with pytest.raises(RuntimeError):
+                async with db.begin_nested():
+                    await db.upsert_shop_units(DATE, [changed])
+                    raise RuntimeError
+
+        async with storage.read_session() as db:
+            assert not await db.shop_unit_exists(offer.id)
+
+    asyncio.run(scenario())
+    assert storage.state.units == {}
+    assert storage.state.offers == []
+    # the partition of the month stays, but empty
+    assert storage.state.partitions == {"2022_06": {}}
+
+
+def test_rolled_back_changes():
+    storage = MemoryStorage()
+    offer = default(Import, parentId=None, type=ShopUnitType.OFFER, price=10)
+
+    async def scenario() -> None:
+        async with storage.write_session() as db:
+            await db.upsert_shop_units(DATE, [offer])
+            await db.create_stat_units([offer.id])
+
+        changed = offer.copy(update={"price": 20})
+        with pytest.raises(RuntimeError):
+            async with storage.write_session() as db:
+                await db.upsert_shop_units(DATE + timedelta(days=1),
+                                           [changed])
+                await db.create_stat_units([changed.id])
+                raise RuntimeError
+
+        async with storage.read_session() as db:
+            units = await db.offers_by_date(DATE, DATE)
+            assert units[offer.id].price == 10
+            stats = await db.stat_units_by_date(
+                offer.id, DATE, DATE + timedelta(days=1), with_end=True)
+            assert [stat.price for stat in stats] == [10]
+
+    asyncio.run(scenario())
+
+
+def test_old_snapshot():
+    # the history of the units before it was partitioned by months
+    id = default(UUID)
+    old = State()
+    del old.partitions, old.last_event
+    entries = [(date, key, {"id": id, "date": date, "_unique_id": key})
+               for key, date in enumerate([DATE, DATE + timedelta(days=30)])]
+    old.history = {id: entries}  # type: ignore
+
+    state = pickle.loads(pickle.dumps(old))
+    assert state.partitions == {"2022_06": {id: entries[:1]},
+                                "2022_07": {id: entries[1:]}}
+    assert state.last_event == 0
+    assert not hasattr(state, "history")
+
+
+if __name__ == "__main__":
+    do_test(__file__)
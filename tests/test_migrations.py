@@ -0,0 +1,129 @@
+import sqlite3
+import time
+from contextlib import closing
+from uuid import UUID, uuid4
+
+import pytest
+from SBDY_app import options
+from SBDY_app.database import DATABASE_URL
+from SBDY_app.migrations import MIGRATIONS
+
+from utils import Client, client, do_test, generate_client, setup, sqlite_only
+
+setup()
+
+pytestmark = sqlite_only
+
+PATH = DATABASE_URL.split("///", 1)[1]
+DATE = "2022-06-22 12:00:00.000000"
+
+# the schema before the integer keys
+SCHEMA_0 = """
+CREATE TABLE shop (
+    name VARCHAR, date DATETIME, type VARCHAR(8), price INTEGER,
+    id BINARY(16) NOT NULL, "parentId" BINARY(16), sub_offers_count INTEGER,
+    PRIMARY KEY (id), FOREIGN KEY("parentId") REFERENCES shop (id));
+CREATE TABLE stat (
+    name VARCHAR, date DATETIME, type VARCHAR(8), price INTEGER,
+    _unique_id INTEGER NOT NULL, id BINARY(16), "parentId" BINARY(16),
+    PRIMARY KEY (_unique_id));
+CREATE TABLE tree (
+    ancestor BINARY(16) NOT NULL, descendant BINARY(16) NOT NULL,
+    depth INTEGER, PRIMARY KEY (ancestor, descendant));
+CREATE INDEX ix_tree_descendant ON tree (descendant, ancestor, depth);
+CREATE TABLE tombstones (id BINARY(16) NOT NULL, PRIMARY KEY (id));
+"""
+
+
+def create_old_database(units: list, tombstones: list) -> None:
+    with closing(sqlite3.connect(PATH)) as conn, conn:
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master"
+            " WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            conn.execute(f"DROP TABLE {table}")
+        conn.execute("PRAGMA user_version = 0")
+        conn.executescript(SCHEMA_0)
+
+        by_id = {unit[0]: unit for unit in units}
+        for id, parent_id, type, price, count in units:
+            row = (id.bytes, parent_id and parent_id.bytes,
+                   str(id)[:8], DATE, type, price, count)
+            conn.execute(
+                "INSERT INTO shop (id, parentId, name, date, type, price,"
+                " sub_offers_count) VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            conn.execute(
+                "INSERT INTO stat (id, parentId, name, date, type, price)"
+                " VALUES (?, ?, ?, ?, ?, ?)", row[:6])
+
+            ancestor, depth = id, 0
+            while ancestor is not None:
+                conn.execute("INSERT INTO tree VALUES (?, ?, ?)",
+                             (ancestor.bytes, id.bytes, depth))
+                ancestor, depth = by_id[ancestor][1], depth + 1
+
+        conn.executemany("INSERT INTO tombstones VALUES (?)",
+                         [(id.bytes,) for id in tombstones])
+
+
+def stored(query: str) -> list:
+    with closing(sqlite3.connect(PATH)) as conn:
+        return conn.execute(query).fetchall()
+
+
+def test_upgrade(monkeypatch: pytest.MonkeyPatch):
+    category, deleted = uuid4(), uuid4()
+    offer1, offer2, offer3 = uuid4(), uuid4(), uuid4()
+    create_old_database([
+        (category, None, "CATEGORY", 30, 2),
+        (offer1, category, "OFFER", 10, 0),
+        (offer2, category, "OFFER", 20, 0),
+        (deleted, None, "CATEGORY", 0, 0),
+        (offer3, deleted, "OFFER", 40, 0),
+    ], [deleted])
+
+    monkeypatch.setattr(options, "DEV_MODE", False)
+    with generate_client() as client:
+        # drop the database once done
+        monkeypatch.setattr(options, "DEV_MODE", True)
+
+        assert stored("PRAGMA user_version") == [(len(MIGRATIONS),)]
+        indexes = {row[0] for row in stored(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {"ix_shop_parent", "ix_shop_type_date",
+                "ix_stat_2022_06_id_date", "ix_stat_2022_06_marks_run_date",
+                "ix_tree_descendant"} <= indexes
+        # the history is moved to the partition of its month,
+        # left to be compacted
+        assert stored("SELECT month, compacted FROM history_partitions") \
+            == [("2022_06", 0)]
+        assert stored("SELECT last FROM history_sequence") == [(5,)]
+
+        response = client.nodes(category)
+        assert response.status_code == 200
+        unit = response.json()
+        assert unit["price"] == 15
+        assert {UUID(child["id"]) for child in unit["children"]} \
+            == {offer1, offer2}
+
+        response = client.stats(offer1)
+        assert response.status_code == 200
+        assert [item["price"] for item in response.json()["items"]] == [10]
+
+        for id in (deleted, offer3):
+            assert client.nodes(id).status_code == 404
+
+        # the tombstone is still there and it's purged
+        deadline = time.monotonic() + 10
+        while stored("SELECT count(*) FROM shop") != [(3,)]:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert stored("SELECT count(*) FROM tombstones") == [(0,)]
+
+
+def test_up_to_date(client: Client):
+    assert stored("PRAGMA user_version") == [(len(MIGRATIONS),)]
+
+
+if __name__ == "__main__":
+    do_test(__file__)
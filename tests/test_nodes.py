@@ -82,6 +82,62 @@ def test_full_category(client: Client):
     assert response.json() == model
 
 
+def test_moved_category(client: Client):
+    id1, id2, id3, id4 = (default(UUID) for _ in range(4))
+    items = [
+        default(Import, id=id1, parentId=None,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, id=id2, parentId=None,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, id=id3, parentId=id1,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, id=id4, parentId=id3,
+                type=ShopUnitType.OFFER, price=69)]
+    for item in items[:3]:
+        item.price = None
+    response = client.imports(default(ImpRequest, items=items).json())
+    assert response.status_code == 200
+
+    items[2].parentId = id2
+    response = client.imports(default(ImpRequest, items=[items[2]]).json())
+    assert response.status_code == 200
+
+    response = client.nodes(id1)
+    assert response.status_code == 200
+    assert response.json()["children"] == []
+    assert response.json()["price"] is None
+
+    response = client.nodes(id2)
+    assert response.status_code == 200
+    unit = ShopUnit(**response.json())
+    assert [child.id for child in unit.children] == [id3]
+    assert [child.id for child in unit.children[0].children] == [id4]
+    assert unit.price == 69
+
+    # the offer is still counted once after the moves and its change
+    id5 = default(UUID)
+    offer = default(Import, id=id5, parentId=id1, price=31)
+    items[2].parentId = id1
+    items[3].price = 41
+    data = default(ImpRequest, items=[items[2], items[3], offer])
+    response = client.imports(data.json())
+    assert response.status_code == 200
+
+    response = client.nodes(id1)
+    assert response.status_code == 200
+    assert response.json()["price"] == 36
+
+    response = client.nodes(id2)
+    assert response.status_code == 200
+    assert response.json()["price"] is None
+
+    # moving into its own descendant is a cycle
+    items[0].parentId = id3
+    response = client.imports(default(ImpRequest, items=[items[0]]).json())
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+
 def test_nonexisting_items(client: Client):
     response = client.nodes(default(UUID))
     assert response.status_code == 404
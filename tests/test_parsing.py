@@ -0,0 +1,66 @@
+import asyncio
+from math import ceil
+from uuid import UUID
+
+import pytest
+from SBDY_app import options, parsing
+from SBDY_app.schemas import Import, ImpRequest, ShopUnit, ShopUnitType
+
+from utils import ERROR_400, Client, client, default, do_test, setup
+
+setup()
+
+
+@pytest.fixture(autouse=True)
+def in_processes():
+    original = options.PARSE_PROCESSES, options.PARSE_IN_PROCESS_SIZE
+    options.PARSE_PROCESSES, options.PARSE_IN_PROCESS_SIZE = 2, 0
+    yield
+    options.PARSE_PROCESSES, options.PARSE_IN_PROCESS_SIZE = original
+    parsing.shutdown()
+
+
+def test_rebuild():
+    id = default(UUID)
+    category = default(Import, id=id, parentId=None,
+                       type=ShopUnitType.CATEGORY, price=None)
+    category.price = None
+    data = default(ImpRequest, items=[category, default(Import, parentId=id)])
+
+    body = data.json().encode("utf-8")
+    parsed = asyncio.run(parsing.rebuild(parsing.validate(body)))
+    assert parsed.dict() == ImpRequest.parse_raw(body).dict()
+
+
+def test_import(client: Client):
+    id = default(UUID)
+    category = default(Import, id=id, parentId=None,
+                       type=ShopUnitType.CATEGORY, price=None)
+    category.price = None
+    offers = [default(Import, parentId=id) for _ in range(10)]
+
+    data = default(ImpRequest, items=[category, *offers])
+    response = client.imports(data.json())
+    assert response.status_code == 200
+
+    response = client.nodes(id)
+    assert response.status_code == 200
+    unit = ShopUnit(**response.json())
+    assert len(unit.children) == len(offers)
+    assert unit.price == ceil(sum(i.price for i in offers) / len(offers))
+
+
+def test_validation(client: Client):
+    data = default(ImpRequest, items=[])
+    data.items = [default(Import, parentId=None)] * 2
+    response = client.imports(data.json())
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+    response = client.client.post("/imports", data=b"abooba")
+    assert response.status_code == 400
+    assert response.json() == ERROR_400
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,89 @@
+from datetime import datetime
+from typing import Iterator, List
+from uuid import UUID
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Executable
+from SBDY_app.crud import Query
+from SBDY_app.migrations import upgrade
+from SBDY_app.models import history_marks, history_partition
+
+from utils import default, do_test, setup
+
+setup()
+
+MONTHS = ("2022_06", "2022_07")
+
+
+@pytest.fixture
+def engine() -> Iterator[Engine]:
+    engine = create_engine("sqlite://", future=True)
+    with engine.begin() as conn:
+        upgrade(conn)
+        for month in MONTHS:
+            history_partition(month).create(conn)
+            history_marks(month).create(conn)
+    yield engine
+    engine.dispose()
+
+
+def query_plan(engine: Engine, statement: Executable) -> List[str]:
+    compiled = statement.compile(
+        engine, compile_kwargs={"render_postcompile": True})
+    # the values don't change the plan, only their number matters
+    params = (None,) * len(compiled.positiontup)  # type: ignore
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params)
+        return [row[-1] for row in rows]
+
+
+def assert_no_scans(plan: List[str], *tables: str) -> None:
+    for table in tables:
+        assert f"SCAN {table}" not in plan, plan
+
+
+def test_sales(engine: Engine):
+    date = default(datetime)
+    plan = query_plan(engine, Query.offers_by_date(date, date, True))
+    assert_no_scans(plan, "shop", "tree")
+    assert any("USING INDEX ix_shop_type_date" in step for step in plan)
+
+
+def test_statistic(engine: Engine):
+    date = default(datetime)
+    plan = query_plan(engine, Query.stat_units_by_date(
+        MONTHS, [default(UUID)], date, date, False))
+    # every partition of the range by its index
+    for month in MONTHS:
+        assert_no_scans(plan, f"stat_{month}")
+        assert any(f"USING INDEX ix_stat_{month}_id_date" in step
+                   for step in plan)
+        # the marks by their runs, the index covers them
+        assert_no_scans(plan, f"stat_{month}_marks")
+        assert any(f"INDEX ix_stat_{month}_marks_run_date" in step
+                   for step in plan)
+
+
+def test_children_recursive(engine: Engine):
+    plan = query_plan(engine, Query.get_children_recursive(
+        Query.shop_units([default(UUID)])))
+    assert_no_scans(plan, "shop", "tree")
+    assert any("USING INDEX ix_shop_parent" in step for step in plan)
+
+
+@pytest.mark.parametrize("lookup", [Query.get_children, Query.get_parents])
+def test_tree(engine: Engine, lookup):
+    plan = query_plan(engine, lookup(Query.shop_units([default(UUID)])))
+    assert_no_scans(plan, "shop", "tree")
+
+
+def test_history_deletion(engine: Engine):
+    plan = query_plan(engine, Query.delete_history(
+        MONTHS[0], Query.subtree_keys(Query.key(default(UUID)))))
+    assert_no_scans(plan, "shop", f"stat_{MONTHS[0]}", "tree")
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,92 @@
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import Dict, Set
+from uuid import UUID
+
+import pytest
+from SBDY_app import options
+from SBDY_app.database import DATABASE_URL
+from SBDY_app.patches import serialize_datetime
+from SBDY_app.schemas import Import, ImpRequest, ShopUnitType
+
+from utils import (Client, default, do_test, generate_client, setup,
+                   sqlite_only)
+
+setup()
+
+pytestmark = sqlite_only
+
+
+def stored_types() -> Dict[str, Set[str]]:
+    path = DATABASE_URL.split("///", 1)[1]
+    with closing(sqlite3.connect(path)) as conn:
+        tables = ["shop"] + [f"stat_{month}" for month, in conn.execute(
+            "SELECT month FROM history_partitions")]
+        return {column: {row[0] for row in conn.execute(" UNION ".join(
+            f"SELECT typeof({column}) FROM {table}" for table in tables))}
+            for column in ("date", "type")}
+
+
+def import_catalog(client: Client, date: datetime) -> UUID:
+    id = default(UUID)
+    items = [
+        default(Import, id=id, parentId=None,
+                type=ShopUnitType.CATEGORY, price=None),
+        default(Import, parentId=id, type=ShopUnitType.OFFER, price=10),
+        default(Import, parentId=id, type=ShopUnitType.OFFER, price=21)]
+    items[0].price = None
+    data = default(ImpRequest, items=items, updateDate=date)
+    response = client.imports(data.json())
+    assert response.status_code == 200
+    return id
+
+
+def responses(client: Client, id: UUID, date: datetime) -> list:
+    return [client.nodes(id).json(),
+            client.sales(date).json(),
+            client.stats(id, date, date + timedelta(hours=1)).json()]
+
+
+@pytest.mark.parametrize("date", [
+    datetime(2022, 6, 22, 12, 30, 15, 123000),
+    datetime(1922, 6, 22, 12, 30, 15, 123000)])
+def test_compact(monkeypatch: pytest.MonkeyPatch, date: datetime):
+    monkeypatch.setattr(options, "COMPACT_STORAGE", True)
+
+    with generate_client() as client:
+        id = import_catalog(client, date)
+        assert stored_types() == {"date": {"integer"}, "type": {"integer"}}
+
+        unit, sales, stats = responses(client, id, date)
+        assert unit["date"] == serialize_datetime(date)
+        assert unit["type"] == ShopUnitType.CATEGORY
+        assert unit["price"] == 16
+        assert len(sales["items"]) == 2
+        assert len(stats["items"]) == 1
+
+
+@pytest.mark.parametrize("date", [
+    datetime(2022, 6, 22, 12, 30, 15, 123000),
+    datetime(1922, 6, 22, 12, 30, 15, 123000)])
+def test_conversion(monkeypatch: pytest.MonkeyPatch, date: datetime):
+    monkeypatch.setattr(options, "COMPACT_STORAGE", False)
+    monkeypatch.setattr(options, "DEV_MODE", True)
+    with generate_client() as client:
+        id = import_catalog(client, date)
+        expected = responses(client, id, date)
+        assert stored_types() == {"date": {"text"}, "type": {"text"}}
+        # the database is kept from now on, but converted on startup
+        monkeypatch.setattr(options, "DEV_MODE", False)
+
+    for compact, stored in ((True, "integer"), (False, "text")):
+        monkeypatch.setattr(options, "COMPACT_STORAGE", compact)
+        with generate_client() as client:
+            assert stored_types() == {"date": {stored}, "type": {stored}}
+            assert json.dumps(responses(client, id, date)) \
+                == json.dumps(expected)
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,173 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from uuid import UUID, uuid4
+
+import pytest
+from SBDY_app import options
+from SBDY_app.schemas import ImpRequest, Import, ShopUnitType
+from SBDY_app.tree_cache import Changes, TreeCache
+
+from utils import Client, client, default, do_test, setup
+
+setup()
+
+
+@pytest.fixture
+def cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(options, "TREE_CACHE_BYTES", 10 * 1024 * 1024)
+
+
+def category(parent_id: Optional[UUID] = None) -> Import:
+    imp = default(Import, parentId=parent_id,
+                  type=ShopUnitType.CATEGORY, price=None)
+    imp.price = None
+    return imp
+
+
+def offer(parent_id: Optional[UUID], price: int) -> Import:
+    return default(Import, parentId=parent_id, type=ShopUnitType.OFFER,
+                   price=price)
+
+
+def import_items(client: Client, *items: Import) -> None:
+    response = client.imports(default(ImpRequest, items=list(items)).json())
+    assert response.status_code == 200
+
+
+def counters(client: Client) -> Dict[str, int]:
+    response = client.nodes_cache()
+    assert response.status_code == 200
+    return response.json()
+
+
+def stored(client: Client, id: UUID,
+           monkeypatch: pytest.MonkeyPatch) -> Any:
+    # the same route, but past the cache
+    with monkeypatch.context() as patch:
+        patch.setattr(options, "TREE_CACHE_BYTES", 0)
+        response = client.nodes(id)
+    return response.status_code, response.json()
+
+
+def assert_cached(client: Client, id: UUID,
+                  monkeypatch: pytest.MonkeyPatch) -> None:
+    hits = counters(client)["hits"]
+    response = client.nodes(id)
+    assert counters(client)["hits"] == hits + 1
+    assert (response.status_code, response.json()) \
+        == stored(client, id, monkeypatch)
+
+
+def test_hits(client: Client, monkeypatch: pytest.MonkeyPatch):
+    # imported past the cache
+    monkeypatch.setattr(options, "TREE_CACHE_BYTES", 0)
+    root = category()
+    child = category(root.id)
+    import_items(client, root, child, offer(child.id, 10))
+
+    monkeypatch.setattr(options, "TREE_CACHE_BYTES", 10 * 1024 * 1024)
+    assert client.nodes(root.id).status_code == 200
+    assert counters(client)["misses"] == 1
+    # the whole subtree is cached with it
+    assert client.nodes(root.id).status_code == 200
+    assert client.nodes(child.id).status_code == 200
+    assert counters(client)["hits"] == 2
+    assert counters(client)["units"] == 3
+
+    assert client.nodes(uuid4()).status_code == 404
+    assert counters(client)["misses"] == 2
+
+
+def test_imported(cached: None, client: Client,
+                  monkeypatch: pytest.MonkeyPatch):
+    root = category()
+    import_items(client, root, offer(root.id, 10))
+    # the new units are cached as they are imported
+    assert_cached(client, root.id, monkeypatch)
+    assert counters(client)["misses"] == 0
+
+
+def test_write_through(cached: None, client: Client,
+                       monkeypatch: pytest.MonkeyPatch):
+    root, other = category(), category()
+    first, second = category(root.id), category(root.id)
+    moved = offer(first.id, 10)
+    import_items(client, root, first, second, moved, offer(first.id, 30))
+    assert client.nodes(root.id).status_code == 200
+    # not cached
+    with monkeypatch.context() as patch:
+        patch.setattr(options, "TREE_CACHE_BYTES", 0)
+        import_items(client, other)
+
+    # the changes are applied to the cached units, so they are still hits
+    import_items(client, offer(second.id, 20))
+    assert_cached(client, root.id, monkeypatch)
+    import_items(client, moved.copy(update={"price": 50}))
+    assert_cached(client, root.id, monkeypatch)
+    import_items(client, moved.copy(update={"parentId": second.id}))
+    assert_cached(client, root.id, monkeypatch)
+    import_items(client, second.copy(update={"parentId": first.id}))
+    assert_cached(client, root.id, monkeypatch)
+
+    assert client.delete(second.id).status_code == 200
+    assert_cached(client, root.id, monkeypatch)
+    assert client.nodes(second.id).status_code == 404
+    assert client.nodes(moved.id).status_code == 404
+
+    # the subtree of the uncached unit isn't known, so the new parent
+    # and its ancestors are loaded again
+    import_items(client, offer(other.id, 40))
+    import_items(client, other.copy(update={"parentId": first.id}))
+    misses = counters(client)["misses"]
+    response = client.nodes(root.id)
+    assert counters(client)["misses"] == misses + 1
+    assert (response.status_code, response.json()) \
+        == stored(client, root.id, monkeypatch)
+    assert_cached(client, root.id, monkeypatch)
+
+
+def test_budget(client: Client, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(options, "TREE_CACHE_BYTES", 0)
+    roots = [category() for _ in range(5)]
+    for root in roots:
+        import_items(client, root, *(offer(root.id, 10) for _ in range(5)))
+
+    monkeypatch.setattr(options, "TREE_CACHE_BYTES", 10 * 1024 * 1024)
+    assert client.nodes(roots[0].id).status_code == 200
+    size = counters(client)["bytes"]
+
+    # two and a half of the subtrees
+    monkeypatch.setattr(options, "TREE_CACHE_BYTES", size * 5 // 2)
+    for root in roots:
+        assert client.nodes(root.id).status_code == 200
+    result = counters(client)
+    assert result["evictions"] == 3
+    assert result["units"] == 2 * 6
+    assert result["bytes"] <= size * 5 // 2
+
+    # the latest ones are kept
+    assert_cached(client, roots[-1].id, monkeypatch)
+    misses = counters(client)["misses"]
+    assert client.nodes(roots[0].id).status_code == 200
+    assert counters(client)["misses"] == misses + 1
+
+
+def test_commit_during_load(cached: None):
+    cache = TreeCache()
+    id = uuid4()
+
+    class Storage:
+        async def shop_unit(self, id: UUID) -> Dict[UUID, Any]:
+            cache.apply(Changes(), {})
+            return {id: SimpleNamespace(id=id, parentId=None, _unique_id=1,
+                                        children=[])}
+
+    # what it loaded could be older than the commit
+    units: List[Any] = list(asyncio.run(cache.shop_unit(id, Storage())))
+    assert units == [id]
+    assert cache.units == {}
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -5,12 +5,13 @@ Things that simplify the testing process and help with it
 from __future__ import annotations
 
 import json
+import os
 import random
 import string
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import _GenericAlias  # type: ignore
-from typing import Any, Generator, Optional, Type
+from typing import Any, Generator, List, Optional, Type
 from urllib.parse import urljoin
 from uuid import UUID, uuid4
 
@@ -23,9 +24,18 @@ from SBDY_app.schemas import Error, ShopUnitType
 from SBDY_app.typedefs import T
 
 
+# the storage backend of the app, e.g. SBDY_APP_STORAGE=memory pytest
+STORAGE = os.environ.get("SBDY_APP_STORAGE", options.STORAGE_BACKEND)
+
+# the tests that look into the database file itself
+sqlite_only = pytest.mark.skipif(
+    STORAGE != "sqlite", reason="checks the SQLite storage itself")
+
+
 def setup():
     random.seed(69)
     options.DEV_MODE = True
+    options.STORAGE_BACKEND = STORAGE
 
 
 ### Link to the server deployed in the container ###
@@ -89,15 +99,42 @@ class Client:
     def cleanup_database(self):
         return self.client.delete("/_cleanup_database_")
 
-    def imports(self, data: str):
-        return self.client.post("/imports", json=json.loads(data))
+    def imports(self, data: str, key: Optional[str] = None):
+        headers = {}
+        if key is not None:
+            headers["Idempotency-Key"] = key
+        return self.client.post("/imports", json=json.loads(data),
+                                headers=headers)
+
+    def imports_stream(self, lines: str, updateDate: Any = None):
+        if isinstance(updateDate, datetime):
+            updateDate = serialize_datetime(updateDate)
+
+        params = {}
+        if updateDate is not None:
+            params["updateDate"] = updateDate
+        return self.client.post("/imports/stream", params=params,
+                                data=lines.encode("utf-8"))
+
+    def imports_job(self, data: str):
+        return self.client.post("/imports/jobs", json=json.loads(data))
+
+    def import_job(self, id: Any):
+        return self.client.get(f"/imports/jobs/{id}")
 
     def delete(self, id: Any):
         return self.client.delete(f"/delete/{id}")
 
+    def delete_batch(self, ids: List[Any]):
+        return self.client.post("/delete/batch",
+                                json={"ids": [str(id) for id in ids]})
+
     def nodes(self, id: Any):
         return self.client.get(f"/nodes/{id}")
 
+    def nodes_cache(self):
+        return self.client.get("/nodes_cache")
+
     def sales(self, date: Any = None):
         if isinstance(date, datetime):
             date = serialize_datetime(date)